@@ -0,0 +1,108 @@
+import os
+import zipfile
+
+import fiona
+import numpy as np
+from shapely.geometry import LineString, Point, Polygon, mapping
+
+fiona.drvsupport.supported_drivers["FlatGeobuf"] = "rw"
+
+# 合成データを配置する範囲（東京周辺、EPSG:4326）
+EXTENT = (139.5, 35.5, 139.9, 35.8)
+
+KINDS = ("point", "line", "polygon")
+
+# フォーマット名 → (fionaのドライバー, 拡張子)
+FORMATS = {
+    "geojson": ("GeoJSON", ".geojson"),
+    "shapefile": ("ESRI Shapefile", ".shp"),
+    "fgb": ("FlatGeobuf", ".fgb"),
+}
+
+SCHEMA_PROPERTIES = {"code": "int", "value": "float", "name": "str"}
+
+ZONES = 64  # クリップ・イレースに使う区画ポリゴンの数
+
+
+def _geometries(kind: str, size: int, rng: np.random.RandomState):
+    minx, miny, maxx, maxy = EXTENT
+    xs = rng.uniform(minx, maxx, size)
+    ys = rng.uniform(miny, maxy, size)
+    if kind == "point":
+        for x, y in zip(xs, ys):
+            yield Point(x, y)
+    elif kind == "line":
+        steps = rng.normal(0, 0.0005, (size, 4, 2))
+        for x, y, step in zip(xs, ys, steps):
+            yield LineString(np.vstack([[x, y], np.cumsum(step, axis=0) + [x, y]]))
+    elif kind == "polygon":
+        # 中心のまわりに半径の異なる六角形を作る（建物・筆界程度の大きさ）
+        radii = rng.uniform(0.0001, 0.0008, size)
+        angles = np.linspace(0, 2 * np.pi, 7)[:-1]
+        for x, y, r in zip(xs, ys, radii):
+            yield Polygon(np.column_stack([x + r * np.cos(angles), y + r * np.sin(angles)]))
+    else:
+        raise ValueError(f"Unknown kind: {kind}")
+
+
+def _zone_geometries(rng: np.random.RandomState):
+    # 範囲を格子状に分け、各セルを頂点の多い不規則な多角形にする（大きな演算対象ポリゴン）
+    minx, miny, maxx, maxy = EXTENT
+    cells = int(np.sqrt(ZONES))
+    width, height = (maxx - minx) / cells, (maxy - miny) / cells
+    angles = np.linspace(0, 2 * np.pi, 257)[:-1]
+    for i in range(cells):
+        for j in range(cells):
+            cx, cy = minx + (i + 0.5) * width, miny + (j + 0.5) * height
+            radius = rng.uniform(0.3, 0.45, angles.size)
+            yield Polygon(np.column_stack([cx + radius * width * np.cos(angles), cy + radius * height * np.sin(angles)]))
+
+
+def _write(path: str, driver: str, geometry_type: str, geometries, rng: np.random.RandomState):
+    schema = {"geometry": geometry_type, "properties": SCHEMA_PROPERTIES}
+    with fiona.open(path, "w", driver=driver, schema=schema, crs="EPSG:4326") as dst:
+        batch = []
+        for index, geometry in enumerate(geometries):
+            batch.append(fiona.Feature.from_dict({
+                "geometry": mapping(geometry),
+                "properties": {"code": index, "value": float(rng.uniform(0, 1000)), "name": f"feature-{index}"},
+            }))
+            if len(batch) >= 10000:
+                dst.writerecords(batch)
+                batch = []
+        dst.writerecords(batch)
+
+
+def _zip_shapefile(path: str) -> str:
+    # /import_shapefile はZIPでアップロードする
+    base = os.path.splitext(path)[0]
+    zip_path = f"{base}.zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for extension in (".shp", ".shx", ".dbf", ".prj", ".cpg"):
+            if os.path.exists(base + extension):
+                archive.write(base + extension, os.path.basename(base + extension))
+    return zip_path
+
+
+def dataset(directory: str, kind: str, size: int, file_format: str, seed: int = 0) -> str:
+    # 同じ引数からは常に同じ内容のファイルを作る（作成済みであればそのまま使う）
+    driver, extension = FORMATS[file_format]
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{kind}_{size}{extension}")
+    upload_path = f"{os.path.splitext(path)[0]}.zip" if file_format == "shapefile" else path
+    if os.path.exists(upload_path):
+        return upload_path
+
+    rng = np.random.RandomState(seed)
+    geometry_type = {"point": "Point", "line": "LineString", "polygon": "Polygon"}[kind]
+    _write(path, driver, geometry_type, _geometries(kind, size, rng), rng)
+    return _zip_shapefile(path) if file_format == "shapefile" else path
+
+
+def zones(directory: str, seed: int = 0) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"zones_{ZONES}.fgb")
+    if not os.path.exists(path):
+        rng = np.random.RandomState(seed)
+        _write(path, "FlatGeobuf", "Polygon", _zone_geometries(rng), rng)
+    return path
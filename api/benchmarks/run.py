@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from . import datasets
+
+# インポート系エンドポイント（フォーマット → エンドポイント）
+IMPORT_ENDPOINTS = {
+    "geojson": "/import_geojson",
+    "shapefile": "/import_shapefile",
+    "fgb": "/import_flatgeobuf",
+}
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+
+def run_case(case: dict) -> dict:
+    # 1ケースを実行し、経過時間・ピークRSS・行数を返す（ピークRSSを正しく測るため別プロセスで呼び出す）
+    from fastapi.testclient import TestClient
+    from sqlalchemy import text
+
+    from egis_api.database import engine, qualified_name
+    from egis_api.main import app
+
+    with TestClient(app) as client:
+        started = time.perf_counter()
+        if case["type"] == "import":
+            with open(case["path"], "rb") as f:
+                response = client.post(f"{case['endpoint']}/{case['schema']}/{case['table']}", params=case.get("params"),
+                                       files={"file": (os.path.basename(case["path"]), f)})
+        else:
+            response = client.post(case["endpoint"], json=case["body"])
+        wall_seconds = time.perf_counter() - started
+
+    if response.status_code != 200:
+        raise RuntimeError(f"{case['name']} failed: {response.status_code} {response.text}")
+
+    with engine.connect() as connection:
+        rows = connection.execute(text(f"SELECT count(*) FROM {qualified_name(case['schema'], case['table'])}")).scalar()
+    return {
+        "wall_seconds": round(wall_seconds, 3),
+        # Linuxのru_maxrssはKB単位
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rows": rows,
+        "rows_per_second": round(rows / wall_seconds, 1) if wall_seconds > 0 else None,
+    }
+
+
+def _spawn(case: dict) -> dict:
+    output = subprocess.run([sys.executable, "-m", "benchmarks.run", "--case", json.dumps(case)], capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"{case['name']} failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def _execute(sql: str):
+    from sqlalchemy import text
+
+    from egis_api.database import engine
+
+    with engine.connect() as connection:
+        connection.execute(text(sql))
+        connection.commit()
+
+
+def _reset_schema(schema_name: str):
+    from egis_api.database import engine
+
+    quoted = engine.dialect.identifier_preparer.quote(schema_name)
+    _execute(f"DROP SCHEMA IF EXISTS {quoted} CASCADE")
+    _execute(f"CREATE SCHEMA {quoted}")
+
+
+def _drop_table(schema_name: str, table_name: str):
+    from egis_api.database import qualified_name
+
+    _execute(f"DROP TABLE IF EXISTS {qualified_name(schema_name, table_name)}")
+
+
+def build_cases(args) -> list:
+    cases = []
+    for size in args.sizes:
+        for file_format in args.formats:
+            for kind in args.kinds:
+                cases.append({
+                    "name": f"import:{file_format}:{kind}:{size}",
+                    "type": "import",
+                    "endpoint": IMPORT_ENDPOINTS[file_format],
+                    "params": {"copy_format": args.copy_format},
+                    "path": datasets.dataset(args.data_dir, kind, size, file_format, args.seed),
+                    "schema": args.schema,
+                    "table": f"{kind}_{file_format}_{size}",
+                    # 空間解析の入力に使うポリゴンは残す
+                    "keep": kind == "polygon" and file_format == args.formats[-1],
+                })
+        if "polygon" not in args.kinds:
+            continue
+        source = f"polygon_{args.formats[-1]}_{size}"
+        cases += [
+            {"name": f"buffer:{size}", "type": "geoprocessing", "endpoint": "/create_buffer", "schema": args.schema, "table": f"buffer_{size}",
+             "body": {"schema_name": args.schema, "table_name": source, "distance": 10, "unit": "meters", "new_table_name": f"buffer_{size}"}},
+            {"name": f"clip:{size}", "type": "geoprocessing", "endpoint": "/clip", "schema": args.schema, "table": f"clip_{size}",
+             "body": {"schema_name": args.schema, "clippee_table_name": source, "clipper_table_name": "zones", "new_table_name": f"clip_{size}"}},
+            {"name": f"erase:{size}", "type": "geoprocessing", "endpoint": "/erase", "schema": args.schema, "table": f"erase_{size}",
+             "body": {"schema_name": args.schema, "erasee_table_name": source, "eraser_table_name": "zones", "new_table_name": f"erase_{size}"}},
+        ]
+    return cases
+
+
+def compare(results: dict, baseline: dict, tolerance: float, rss_tolerance: float) -> list:
+    # 基準値より tolerance（割合）を超えて遅い・メモリを使うケース、行数が変わったケースを返す
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["wall_seconds"] > base["wall_seconds"] * (1 + tolerance):
+            regressions.append(f"{name}: wall_seconds {base['wall_seconds']} -> {result['wall_seconds']}")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + rss_tolerance):
+            regressions.append(f"{name}: peak_rss_mb {base['peak_rss_mb']} -> {result['peak_rss_mb']}")
+        if result["rows"] != base["rows"]:
+            regressions.append(f"{name}: rows {base['rows']} -> {result['rows']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="インポート・空間解析のベンチマーク（api/ディレクトリで python -m benchmarks.run として実行する）")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=list(DEFAULT_SIZES))
+    parser.add_argument("--kinds", type=lambda value: value.split(","), default=list(datasets.KINDS))
+    parser.add_argument("--formats", type=lambda value: value.split(","), default=list(datasets.FORMATS))
+    parser.add_argument("--copy-format", default="binary")
+    parser.add_argument("--schema", default="egis_benchmark")
+    parser.add_argument("--data-dir", default="/tmp/egis_benchmark_data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmarks/results.json")
+    parser.add_argument("--baseline", default="benchmarks/baseline.json")
+    parser.add_argument("--update-baseline", action="store_true", help="結果を基準値として保存する")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="経過時間の許容される悪化の割合")
+    parser.add_argument("--rss-tolerance", type=float, default=0.2, help="ピークRSSの許容される悪化の割合")
+    parser.add_argument("--keep", action="store_true", help="終了後もベンチマーク用のスキーマを削除しない")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    from egis_api import importers
+
+    cases = build_cases(args)
+    _reset_schema(args.schema)
+    importers.import_vector(datasets.zones(args.data_dir, args.seed), args.schema, "zones")
+
+    results = {}
+    try:
+        for case in cases:
+            results[case["name"]] = _spawn(case)
+            print(f"{case['name']:32} {json.dumps(results[case['name']])}", flush=True)
+            if not case.get("keep"):
+                _drop_table(case["schema"], case["table"])
+    finally:
+        if not args.keep:
+            from egis_api.database import engine
+
+            _execute(f"DROP SCHEMA IF EXISTS {engine.dialect.identifier_preparer.quote(args.schema)} CASCADE")
+
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(), "copy_format": args.copy_format},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance, args.rss_tolerance)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fiona
+from fastapi import HTTPException
+
+from . import changes, config, importers, jobs, merge, metrics, planar, pyramid, uploads
+
+# 1つのファイルが1レイヤーになる形式（GeoPackageはファイル内のレイヤーごとに取り込む）
+SINGLE_LAYER_EXTENSIONS = (".shp", ".geojson", ".fgb")
+MULTI_LAYER_EXTENSIONS = (".gpkg",)
+
+# PostgreSQLの識別子の最大長
+_MAX_IDENTIFIER_LENGTH = 63
+
+
+def _table_name(name: str, prefix: str, used: set) -> str:
+    # レイヤー名から英数字（と日本語などの文字）以外を _ に置き換えたテーブル名を作る（重複する場合は連番を付ける）
+    base = (prefix + re.sub(r"\W+", "_", name).strip("_").lower())[:_MAX_IDENTIFIER_LENGTH] or "layer"
+    table_name, number = base, 1
+    while table_name in used:
+        number += 1
+        suffix = f"_{number}"
+        table_name = base[:_MAX_IDENTIFIER_LENGTH - len(suffix)] + suffix
+    used.add(table_name)
+    return table_name
+
+
+def discover(directory: str, prefix: str = "") -> list:
+    # 展開したディレクトリからレイヤーを探す（大きいものから処理して終了時刻を揃える）
+    # 戻り値は {"source", "path", "layer", "table_name", "bytes"} の一覧
+    layers = []
+    for root, dirs, files in os.walk(directory):
+        # macOSで作成したZIPに含まれるメタデータは除く
+        dirs[:] = [name for name in dirs if name != "__MACOSX"]
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            stem, extension = os.path.splitext(filename)
+            extension = extension.lower()
+            source = os.path.relpath(path, directory)
+            if extension in SINGLE_LAYER_EXTENSIONS:
+                layers.append({"source": source, "path": path, "layer": None, "name": stem, "bytes": os.path.getsize(path)})
+            elif extension in MULTI_LAYER_EXTENSIONS:
+                for layer in fiona.listlayers(path):
+                    with fiona.open(path, layer=layer) as src:
+                        # ジオメトリを持たない属性テーブルは取り込まない
+                        if src.schema.get("geometry") in (None, "None"):
+                            continue
+                        count = len(src)
+                    layers.append({"source": f"{source}:{layer}", "path": path, "layer": layer, "name": layer, "count": count})
+    # GeoPackageのレイヤーの大きさをファイルサイズから按分する
+    for path in {layer["path"] for layer in layers if "count" in layer}:
+        same_file = [layer for layer in layers if layer["path"] == path]
+        total = sum(layer["count"] for layer in same_file) or 1
+        for layer in same_file:
+            layer["bytes"] = os.path.getsize(path) * layer.pop("count") // total
+
+    used = set()
+    for layer in layers:
+        layer["table_name"] = _table_name(layer.pop("name"), prefix, used)
+    return sorted(layers, key=lambda layer: layer["bytes"], reverse=True)
+
+
+def _import_layer(layer: dict, schema_name: str, copy_format: str, storage: str, generalize: bool, mode: str, key: str) -> dict:
+    # 子プロセスで1レイヤーを取り込む（例外は親プロセスで復元できない場合があるため、結果として返す）
+    started = time.perf_counter()
+    result = {"source": layer["source"], "table_name": layer["table_name"]}
+    try:
+        stats = importers.import_vector(layer["path"], schema_name, layer["table_name"], copy_format, storage, layer=layer["layer"],
+                                        generalize=generalize, mode=mode, key=key)
+        result.update(state="succeeded", **stats)
+    except Exception as e:
+        result.update(state="failed", error=e.detail if isinstance(e, HTTPException) else str(e))
+    result["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+@metrics.operation("import_archive")
+def import_archive(zip_path: str, schema_name: str, copy_format: str = "csv", storage: str = "geography", generalize: bool = False,
+                   mode: str = "create", key: str = None, table_prefix: str = "") -> dict:
+    # アーカイブ内のすべてのレイヤーを、レイヤーごとのテーブルに ARCHIVE_IMPORT_WORKERS 個のプロセスで並列に取り込む
+    # 読み込み・型変換・投影変換はGILに縛られるため、スレッドではなくプロセスに分ける
+    merge.check_mode(mode, key)
+    planar.check_storage(storage)
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=uploads.spool_dir()) as directory:
+        jobs.report(phase="extract")
+        with zipfile.ZipFile(zip_path) as archive:
+            archive.extractall(directory)
+        layers = discover(directory, table_prefix)
+        if not layers:
+            raise HTTPException(status_code=400, detail="No vector layers found in the archive")
+
+        jobs.report(phase="import", layers_total=len(layers), layers_done=0, layers_failed=0)
+        results = []
+        workers = min(config.ARCHIVE_IMPORT_WORKERS, len(layers))
+        # スレッドやDB接続を持つAPIサーバーからforkするとロックや接続の状態を引き継いでしまうため、spawnで起動する
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [
+                pool.submit(_import_layer, layer, schema_name, copy_format, storage, generalize, mode, key)
+                for layer in layers
+            ]
+            try:
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    # 子プロセスのキャッシュの無効化はこのプロセスに届かないため、ここで改めて通知する
+                    if result["state"] == "succeeded":
+                        changes.table_changed(schema_name, result["table_name"])
+                        for name in pyramid.levels(schema_name, result["table_name"]).values():
+                            changes.table_changed(schema_name, name)
+                    jobs.report(layers_done=len(results), layers_failed=sum(result["state"] == "failed" for result in results))
+                    jobs.check_cancelled()
+            except jobs.JobCancelled:
+                # 取り消された場合は未着手のレイヤーを取り消す（実行中のレイヤーは完了まで待つ）
+                pool.shutdown(cancel_futures=True)
+                raise
+
+    order = {layer["table_name"]: index for index, layer in enumerate(layers)}
+    results.sort(key=lambda result: order[result["table_name"]])
+    failed = [result for result in results if result["state"] == "failed"]
+    summary = {
+        "layers": len(results),
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "rows": sum(result.get("rows", 0) for result in results),
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+        "results": results,
+    }
+    if len(failed) == len(results):
+        raise HTTPException(status_code=500, detail={"message": "Archive import failed", **summary})
+    return summary
@@ -0,0 +1,196 @@
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+from sqlalchemy import inspect, text
+
+from . import config
+from .database import async_engine, engine
+
+logger = logging.getLogger(__name__)
+
+SCHEMAS_SQL = "SELECT schema_name FROM information_schema.schemata"
+
+# DDLをNOTIFYで通知するイベントトリガー（作成にはスーパーユーザー権限が必要）
+EVENT_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION public.egis_catalog_notify() RETURNS event_trigger LANGUAGE plpgsql AS $$
+DECLARE
+    obj record;
+BEGIN
+    IF TG_EVENT = 'sql_drop' THEN
+        FOR obj IN SELECT * FROM pg_event_trigger_dropped_objects() LOOP
+            PERFORM pg_notify('{config.CATALOG_NOTIFY_CHANNEL}', coalesce(obj.schema_name, obj.object_identity, ''));
+        END LOOP;
+    ELSE
+        FOR obj IN SELECT * FROM pg_event_trigger_ddl_commands() LOOP
+            PERFORM pg_notify('{config.CATALOG_NOTIFY_CHANNEL}', coalesce(obj.schema_name, obj.object_identity, ''));
+        END LOOP;
+    END IF;
+END;
+$$;
+DROP EVENT TRIGGER IF EXISTS egis_catalog_ddl;
+DROP EVENT TRIGGER IF EXISTS egis_catalog_drop;
+CREATE EVENT TRIGGER egis_catalog_ddl ON ddl_command_end EXECUTE FUNCTION public.egis_catalog_notify();
+CREATE EVENT TRIGGER egis_catalog_drop ON sql_drop EXECUTE FUNCTION public.egis_catalog_notify();
+"""
+
+
+class Catalog:
+    # スキーマ・テーブル・列の一覧をTTL付きでメモリ上に保持する
+    # このAPI自身のDDLでは changes から、外部のDDLはイベントトリガーの通知（有効な場合）またはTTLで無効化される
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}  # key -> (有効期限, 値)
+        self._generation = 0  # 無効化の回数（取得中に無効化された値を保存しないため）
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        # (キャッシュ済みの値, 取得開始時点の無効化回数)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1], None
+            return None, self._generation
+
+    def _store(self, key, value, generation: int, keep_empty: bool = False):
+        with self._lock:
+            # 空の結果は保存しない（作成直後のテーブルを見落とさないため）。keep_empty の場合は None 以外を保存する
+            if (value or (keep_empty and value is not None)) and generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def _get(self, key, load, keep_empty: bool = False):
+        value, generation = self._lookup(key)
+        if generation is None:
+            return value
+        value = load()
+        self._store(key, value, generation, keep_empty)
+        return value
+
+    async def _aget(self, key, load, keep_empty: bool = False):
+        value, generation = self._lookup(key)
+        if generation is None:
+            return value
+        value = await load()
+        self._store(key, value, generation, keep_empty)
+        return value
+
+    def schemas(self) -> list:
+        def load():
+            with engine.connect() as connection:
+                result = connection.execute(text(SCHEMAS_SQL))
+                return [row[0] for row in result.fetchall()]
+        return self._get(("schemas",), load)
+
+    def tables(self, schema_name: str) -> list:
+        return self._get(("tables", schema_name), lambda: inspect(engine).get_table_names(schema=schema_name))
+
+    def columns(self, schema_name: str, table_name: str) -> list:
+        # inspector.get_columns と同じ形式（name, type, nullable, ...）の列定義
+        def load():
+            if table_name not in self.tables(schema_name):
+                return []
+            return inspect(engine).get_columns(table_name, schema=schema_name)
+        return self._get(("columns", schema_name, table_name), load)
+
+    # 以下はイベントループ上から使う非同期版（キャッシュは同期版と共有する）
+    async def aschemas(self) -> list:
+        async def load():
+            async with async_engine.connect() as connection:
+                result = await connection.execute(text(SCHEMAS_SQL))
+                return [row[0] for row in result.fetchall()]
+        return await self._aget(("schemas",), load)
+
+    async def atables(self, schema_name: str) -> list:
+        async def load():
+            async with async_engine.connect() as connection:
+                return await connection.run_sync(lambda sync_connection: inspect(sync_connection).get_table_names(schema=schema_name))
+        return await self._aget(("tables", schema_name), load)
+
+    async def acolumns(self, schema_name: str, table_name: str) -> list:
+        async def load():
+            if table_name not in await self.atables(schema_name):
+                return []
+            async with async_engine.connect() as connection:
+                return await connection.run_sync(lambda sync_connection: inspect(sync_connection).get_columns(table_name, schema=schema_name))
+        return await self._aget(("columns", schema_name, table_name), load)
+
+    def cached(self, key: tuple, load, keep_empty: bool = False):
+        # テーブルから求めた任意の値を (種類, スキーマ名, テーブル名) をキーとしてキャッシュする（テーブルの無効化で破棄される）
+        # keep_empty の場合は空の値もキャッシュする（load が None を返した場合はキャッシュしない）
+        return self._get(key, load, keep_empty)
+
+    async def acached(self, key: tuple, load, keep_empty: bool = False):
+        return await self._aget(key, load, keep_empty)
+
+    def discard(self, key: tuple):
+        # テーブルに結び付かないキーでキャッシュした値を破棄する
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def has_table(self, schema_name: str, table_name: str) -> bool:
+        # キャッシュにない場合は取得し直して確認する（外部で作成された直後のテーブル）
+        if table_name in self.tables(schema_name):
+            return True
+        self.invalidate(schema_name)
+        return table_name in self.tables(schema_name)
+
+    def invalidate(self, schema_name: str = None, table_name: str = None):
+        # schema_name を省略した場合はすべて、table_name を省略した場合はスキーマ内のすべてを破棄する
+        with self._lock:
+            self._generation += 1
+            if schema_name is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                if key[0] == "schemas" or (len(key) > 1 and key[1] == schema_name and (table_name is None or len(key) == 2 or key[2] == table_name)):
+                    del self._entries[key]
+
+
+catalog = Catalog(config.CATALOG_TTL)
+
+
+def install_event_trigger():
+    with engine.connect() as connection:
+        connection.execute(text(EVENT_TRIGGER_SQL))
+        connection.commit()
+
+
+def _listen():
+    # 通知を受け取ったスキーマのキャッシュを破棄する（接続が切れた場合は再接続する）
+    url = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        connection = None
+        try:
+            connection = psycopg2.connect(url)
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {config.CATALOG_NOTIFY_CHANNEL}")
+            # 接続直後は通知を取りこぼしている可能性があるため、すべて破棄する
+            catalog.invalidate()
+            while True:
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    catalog.invalidate(notify.payload or None)
+        except Exception:
+            logger.exception("catalog listener disconnected")
+            if connection is not None:
+                connection.close()
+            time.sleep(5)
+
+
+def start_listener():
+    # CATALOG_LISTEN が有効な場合、イベントトリガーを作成して通知の受信を開始する
+    if not config.CATALOG_LISTEN:
+        return
+    try:
+        install_event_trigger()
+    except Exception:
+        logger.warning("could not install the catalog event trigger; falling back to CATALOG_TTL", exc_info=True)
+        return
+    threading.Thread(target=_listen, name="egis-catalog-listener", daemon=True).start()
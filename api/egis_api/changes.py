@@ -0,0 +1,120 @@
+import logging
+import threading
+
+from sqlalchemy import text
+
+from . import config, tilecache
+from .catalog import catalog
+from .database import async_engine, engine
+
+logger = logging.getLogger(__name__)
+
+# テーブルのバージョン（このAPIでの変更の回数）を RESULT_CACHE_SCHEMA の table_versions に記録する
+# 空間解析の結果の記録（results）とベクタータイルのETag（routes/tiles）で、テーブルが変更されていないかの判定に使う
+# バージョンを記録するのは空間解析で track したテーブルだけで、それ以外のテーブルの変更では行を更新しない
+# バージョンだけではこのAPIを経由しない変更はテーブルの作り直し（OIDの変化）のみ検出できるため、タイルでは統計情報も併せて使う
+
+_SETUP_SQL = """
+CREATE SCHEMA IF NOT EXISTS {schema};
+CREATE TABLE IF NOT EXISTS {schema}.table_versions (
+    schema_name text NOT NULL,
+    table_name text NOT NULL,
+    version bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (schema_name, table_name)
+);
+"""
+
+_TRACK_SQL = """
+INSERT INTO {schema}.table_versions (schema_name, table_name) VALUES (:schema_name, :table_name)
+ON CONFLICT (schema_name, table_name) DO NOTHING
+"""
+
+# テーブルの現在の [バージョン, OID]（テーブルがなければ null）
+VERSION_SQL = """
+CASE WHEN to_regclass(quote_ident({schema_name}) || '.' || quote_ident({table_name})) IS NOT NULL THEN jsonb_build_array(
+    coalesce((SELECT v.version FROM {schema}.table_versions v WHERE v.schema_name = {schema_name} AND v.table_name = {table_name}), 0),
+    to_regclass(quote_ident({schema_name}) || '.' || quote_ident({table_name}))::oid::bigint
+) END
+"""
+
+_ready = False
+_ready_lock = threading.Lock()
+_versions_exist = False  # table_versions が作成済みか（読み取りの処理では作成しないため）
+
+
+def versions_schema() -> str:
+    return engine.dialect.identifier_preparer.quote(config.RESULT_CACHE_SCHEMA)
+
+
+def setup():
+    # 管理用のスキーマとテーブルを作成する（プロセスごとに1回）
+    global _ready, _versions_exist
+    if _ready:
+        return
+    with _ready_lock:
+        if not _ready:
+            with engine.connect() as setup_connection:
+                setup_connection.execute(text(_SETUP_SQL.format(schema=versions_schema())))
+                setup_connection.commit()
+            _ready = _versions_exist = True
+
+
+def track(connection, tables):
+    # テーブルをバージョンの記録の対象にする（以降の変更で table_changed が行を更新する）
+    for schema_name, table_name in tables:
+        connection.execute(text(_TRACK_SQL.format(schema=versions_schema())), {"schema_name": schema_name, "table_name": table_name})
+
+
+def version(connection, schema_name: str, table_name: str):
+    return connection.execute(
+        text("SELECT " + VERSION_SQL.format(schema=versions_schema(), schema_name=":schema_name", table_name=":table_name")),
+        {"schema_name": schema_name, "table_name": table_name},
+    ).scalar()
+
+
+async def atable_state(schema_name: str, table_name: str):
+    # テーブルの内容が変わると変わる値（ベクタータイルのETagに使う。読み取りのみで、table_versions に行を追加しない）
+    # このAPIでの変更回数に加えて、挿入・更新・削除の行数の累計（統計情報）と relfilenode を含め、外部のクライアントによる変更も反映する
+    # （統計情報は各トランザクションの終了後に非同期で反映されるため、外部の変更は1秒程度遅れて反映されることがある）
+    global _versions_exist
+    async with async_engine.connect() as connection:
+        if not _versions_exist:
+            _versions_exist = (await connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": f"{versions_schema()}.table_versions"})).scalar()
+        # 記録の対象でないテーブルのバージョンは0とする
+        version = f"""coalesce((SELECT v.version FROM {versions_schema()}.table_versions v
+                               WHERE v.schema_name = :schema_name AND v.table_name = :table_name), 0)""" if _versions_exist else "0"
+        row = (await connection.execute(text(f"""
+            SELECT c.oid::bigint, c.relfilenode::bigint, s.n_tup_ins, s.n_tup_upd, s.n_tup_del, {version}
+            FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE c.oid = to_regclass(quote_ident(:schema_name) || '.' || quote_ident(:table_name))
+        """), {"schema_name": schema_name, "table_name": table_name})).first()
+        return tuple(row) if row is not None else None
+
+
+def _bump(schema_name: str, table_name: str):
+    # テーブルのバージョンを上げる（記録の対象でないテーブルでは何も更新されない）
+    # トランザクションを開始せず1回の問い合わせで済ませる
+    if schema_name == config.RESULT_CACHE_SCHEMA:
+        return
+    try:
+        setup()
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text(f"""
+                UPDATE {versions_schema()}.table_versions SET version = version + 1 WHERE schema_name = :schema_name AND table_name = :table_name
+            """), {"schema_name": schema_name, "table_name": table_name})
+    except Exception:
+        logger.warning("could not bump the version of %s.%s", schema_name, table_name, exc_info=True)
+
+
+def table_changed(schema_name: str, table_name: str):
+    # テーブルの作成・更新・削除の後に呼び出し、そのテーブルに依存するキャッシュを無効化する
+    # GeoServerのレイヤー名はテーブル名と同じ
+    catalog.invalidate(schema_name, table_name)
+    tilecache.cache.invalidate_layer(table_name)
+    # 保存済みの空間解析結果・ベクタータイルのETagのうち、このテーブルに依存するものを使われないようにする
+    _bump(schema_name, table_name)
+
+
+def schema_changed(schema_name: str):
+    # スキーマの作成・削除の後に呼び出す
+    catalog.invalidate(schema_name)
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import re
+import tempfile
+import time
+import zipfile
+from collections import deque
+
+from fastapi import HTTPException
+
+from . import config, jobs, metrics, uploads
+
+# Importer/Exporter のログ行（[12:34:56 INFO] メッセージ）
+_LOG_LINE = re.compile(r"^\[(?P<time>\d{2}:\d{2}:\d{2}) (?P<level>[A-Z]+)\] (?P<message>.*)$")
+# 処理結果の集計行（"Building: 120" など、"Imported city objects:" の後に出力される）
+_COUNT_LINE = re.compile(r"^(?:\[[^\]]+\] )?\s*(?P<name>[A-Za-z][\w ]*?):\s+(?P<count>\d+)\s*$")
+
+CITYGML_EXTENSIONS = (".gml",)
+
+# ログ1行の最大長（バイト）
+_LINE_LIMIT = 1024 * 1024
+
+
+def _command(path: str) -> list:
+    return [
+        "impexp", "import",
+        "-H", config.DB_HOST,
+        "-P", config.DB_PORT,
+        "-d", config.DB_NAME,
+        "-u", config.DB_USER_NAME,
+        "-p", config.DB_USER_PASS,
+        path,
+    ]
+
+
+def discover(directory: str) -> list:
+    # 展開したディレクトリからタイルごとのCityGMLファイルを探す（大きいファイルから処理して終了時刻を揃える）
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if filename.lower().endswith(CITYGML_EXTENSIONS):
+                paths.append(os.path.join(root, filename))
+    return sorted(paths, key=os.path.getsize, reverse=True)
+
+
+class _Tile:
+    # 1つのCityGMLファイルのインポート状況
+    def __init__(self, path: str, directory: str):
+        self.path = path
+        self.name = os.path.relpath(path, directory)
+        self.state = "queued"
+        self.objects = {}
+        self.errors = []
+        self.warnings = 0
+        self.returncode = None
+        self.elapsed = None
+        self._tail = deque(maxlen=config.CITYGML_LOG_TAIL)
+        self._counting = False
+
+    def parse(self, line: str):
+        # ログを1行ずつ解析し、エラーと取り込んだオブジェクト数を記録する
+        self._tail.append(line)
+        match = _LOG_LINE.match(line)
+        message = match.group("message") if match else line
+        if match and match.group("level") == "ERROR":
+            self.errors.append(message)
+        elif match and match.group("level") == "WARN":
+            self.warnings += 1
+        if "imported city objects" in message.lower():
+            self._counting = True
+            return
+        if self._counting:
+            count = _COUNT_LINE.match(message.strip())
+            if count:
+                self.objects[count.group("name").strip()] = int(count.group("count"))
+            else:
+                self._counting = False
+
+    def to_dict(self) -> dict:
+        result = {"file": self.name, "state": self.state, "objects": self.objects, "warnings": self.warnings, "returncode": self.returncode, "elapsed_seconds": self.elapsed}
+        if self.state == "failed":
+            result["errors"] = self.errors or list(self._tail)
+        return result
+
+
+def _report(tiles: list):
+    states = [tile.state for tile in tiles]
+    jobs.report(
+        tiles_total=len(tiles),
+        tiles_done=states.count("succeeded") + states.count("failed"),
+        tiles_failed=states.count("failed"),
+        tiles_running=[tile.name for tile in tiles if tile.state == "running"],
+    )
+
+
+async def _import_tile(tile: _Tile, tiles: list, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        jobs.check_cancelled()
+        tile.state = "running"
+        _report(tiles)
+        started = time.perf_counter()
+        # 標準エラー出力も同じストリームで受け取り、終了を待たずに1行ずつ解析する
+        try:
+            process = await asyncio.create_subprocess_exec(*_command(tile.path), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                                                           limit=_LINE_LIMIT)
+        except OSError as e:
+            # impexp を起動できない場合はそのタイルの失敗として記録する
+            tile.errors.append(str(e))
+            process = None
+        if process is not None:
+            with jobs.tracked_process(process):
+                async for line in process.stdout:
+                    tile.parse(line.decode("utf-8", errors="replace").rstrip())
+                tile.returncode = await process.wait()
+        tile.elapsed = round(time.perf_counter() - started, 3)
+        tile.state = "succeeded" if tile.returncode == 0 else "failed"
+        metrics.STEP_DURATION.labels(metrics.operation_name(), "impexp").observe(tile.elapsed)
+        _report(tiles)
+
+
+async def _import_tiles(tiles: list):
+    semaphore = asyncio.Semaphore(config.CITYGML_PARALLELISM)
+    await asyncio.gather(*(_import_tile(tile, tiles, semaphore) for tile in tiles))
+
+
+def _extract(archive_path: str, directory: str) -> str:
+    # ZIPはタイルごとのファイルに展開する（テクスチャ等の関連ファイルも相対パスのまま展開する）
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            archive.extractall(directory)
+        return directory
+    return os.path.dirname(archive_path)
+
+
+@metrics.operation("import_citygml")
+def import_archive(archive_path: str) -> dict:
+    # タイルごとに impexp を CITYGML_PARALLELISM 個まで同時に実行する
+    # ジョブのワーカースレッド内で専用のイベントループを回すため、APIサーバーのイベントループは待たされない
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=uploads.spool_dir()) as directory:
+        jobs.report(phase="extract")
+        root = _extract(archive_path, directory)
+        paths = discover(root) if root == directory else [archive_path]
+        if not paths:
+            raise HTTPException(status_code=400, detail="No CityGML files found in the archive")
+
+        tiles = [_Tile(path, root) for path in paths]
+        jobs.report(phase="impexp")
+        _report(tiles)
+        asyncio.run(_import_tiles(tiles))
+
+    failed = [tile.to_dict() for tile in tiles if tile.state == "failed"]
+    objects = {}
+    for tile in tiles:
+        for name, count in tile.objects.items():
+            objects[name] = objects.get(name, 0) + count
+    summary = {
+        "tiles": len(tiles),
+        "succeeded": len(tiles) - len(failed),
+        "failed": failed,
+        "objects": objects,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+        "results": [tile.to_dict() for tile in tiles],
+    }
+    if len(failed) == len(tiles):
+        raise HTTPException(status_code=500, detail={"message": "CityGML import failed", **summary})
+    return summary
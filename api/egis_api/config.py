@@ -2,10 +2,100 @@
 GEOSERVER_URL = "http://host.docker.internal:8080/geoserver"
 GEOSERVER_USER_NAME = "admin"
 GEOSERVER_USER_PASS = "geoserver"
+GEOSERVER_TIMEOUT = 30  # GeoServer REST APIのタイムアウト（秒）
+GEOSERVER_MAX_CONNECTIONS = 20  # GeoServerへの同時接続数の上限（keep-aliveで使い回す）
+GEOSERVER_RETRIES = 3  # 接続エラー・一時的なエラー（502/503/504）時の再試行回数
+GEOSERVER_RETRY_BACKOFF = 0.5  # 再試行までの待ち時間の初期値（秒、再試行ごとに倍にする）
+GEOSERVER_BATCH_CONCURRENCY = 4  # 一括公開・一括削除で同時に送るリクエスト数
 
 # Postgres
 DB_HOST = "db"
 DB_USER_NAME = "postgres"
 DB_USER_PASS = "password"
 DB_PORT = "5432"
-DB_NAME = "egis"
\ No newline at end of file
+DB_NAME = "egis"
+DB_POOL_SIZE = 10  # 常時保持する接続数
+DB_MAX_OVERFLOW = 20  # 混雑時に一時的に追加できる接続数
+DB_POOL_TIMEOUT = 30  # 空き接続を待つ時間の上限（秒）
+DB_POOL_RECYCLE = 1800  # 接続を作り直すまでの時間（秒）
+DB_POOL_PRE_PING = True  # 接続を使う前に疎通を確認する（DBの再起動後に切れた接続を使わないため）
+DB_STATEMENT_TIMEOUT = 0  # インポート・空間解析などで使う同期接続のステートメントタイムアウト（ミリ秒、0は無制限）
+DB_READ_POOL_SIZE = 10  # 読み取り系エンドポイント用の非同期接続数
+DB_READ_MAX_OVERFLOW = 20  # 読み取り系エンドポイント用に一時的に追加できる非同期接続数
+DB_READ_STATEMENT_TIMEOUT = 30000  # 読み取り系エンドポイントのステートメントタイムアウト（ミリ秒）
+
+# Import
+UPLOAD_SPOOL_DIR = "/tmp/egis_uploads"  # アップロードファイルを一時保存するディレクトリ
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # アップロードファイルをディスクへ書き出す単位（バイト）
+IMPORT_BATCH_SIZE = 50000  # 1回に読み込んで書き込むフィーチャー数（インポート時のメモリ使用量の上限を決める）
+SCHEMA_SAMPLE_BATCHES = 2  # 列の型の推定に使う先頭のバッチ数（推定中はこの数のバッチをメモリに保持する）
+RESUMABLE_MAX_FILE_SIZE = 100 * 1024 ** 3  # 再開可能なアップロードで受け付けるファイルの最大サイズ（バイト）
+RESUMABLE_MAX_CHUNK_SIZE = 256 * 1024 * 1024  # 再開可能なアップロードで1回のPUTで送れる最大サイズ（バイト）
+RESUMABLE_SESSION_TTL = 24 * 3600  # 更新のないアップロードセッションを削除するまでの時間（秒）
+
+# Archive import
+ARCHIVE_IMPORT_WORKERS = 4  # 複数レイヤーのアーカイブを取り込む際に同時に実行するプロセス数（レイヤー単位）
+
+# CityGML
+CITYGML_PARALLELISM = 4  # 同時に実行する impexp プロセス数（タイル単位）
+CITYGML_LOG_TAIL = 20  # 失敗したタイルの結果に含めるログの行数（エラー行がない場合）
+
+# Jobs
+JOB_WORKERS = 4  # バックグラウンドジョブを同時に実行するワーカー数
+JOB_HISTORY_LIMIT = 200  # 保持する完了済みジョブの件数
+
+# Vector tiles
+TILE_EXTENT = 4096  # MVTタイルの座標範囲
+TILE_BUFFER = 64  # タイル境界の外側に含めるバッファ（タイル座標単位）
+TILE_FEATURE_LIMITS = {0: 5000, 6: 20000, 12: 50000}  # ズームレベルごとの1タイルあたりの最大フィーチャー数（キーは適用を開始するズームレベル）
+TILE_CACHE_MAX_AGE = 60  # タイルレスポンスのCache-Control max-age（秒）
+
+# WMS tile cache
+WMS_CACHE_DIR = "/tmp/egis_wms_cache"  # WMSタイルをキャッシュするディレクトリ（ワーカープロセスごとのサブディレクトリに保存する）
+WMS_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # ワーカープロセスごとのキャッシュの上限サイズ（バイト）
+WMS_TILE_SIZE = 256  # キャッシュ対象とするタイルの大きさ（ピクセル）
+WMS_METATILE = 4  # 1回の描画でまとめて取得するタイル数（縦横それぞれ）
+WMS_REQUEST_TIMEOUT = 60  # GeoServerへのリクエストのタイムアウト（秒）
+
+# Features
+FEATURES_FETCH_SIZE = 5000  # サーバーサイドカーソルから1回に取得する行数
+
+# Table summary
+SUMMARY_SAMPLE_ROWS = 10000  # ジオメトリの種類の内訳を集計するために抽出する行数の目安（TABLESAMPLE）
+SUMMARY_PREVIEW_ROWS = 10  # プレビューで返す行数の既定値
+SUMMARY_PREVIEW_PIXELS = 512  # プレビューのジオメトリを簡略化する精度（テーブルの範囲を何ピクセルで表示する想定か）
+
+# Overlay (clip / erase)
+OVERLAY_SUBDIVIDE_VERTICES = 256  # クリップ・イレースに使うポリゴンを分割する際の最大頂点数
+OVERLAY_PARTITIONS = 32  # 対象レイヤーを分割する空間区画の数
+OVERLAY_PARALLELISM = 4  # 区画を同時に処理するDBセッション数
+
+# Maintenance
+MAINTENANCE_WORK_MEM = "1GB"  # インデックス作成・CLUSTER時の maintenance_work_mem
+MAINTENANCE_FILLFACTOR = 100  # 作成したテーブルのfillfactor（読み取り中心のため100%、追記・更新が多い場合は下げる）
+MAINTENANCE_INDEX_FILLFACTOR = 100  # GiSTインデックスのfillfactor
+MAINTENANCE_CLUSTER = False  # 投入後にジオハッシュ順でテーブルを並べ直す（CLUSTER）。インポートは各バッチをヒルベルト曲線の順に並べて書き込むため既定では行わない
+
+# Generalized levels
+PYRAMID_ZOOMS = (5, 8, 11)  # 簡略化したテーブルを作成するズームレベル（各テーブルはそのズームレベル以下の描画に使う）
+PYRAMID_PIXEL_TOLERANCE = 0.5  # 簡略化の許容誤差（各ズームレベルでのピクセル数）
+PYRAMID_WMS = True  # Trueの場合、WMSプロキシは低ズームのGetMapを簡略化したレイヤーに置き換える
+
+# Planar storage
+PLANAR_MAX_SPAN_DEGREES = 6  # 投影座標系（UTM）の列を追加できるデータ範囲の最大幅（度）
+
+# Result cache
+RESULT_CACHE_ENABLED = True  # Trueの場合、同じ入力テーブル・パラメータの空間解析の結果を記録し、複製して再利用する
+RESULT_CACHE_SCHEMA = "egis_cache"  # 結果の記録・保持した結果の複製とテーブルのバージョン（ベクタータイルのETagにも使う）を格納するスキーマ
+RESULT_CACHE_MAX_BYTES = 10 * 1024 ** 3  # 保持する結果の複製の合計サイズの上限（バイト、超えた分は最後に使われた日時が古い記録から複製とともに削除する）
+RESULT_CACHE_MAX_ENTRIES = 1000  # 記録する結果の数の上限（超えた分は最後に使われた日時が古いものから削除する）
+
+# Metrics
+SLOW_QUERY_LOG = False  # Trueの場合、SLOW_QUERY_THRESHOLD 秒以上かかったSQLをログに出力する
+SLOW_QUERY_THRESHOLD = 1.0  # スロークエリとして記録する実行時間（秒）
+SLOW_QUERY_EXPLAIN = True  # スロークエリのログにEXPLAINの結果を含める
+
+# Catalog cache
+CATALOG_TTL = 300  # スキーマ・テーブル・列の一覧をキャッシュする時間（秒）
+CATALOG_LISTEN = False  # Trueの場合、イベントトリガーとLISTEN/NOTIFYで外部のDDLも即座に反映する（スーパーユーザー権限が必要）
+CATALOG_NOTIFY_CHANNEL = "egis_catalog"  # DDLの通知に使うチャンネル名
@@ -0,0 +1,123 @@
+import decimal
+import json
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import mapping
+from sqlalchemy import Boolean, SmallInteger, Integer, BigInteger, Float, Numeric, Date, DateTime
+from sqlalchemy.dialects.postgresql import REAL
+
+from . import uploads
+
+import fiona
+fiona.drvsupport.supported_drivers["FlatGeobuf"] = "rw"
+
+
+def fiona_type(column_type) -> str:
+    # SQLAlchemyの型をfiona（OGR）のフィールド型に対応付ける
+    if isinstance(column_type, Boolean):
+        return "bool"
+    if isinstance(column_type, Integer):
+        return "int"
+    if isinstance(column_type, Numeric):
+        return "float"
+    if isinstance(column_type, DateTime):
+        return "datetime"
+    if isinstance(column_type, Date):
+        return "date"
+    return "str"
+
+
+def fiona_schema(columns: dict, select_columns: list) -> dict:
+    return {"geometry": "Unknown", "properties": {column: fiona_type(columns[column]) for column in select_columns}}
+
+
+def _fiona_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def write_fiona(path: str, driver: str, partitions, schema: dict, layer: str = None, **creation_options) -> int:
+    # ジオメトリをWKBで受け取り、取得した行のまとまりごとにファイルへ書き出す
+    written = 0
+    with fiona.open(path, "w", driver=driver, schema=schema, crs="EPSG:4326", layer=layer, **creation_options) as dst:
+        for partition in partitions:
+            geometries = shapely.from_wkb([bytes(row["geometry"]) if row["geometry"] is not None else None for row in partition])
+            dst.writerecords(
+                fiona.Feature.from_dict({
+                    "geometry": mapping(geometry) if geometry is not None else None,
+                    "properties": {key: _fiona_value(row[key]) for key in schema["properties"]},
+                })
+                for row, geometry in zip(partition, geometries)
+            )
+            written += len(partition)
+    return written
+
+
+def arrow_type(column_type) -> pa.DataType:
+    # SQLAlchemyの型をArrowの型に対応付ける
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, SmallInteger):
+        return pa.int16()
+    if isinstance(column_type, BigInteger):
+        return pa.int64()
+    if isinstance(column_type, Integer):
+        return pa.int32()
+    if isinstance(column_type, REAL):
+        return pa.float32()
+    if isinstance(column_type, (Float, Numeric)):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp("us", tz="UTC" if column_type.timezone else None)
+    if isinstance(column_type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+def _arrow_value(value, data_type: pa.DataType):
+    if value is None:
+        return None
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if pa.types.is_string(data_type) and not isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False, default=str) if isinstance(value, (dict, list)) else str(value)
+    return value
+
+
+def write_parquet(path: str, partitions, columns: dict, select_columns: list) -> int:
+    # GeoParquet（ジオメトリはWKBのまま書き出す）。取得した行のまとまりごとに行グループとして追記する
+    fields = [pa.field(column, arrow_type(columns[column])) for column in select_columns]
+    geo_metadata = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        # crsを省略するとOGC:CRS84（経度・緯度順のWGS84）として扱われる
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}},
+    }
+    schema = pa.schema(fields + [pa.field("geometry", pa.binary())], metadata={"geo": json.dumps(geo_metadata)})
+
+    written = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for partition in partitions:
+            arrays = [
+                pa.array([_arrow_value(row[field.name], field.type) for row in partition], type=field.type)
+                for field in fields
+            ]
+            arrays.append(pa.array([bytes(row["geometry"]) if row["geometry"] is not None else None for row in partition], type=pa.binary()))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            written += len(partition)
+    return written
+
+
+def spool_path(suffix: str) -> str:
+    # 書き出し先の一時ファイル（レスポンス送信後に削除する）
+    handle, path = tempfile.mkstemp(dir=uploads.spool_dir(), suffix=suffix)
+    os.close(handle)
+    os.unlink(path)
+    return path
@@ -0,0 +1,137 @@
+import json
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from geoalchemy2 import Geography, Geometry
+
+from . import config
+from .catalog import catalog
+from .database import engine, qualified_name
+
+# 属性フィルタで使える演算子（where=列名:演算子:値）
+FILTER_OPERATORS = {
+    "eq": "=",
+    "ne": "<>",
+    "lt": "<",
+    "le": "<=",
+    "gt": ">",
+    "ge": ">=",
+    "like": "LIKE",
+    "ilike": "ILIKE",
+}
+
+
+def table_columns(schema_name: str, table_name: str) -> dict:
+    # 既存テーブルから列名と型を取得
+    columns = {column['name']: column['type'] for column in catalog.columns(schema_name, table_name)}
+    if not columns:
+        raise HTTPException(status_code=404, detail="Table not found")
+    if 'geometry' not in columns:
+        raise HTTPException(status_code=400, detail="Table has no geometry column")
+    return columns
+
+
+def attribute_columns(columns: dict, requested: Optional[str] = None) -> list:
+    # 出力する属性列（指定がなければジオメトリ以外のすべての列）
+    attributes = [name for name, column_type in columns.items() if not isinstance(column_type, (Geometry, Geography))]
+    if requested is None:
+        return attributes
+    selected = [column for column in requested.split(",") if column]
+    unknown = [column for column in selected if column not in attributes]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}")
+    return selected
+
+
+def parse_bbox(bbox: str) -> tuple:
+    try:
+        minx, miny, maxx, maxy = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be minx,miny,maxx,maxy")
+    return minx, miny, maxx, maxy
+
+
+def _geometry_filter(geometry_type, geometry_sql: str) -> str:
+    # 4326の検索範囲をgeometry列の型・SRIDに合わせ、GiSTインデックスを使うST_Intersectsで絞り込む
+    if isinstance(geometry_type, Geography):
+        return f"ST_Intersects(t.geometry, ({geometry_sql})::geography)"
+    srid = geometry_type.srid if geometry_type.srid and geometry_type.srid > 0 else 4326
+    return f"ST_Intersects(t.geometry, ST_Transform({geometry_sql}, {int(srid)}))"
+
+
+def build_query(schema_name: str, table_name: str, columns: dict, select_columns: list, geometry_select: str,
+                bbox: Optional[str] = None, intersects: Optional[str] = None, where: Optional[list] = None,
+                after_id: Optional[int] = None, limit: Optional[int] = None, skip_null_geometry: bool = False) -> tuple:
+    # 検索条件からSELECT文とバインドパラメータを組み立てる
+    preparer = engine.dialect.identifier_preparer
+    conditions = ["t.geometry IS NOT NULL"] if skip_null_geometry else []
+    params = {}
+
+    if bbox is not None:
+        params["minx"], params["miny"], params["maxx"], params["maxy"] = parse_bbox(bbox)
+        conditions.append(_geometry_filter(columns['geometry'], "ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326)"))
+
+    if intersects is not None:
+        # GeoJSONジオメトリまたはWKT（EPSG:4326）
+        params["intersects"] = intersects
+        if intersects.lstrip().startswith("{"):
+            geometry_sql = "ST_SetSRID(ST_GeomFromGeoJSON(:intersects), 4326)"
+        else:
+            geometry_sql = "ST_GeomFromText(:intersects, 4326)"
+        conditions.append(_geometry_filter(columns['geometry'], geometry_sql))
+
+    for index, condition in enumerate(where or []):
+        column, _, rest = condition.partition(":")
+        operator, _, value = rest.partition(":")
+        if column not in columns or operator not in FILTER_OPERATORS:
+            raise HTTPException(status_code=400, detail=f"Invalid filter: {condition}")
+        params[f"where_{index}"] = value
+        conditions.append(f"t.{preparer.quote(column)} {FILTER_OPERATORS[operator]} :where_{index}")
+
+    # id列によるキーセットページネーション
+    order_by = ""
+    if 'id' in columns:
+        order_by = "ORDER BY t.id"
+        if after_id is not None:
+            params["after_id"] = after_id
+            conditions.append("t.id > :after_id")
+    elif after_id is not None:
+        raise HTTPException(status_code=400, detail="after_id requires an id column")
+
+    select_list = ", ".join([f"t.{preparer.quote(column)}" for column in select_columns] + [f"{geometry_select} AS geometry"])
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit_clause = ""
+    if limit is not None:
+        params["limit"] = limit
+        limit_clause = "LIMIT :limit"
+
+    query = f"""
+        SELECT {select_list}
+        FROM {qualified_name(schema_name, table_name)} AS t
+        {where_clause}
+        {order_by}
+        {limit_clause}
+    """
+    return query, params
+
+
+def stream_rows(query: str, params: dict, batch_size: int = None):
+    # サーバーサイドカーソルで batch_size 行ずつ取得し、行のリストを順に返す
+    batch_size = batch_size or config.FEATURES_FETCH_SIZE
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(text(query), params)
+        for partition in result.mappings().partitions():
+            yield partition
+
+
+def geojsonl_lines(query: str, params: dict):
+    # 1行1フィーチャーのGeoJSON Lines（ジオメトリはPostGISが生成したGeoJSON文字列をそのまま埋め込む）
+    for partition in stream_rows(query, params):
+        lines = []
+        for row in partition:
+            properties = {key: value for key, value in row.items() if key != 'geometry'}
+            feature_id = json.dumps(properties.get('id'), default=str)
+            geometry = row['geometry'] or "null"
+            lines.append(f'{{"type":"Feature","id":{feature_id},"geometry":{geometry},"properties":{json.dumps(properties, ensure_ascii=False, default=str)}}}\n')
+        yield "".join(lines).encode("utf-8")
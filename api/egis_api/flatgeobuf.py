@@ -0,0 +1,186 @@
+import datetime
+import decimal
+import json
+import struct
+
+import numpy as np
+import shapely
+from sqlalchemy import Boolean, SmallInteger, Integer, BigInteger, Float, Numeric, Date, DateTime, JSON
+
+# 空間インデックスなしのFlatGeobufを、ファイルに書き出さずに先頭から順にバイト列として生成する
+# （GDALのドライバーはファイルへの書き込みが必要なため使わない）
+# ヘッダー・フィーチャーはFlatBuffersのテーブルで、それぞれ4バイトの長さを先頭に付けて並べる
+# ジオメトリは2次元（XY）のみ書き出す
+
+MAGIC = b"fgb\x03fgb\x00"
+
+# GeometryType
+_GEOMETRY_TYPES = {
+    "Point": 1, "LineString": 2, "Polygon": 3, "MultiPoint": 4,
+    "MultiLineString": 5, "MultiPolygon": 6, "GeometryCollection": 7,
+}
+
+# ColumnType（値の struct フォーマットがない型は、4バイトの長さとUTF-8の文字列）
+BOOL, SHORT, INT, LONG, DOUBLE, STRING, JSON_TYPE, DATETIME = 2, 3, 5, 7, 10, 11, 12, 13
+_VALUE_FORMATS = {BOOL: "<B", SHORT: "<h", INT: "<i", LONG: "<q", DOUBLE: "<d"}
+
+# FlatBuffersのテーブルに埋め込むスカラー値の struct フォーマット
+_SCALAR_FORMATS = {"u8": "<B", "u16": "<H", "i32": "<i"}
+
+
+def column_type(sql_type) -> int:
+    # SQLAlchemyの型をFlatGeobufの列の型に対応付ける（サブクラスを先に判定する）
+    if isinstance(sql_type, Boolean):
+        return BOOL
+    if isinstance(sql_type, SmallInteger):
+        return SHORT
+    if isinstance(sql_type, BigInteger):
+        return LONG
+    if isinstance(sql_type, Integer):
+        return INT
+    # real も Double にする（GDALは読めるが、Float の列を読み飛ばすクライアントがある）
+    if isinstance(sql_type, (Float, Numeric)):
+        return DOUBLE
+    if isinstance(sql_type, (Date, DateTime)):
+        return DATETIME
+    if isinstance(sql_type, JSON):
+        return JSON_TYPE
+    return STRING
+
+
+def _align(buffer: bytearray, alignment: int, extra: int = 0):
+    # len(buffer) + extra が alignment の倍数になるように0を詰める
+    buffer += bytes(-(len(buffer) + extra) % alignment)
+
+
+def _write_child(buffer: bytearray, kind: str, value) -> int:
+    # 文字列・ベクター・テーブルを末尾に書き込み、その位置を返す
+    if kind == "table":
+        return _write_table(buffer, value)
+    _align(buffer, 8 if kind == "f64s" else 4, extra=4 if kind == "f64s" else 0)
+    position = len(buffer)
+    if kind == "str":
+        data = value.encode("utf-8")
+        buffer += struct.pack("<I", len(data)) + data + b"\x00"
+    elif kind == "bytes":
+        buffer += struct.pack("<I", len(value)) + value
+    elif kind == "u32s":
+        buffer += struct.pack("<I", len(value)) + np.asarray(value, dtype="<u4").tobytes()
+    elif kind == "f64s":
+        buffer += struct.pack("<I", len(value)) + np.ascontiguousarray(value, dtype="<f8").tobytes()
+    elif kind == "tables":
+        buffer += struct.pack("<I", len(value)) + bytes(4 * len(value))
+        for index, fields in enumerate(value):
+            table = _write_table(buffer, fields)
+            element = position + 4 + 4 * index
+            struct.pack_into("<I", buffer, element, table - element)
+    return position
+
+
+def _write_table(buffer: bytearray, fields: list) -> int:
+    # fields: (フィールド番号, 種類, 値) の一覧
+    # vtable・テーブル本体・参照先（文字列・ベクター・テーブル）の順に、前から書き込む
+    slots = max(slot for slot, kind, value in fields) + 1
+    _align(buffer, 2)
+    vtable = len(buffer)
+    buffer += bytes(4 + 2 * slots)
+    _align(buffer, 4)
+    table = len(buffer)
+    buffer += struct.pack("<i", table - vtable)
+
+    offsets, references = {}, []
+    for slot, kind, value in fields:
+        fmt = _SCALAR_FORMATS.get(kind, "<I")
+        _align(buffer, struct.calcsize(fmt))
+        offsets[slot] = len(buffer) - table
+        if kind in _SCALAR_FORMATS:
+            buffer += struct.pack(fmt, value)
+        else:
+            references.append((len(buffer), kind, value))
+            buffer += bytes(4)
+
+    struct.pack_into("<HH", buffer, vtable, 4 + 2 * slots, len(buffer) - table)
+    for slot, offset in offsets.items():
+        struct.pack_into("<H", buffer, vtable + 4 + 2 * slot, offset)
+    # 参照はフィールドの位置からの前方への相対位置
+    for position, kind, value in references:
+        struct.pack_into("<I", buffer, position, _write_child(buffer, kind, value) - position)
+    return table
+
+
+def _finish(fields: list) -> bytes:
+    # 先頭にルートテーブルへの相対位置を置き、全体の長さを付けて返す
+    buffer = bytearray(4)
+    struct.pack_into("<I", buffer, 0, _write_table(buffer, fields))
+    return struct.pack("<I", len(buffer)) + bytes(buffer)
+
+
+def header(name: str, columns: list) -> bytes:
+    # columns: (列名, ColumnType) の一覧。ジオメトリの種類は混在を許す Unknown、フィーチャー数は不明（0）とする
+    return MAGIC + _finish([
+        (0, "str", name),
+        (7, "tables", [[(0, "str", column), (1, "u8", kind)] for column, kind in columns]),
+        # 空間インデックスなし（index_node_size の既定値は16のため明示する）
+        (9, "u16", 0),
+        (10, "table", [(0, "str", "EPSG"), (1, "i32", 4326)]),
+    ])
+
+
+def _geometry(geometry) -> list:
+    geometry_type = geometry.geom_type
+    fields = [(6, "u8", _GEOMETRY_TYPES[geometry_type])]
+    if geometry_type in ("MultiPolygon", "GeometryCollection"):
+        fields.append((7, "tables", [_geometry(part) for part in geometry.geoms]))
+        return fields
+    if geometry_type == "Polygon":
+        rings = [geometry.exterior, *geometry.interiors]
+    elif geometry_type == "MultiLineString":
+        rings = list(geometry.geoms)
+    else:
+        rings = [geometry]
+    coordinates = [shapely.get_coordinates(ring) for ring in rings]
+    if coordinates:
+        fields.append((1, "f64s", np.concatenate(coordinates).ravel()))
+    if len(coordinates) > 1:
+        # 各リング・ラインの終わりの頂点の位置
+        fields.append((0, "u32s", np.cumsum([len(part) for part in coordinates])))
+    return fields
+
+
+def _value(kind: int, value) -> bytes:
+    fmt = _VALUE_FORMATS.get(kind)
+    if fmt is not None:
+        return struct.pack(fmt, float(value) if isinstance(value, decimal.Decimal) else value)
+    if kind == JSON_TYPE:
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    elif not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False, default=str) if isinstance(value, (dict, list)) else str(value)
+    data = value.encode("utf-8")
+    return struct.pack("<I", len(data)) + data
+
+
+def feature(geometry, properties: list) -> bytes:
+    # properties: (列の番号, ColumnType, 値) の一覧（値が None の列は書き込まない）
+    # 空のジオメトリは座標を持てないため、ジオメトリなしとして書き込む
+    fields = []
+    if geometry is not None and not geometry.is_empty:
+        fields.append((0, "table", _geometry(geometry)))
+    data = b"".join(struct.pack("<H", index) + _value(kind, value) for index, kind, value in properties if value is not None)
+    if data:
+        fields.append((1, "bytes", data))
+    return _finish(fields or [(1, "bytes", b"")])
+
+
+def stream(partitions, name: str, columns: list):
+    # partitions: ジオメトリ（WKB）と columns の列を持つ行のまとまり
+    # columns: (列名, SQLAlchemyの型) の一覧
+    kinds = [(column, column_type(sql_type)) for column, sql_type in columns]
+    yield header(name, kinds)
+    for partition in partitions:
+        geometries = shapely.from_wkb([bytes(row["geometry"]) if row["geometry"] is not None else None for row in partition])
+        yield b"".join(
+            feature(geometry, [(index, kind, row[column]) for index, (column, kind) in enumerate(kinds)])
+            for row, geometry in zip(partition, geometries)
+        )
@@ -0,0 +1,194 @@
+import json
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from fastapi import HTTPException
+from pyproj import CRS
+from sqlalchemy import Column
+
+from . import config, importers, ingest, jobs, metrics, planar, pyramid, schema_inference
+
+# GeoParquetのファイルを行グループ単位で読み込み、Arrowの型から列の型を決めて投入する
+# ジオメトリはWKBのままCOPYに渡すため、EPSG:4326（OGC:CRS84）のデータではフィーチャーごとのShapelyオブジェクトを作らない
+
+_WGS84 = CRS.from_epsg(importers.SRID)
+
+
+def _kind(arrow_type: pa.DataType) -> str:
+    # Arrowの型 -> schema_inference の型名
+    if pa.types.is_dictionary(arrow_type):
+        return _kind(arrow_type.value_type)
+    if pa.types.is_boolean(arrow_type):
+        return "boolean"
+    if pa.types.is_int8(arrow_type) or pa.types.is_int16(arrow_type) or pa.types.is_uint8(arrow_type):
+        return "smallint"
+    if pa.types.is_int32(arrow_type) or pa.types.is_uint16(arrow_type):
+        return "integer"
+    if pa.types.is_int64(arrow_type) or pa.types.is_uint32(arrow_type):
+        return "bigint"
+    if pa.types.is_floating(arrow_type) and arrow_type.bit_width <= 32:
+        return "real"
+    if pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return "double"
+    if pa.types.is_date(arrow_type):
+        return "date"
+    if pa.types.is_timestamp(arrow_type):
+        return "timestamptz" if arrow_type.tz is not None else "timestamp"
+    if pa.types.is_nested(arrow_type):
+        return "jsonb"
+    # uint64（bigint に収まらない値がある）・文字列・その他の型は文字列にする
+    return "text"
+
+
+def _metadata(parquet_file: pq.ParquetFile) -> dict:
+    # GeoParquetのメタデータ（"geo" キーのJSON）を読む
+    metadata = parquet_file.schema_arrow.metadata or {}
+    if b"geo" not in metadata:
+        raise HTTPException(status_code=400, detail="Not a GeoParquet file (no 'geo' metadata)")
+    geo = json.loads(metadata[b"geo"])
+    primary = geo.get("primary_column")
+    column = geo.get("columns", {}).get(primary)
+    if column is None:
+        raise HTTPException(status_code=400, detail="GeoParquet primary geometry column not found")
+    if column.get("encoding", "WKB").upper() != "WKB":
+        raise HTTPException(status_code=400, detail=f"Unsupported GeoParquet geometry encoding: {column['encoding']}")
+    return geo
+
+
+def _crs(column: dict):
+    # crs が省略された場合は OGC:CRS84、null の場合は不明（どちらもEPSG:4326として扱う）
+    crs = column.get("crs")
+    if crs is None:
+        return None
+    crs = CRS.from_json_dict(crs) if isinstance(crs, dict) else CRS.from_user_input(crs)
+    return None if crs.equals(_WGS84, ignore_axis_order=True) else crs
+
+
+def _skipped_columns(geo: dict) -> set:
+    # 主ジオメトリ以外のジオメトリ列と、bboxのcovering列は取り込まない
+    skipped = {name for name in geo["columns"] if name != geo["primary_column"]}
+    for column in geo["columns"].values():
+        covering = column.get("covering", {}).get("bbox", {})
+        skipped.update(path[0] for path in covering.values() if path)
+    return skipped
+
+
+def _attribute_fields(parquet_file: pq.ParquetFile, geo: dict) -> list:
+    skipped = _skipped_columns(geo) | {geo["primary_column"], "geometry"}
+    return [field for field in parquet_file.schema_arrow if field.name not in skipped]
+
+
+def _column_names(fields: list) -> dict:
+    # 列名 -> テーブルの列名（テーブルが持つ id・生成列と同じ名前の列は source_<列名> にする）
+    reserved = {"id", planar.PLANAR_COLUMN}
+    used = {field.name for field in fields}
+    names = {}
+    for field in fields:
+        name = field.name
+        if name in reserved:
+            while name in reserved or name in used:
+                name = f"source_{name}"
+            used.add(name)
+        names[field.name] = name
+    return names
+
+
+def _columns(fields: list) -> list:
+    names = _column_names(fields)
+    return importers.geometry_columns() + [Column(names[field.name], schema_inference.column_type(_kind(field.type))) for field in fields]
+
+
+# 欠損値を含む整数列・真偽値列が float64・object にならないように、pandasの欠損値対応の型に変換する
+_PANDAS_TYPES = {
+    pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype(),
+    pa.uint8(): pd.UInt8Dtype(), pa.uint16(): pd.UInt16Dtype(), pa.uint32(): pd.UInt32Dtype(), pa.bool_(): pd.BooleanDtype(),
+}
+
+
+def _to_frame(batch: pa.RecordBatch, fields: list, geometry_column: str, crs) -> pd.DataFrame:
+    columns = {}
+    names = _column_names(fields)
+    for field in fields:
+        array = batch.column(field.name)
+        name = names[field.name]
+        if pa.types.is_nested(field.type):
+            # list・struct・map はJSONとして書き込めるように Python の list・dict にする
+            columns[name] = pd.Series(array.to_pylist(), dtype=object)
+        elif pa.types.is_uint64(field.type):
+            columns[name] = pd.Series([None if value is None else str(value) for value in array.to_pylist()], dtype=object)
+        else:
+            columns[name] = array.to_pandas(types_mapper=_PANDAS_TYPES.get)
+    frame = pd.DataFrame(columns, index=pd.RangeIndex(batch.num_rows))
+
+    # WKBのバイト列をそのまま使う（EPSG:4326以外の場合のみ、ジオメトリを作って投影変換する）
+    wkb = batch.column(geometry_column).to_numpy(zero_copy_only=False)
+    if crs is not None:
+        with metrics.step("reproject"):
+            geometries = gpd.GeoSeries(shapely.from_wkb(wkb), crs=crs).to_crs(epsg=importers.SRID)
+            wkb = shapely.to_wkb(geometries.to_numpy())
+    frame["geometry"] = pd.Series(np.asarray(wkb, dtype=object), index=frame.index)
+    return frame
+
+
+def read_batches(path: str, batch_size: int = None):
+    # 行グループを1つずつ読み込み、batch_size 行ずつのDataFrameにする（メモリ使用量は行グループの大きさで上限が決まる）
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    parquet_file = pq.ParquetFile(path)
+    geo = _metadata(parquet_file)
+    geometry_column = geo["primary_column"]
+    crs = _crs(geo["columns"][geometry_column])
+    fields = _attribute_fields(parquet_file, geo)
+    jobs.report(rows_total=parquet_file.metadata.num_rows)
+
+    read_columns = [field.name for field in fields] + [geometry_column]
+    yielded = False
+    for index in range(parquet_file.num_row_groups):
+        jobs.check_cancelled()
+        with metrics.step("read"):
+            row_group = parquet_file.read_row_group(index, columns=read_columns)
+        for batch in row_group.to_batches(max_chunksize=batch_size):
+            yielded = True
+            yield _to_frame(batch, fields, geometry_column, crs)
+        del row_group
+    # 行が0件の場合も列定義のために空のバッチを返す
+    if not yielded:
+        empty = pa.RecordBatch.from_pylist([], schema=pa.schema([parquet_file.schema_arrow.field(name) for name in read_columns]))
+        yield _to_frame(empty, fields, geometry_column, crs)
+
+
+def describe(path: str) -> dict:
+    # インポート前のプレビュー用に、Arrowの型から決めた列の型を返す
+    parquet_file = pq.ParquetFile(path)
+    geo = _metadata(parquet_file)
+    fields = _attribute_fields(parquet_file, geo)
+    names = _column_names(fields)
+    columns = [{"name": "id", "type": "integer"}, {"name": "geometry", "type": "geography"}]
+    columns += [
+        {"name": names[field.name], "source_name": field.name, "type": _kind(field.type), "arrow_type": str(field.type)} for field in fields
+    ]
+    return {
+        "rows": parquet_file.metadata.num_rows,
+        "row_groups": parquet_file.num_row_groups,
+        "columns": columns,
+        "skipped_columns": sorted(_skipped_columns(geo)),
+    }
+
+
+@metrics.operation("import_geoparquet")
+def import_geoparquet(path: str, schema_name: str, table_name: str, copy_format: str = "binary", storage: str = "geography", generalize: bool = False,
+                      mode: str = "create", key: str = None) -> dict:
+    # 列の型はサンプルから推定せず、ファイルのArrowスキーマから決める
+    started = time.perf_counter()
+    parquet_file = pq.ParquetFile(path)
+    fields = _attribute_fields(parquet_file, _metadata(parquet_file))
+    batches = read_batches(path)
+    result = importers.write_batches(schema_name, table_name, batches, lambda sampled: _columns(fields), copy_format, storage=storage, mode=mode, key=key)
+    stats = {**result, **ingest.throughput(result["rows"], started)}
+    if generalize and (mode == "create" or not pyramid.levels(schema_name, table_name)):
+        stats.update(pyramid.build(schema_name, table_name))
+    return stats
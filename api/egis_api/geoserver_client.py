@@ -0,0 +1,72 @@
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+
+from . import config, metrics
+
+# 冪等なメソッドのみ、タイムアウトや一時的なエラーでも再試行する（POSTは接続できなかった場合のみ）
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def client() -> httpx.AsyncClient:
+    # アプリケーション全体で共有するクライアント（接続はkeep-aliveで使い回す）
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=config.GEOSERVER_URL,
+            auth=(config.GEOSERVER_USER_NAME, config.GEOSERVER_USER_PASS),
+            timeout=config.GEOSERVER_TIMEOUT,
+            limits=httpx.Limits(max_connections=config.GEOSERVER_MAX_CONNECTIONS, max_keepalive_connections=config.GEOSERVER_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def request(method: str, path: str, **kwargs) -> httpx.Response:
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    for attempt in range(config.GEOSERVER_RETRIES + 1):
+        last_attempt = attempt == config.GEOSERVER_RETRIES
+        started = time.perf_counter()
+        try:
+            response = await client().request(method, path, **kwargs)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+            metrics.GEOSERVER_REQUEST_DURATION.labels(method, "error").observe(time.perf_counter() - started)
+            if last_attempt:
+                raise
+        except httpx.TransportError:
+            metrics.GEOSERVER_REQUEST_DURATION.labels(method, "error").observe(time.perf_counter() - started)
+            if last_attempt or not idempotent:
+                raise
+        else:
+            metrics.GEOSERVER_REQUEST_DURATION.labels(method, str(response.status_code)).observe(time.perf_counter() - started)
+            if last_attempt or not idempotent or response.status_code not in RETRY_STATUS_CODES:
+                return response
+        await asyncio.sleep(config.GEOSERVER_RETRY_BACKOFF * 2 ** attempt)
+
+
+def limiter() -> asyncio.Semaphore:
+    return asyncio.Semaphore(config.GEOSERVER_BATCH_CONCURRENCY)
+
+
+async def gather_limited(coroutines, semaphore: Optional[asyncio.Semaphore] = None) -> list:
+    # 同時実行数を GEOSERVER_BATCH_CONCURRENCY に抑えて実行する
+    # 複数の一覧をまとめて処理する場合は、同じ semaphore を渡して全体の同時実行数を抑える
+    # （semaphore を取得したまま、同じ semaphore で gather_limited を呼び出さないこと）
+    semaphore = semaphore or limiter()
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
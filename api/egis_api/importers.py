@@ -0,0 +1,192 @@
+import itertools
+import os
+import tempfile
+import time
+import zipfile
+
+import pandas as pd
+import geopandas as gpd
+from fastapi import HTTPException
+from sqlalchemy import Table, MetaData, Column, Integer
+from geoalchemy2 import Geography
+
+from . import changes, config, ingest, jobs, maintenance, merge, metrics, planar, pyramid, schema_inference, uploads
+from .catalog import catalog
+from .database import engine
+
+import fiona
+fiona.drvsupport.supported_drivers["FlatGeobuf"] = "rw"
+
+SRID = 4326  # WGS84
+
+GEOJSON_EXTENSIONS = (".geojson", ".json")
+
+
+def to_wgs84(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    # GeoDataFrameにCRSが設定されていない場合、デフォルトでEPSG:4326を設定
+    if gdf.crs is None:
+        return gdf.set_crs(epsg=SRID)
+    # 元のデータの座標系がEPSG:4326以外の場合、EPSG:4326に投影変換する
+    return gdf.to_crs(epsg=SRID)
+
+
+def _reproject(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    with metrics.step("reproject"):
+        return to_wgs84(gdf)
+
+
+def read_vector_batches(path: str, batch_size: int = None, layer: str = None):
+    # fionaでフィーチャーを順に読み、batch_size件ずつGeoDataFrameにして返す
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    # GeoJSONの配列のプロパティは既定では読み込まれずに列ごと落ちるため、JSON列として読み込ませる（値はlistに戻される）
+    options = {"ARRAY_AS_STRING": "YES"} if path.lower().endswith(GEOJSON_EXTENSIONS) else {}
+    with fiona.open(path, layer=layer, **options) as src:
+        # 件数を安価に取得できるドライバーの場合は進捗表示用に総件数を記録する
+        if src.driver in ("ESRI Shapefile", "FlatGeobuf", "GPKG"):
+            jobs.report(rows_total=len(src))
+        crs = src.crs_wkt or None
+        columns = list(src.schema["properties"]) + ["geometry"]
+        features = []
+        yielded = False
+        for feature in src:
+            features.append(feature)
+            if len(features) >= batch_size:
+                yield gpd.GeoDataFrame.from_features(features, crs=crs, columns=columns)
+                features = []
+                yielded = True
+        # フィーチャーが0件の場合も列定義のために空のバッチを返す
+        if features or not yielded:
+            yield gpd.GeoDataFrame.from_features(features, crs=crs, columns=columns)
+
+
+def read_csv_batches(path: str, batch_size: int = None):
+    return pd.read_csv(path, chunksize=batch_size or config.IMPORT_BATCH_SIZE)
+
+
+def geometry_columns() -> list:
+    return [Column('id', Integer, primary_key=True),
+            Column('geometry', Geography('GEOMETRY', srid=SRID))]
+
+
+def vector_columns(sampled: list) -> list:
+    # 先頭のバッチから属性列の型を推定し、id・geometry列と合わせて新しいテーブルの列を定義する
+    return geometry_columns() + schema_inference.infer_columns(sampled)
+
+
+def csv_columns(sampled: list) -> list:
+    return schema_inference.infer_columns(sampled)
+
+
+def load_batches(schema_name: str, table_name: str, batches, build_columns, copy_format: str = "csv", spatial_index: bool = True, storage: str = "geography") -> int:
+    # バッチを1つずつCOPYで書き込んでから次のバッチを読むため、メモリ使用量はバッチサイズ（型の推定中はサンプル数分）で上限が決まる
+    # テーブル作成から投入・インデックス作成までを1トランザクションで行う
+    # 各バッチはヒルベルト曲線の順に並べてから書き込み、近い地物が近いページに入るようにする
+    planar.check_storage(storage)
+    rows = 0
+    extent = None
+    batches = iter(batches)
+    with engine.connect() as connection, jobs.tracked_connection(connection):
+        jobs.report(phase="load")
+        # 先頭のバッチから列の型を推定してテーブルを作成する
+        sampled = schema_inference.sample(batches)
+        table = Table(table_name, MetaData(), *build_columns(sampled), schema=schema_name)
+        table.create(connection)
+        for batch in itertools.chain(sampled, batches):
+            jobs.check_cancelled()
+            # storage=both の場合は、範囲がUTMゾーンに収まらなくなった時点で投入を打ち切る
+            if storage == "both":
+                extent = planar.extend_extent(extent, batch)
+            # 推定した型に収まらない値があれば列の型を広げる
+            schema_inference.widen_table(connection, table, batch)
+            with metrics.step("sort"):
+                batch = maintenance.hilbert_order(batch)
+            with metrics.step("copy"):
+                batch_rows = ingest.copy_dataframe(connection, table, batch, copy_format)
+            rows += batch_rows
+            jobs.add_rows(batch_rows)
+
+        # storage=both の場合はデータ範囲に合ったUTMゾーンのgeometry列を追加する（テーブルを書き換えるためインデックス作成より前に行う）
+        if storage == "both":
+            jobs.report(phase="planar")
+            planar.add_planar_column(connection, schema_name, table_name)
+
+        # 並べ替え・空間インデックスの作成・統計情報の更新
+        maintenance.finalize(connection, schema_name, table_name, spatial_index=spatial_index)
+        connection.commit()
+    changes.table_changed(schema_name, table_name)
+    return rows
+
+
+def write_batches(schema_name: str, table_name: str, batches, build_columns, copy_format: str = "csv", spatial_index: bool = True,
+                  storage: str = "geography", mode: str = "create", key: str = None) -> dict:
+    # mode=append / upsert で対象のテーブルが既にあれば作業用テーブル経由で追加・更新し、なければ新しく作成する
+    merge.check_mode(mode, key)
+    if mode != "create" and catalog.has_table(schema_name, table_name):
+        return merge.merge_batches(schema_name, table_name, batches, copy_format, mode, key)
+    rows = load_batches(schema_name, table_name, batches, build_columns, copy_format, spatial_index=spatial_index, storage=storage)
+    return {"rows": rows, "inserted": rows}
+
+
+def _stats(result: dict, started: float) -> dict:
+    return {**result, **ingest.throughput(result["rows"], started)}
+
+
+@metrics.operation("import_csv")
+def import_csv(path: str, schema_name: str, table_name: str, copy_format: str = "csv", mode: str = "create", key: str = None) -> dict:
+    started = time.perf_counter()
+    result = write_batches(schema_name, table_name, metrics.timed_iter(read_csv_batches(path), "read"), csv_columns, copy_format, spatial_index=False, mode=mode, key=key)
+    return _stats(result, started)
+
+
+@metrics.operation("import_vector")
+def import_vector(path: str, schema_name: str, table_name: str, copy_format: str = "csv", storage: str = "geography", layer: str = None, generalize: bool = False,
+                  mode: str = "create", key: str = None) -> dict:
+    # バッチごとに投影変換してから書き込む
+    # generalize=True の場合は低ズーム描画用の簡略化テーブルも作成する
+    started = time.perf_counter()
+    batches = (_reproject(batch) for batch in metrics.timed_iter(read_vector_batches(path, layer=layer), "read"))
+    stats = _stats(write_batches(schema_name, table_name, batches, vector_columns, copy_format, storage=storage, mode=mode, key=key), started)
+    # 追加・更新で既存の簡略化テーブルがある場合は merge で作り直し済み
+    if generalize and (mode == "create" or not pyramid.levels(schema_name, table_name)):
+        stats.update(pyramid.build(schema_name, table_name))
+    return stats
+
+
+def find_shapefile(directory: str) -> str:
+    # Recursively find the .shp file in the extracted files
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if filename.endswith('.shp'):
+                return os.path.join(root, filename)
+    raise HTTPException(status_code=400, detail="No .shp file found in the zip")
+
+
+@metrics.operation("import_shapefile")
+def import_shapefile_zip(zip_path: str, schema_name: str, table_name: str, copy_format: str = "csv", storage: str = "geography", generalize: bool = False,
+                         mode: str = "create", key: str = None) -> dict:
+    # Unzip the shapefile
+    with tempfile.TemporaryDirectory(dir=uploads.spool_dir()) as tmpdirname:
+        jobs.report(phase="extract")
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            zip_ref.extractall(tmpdirname)
+        shapefile_path = find_shapefile(tmpdirname)
+        return import_vector(shapefile_path, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
+
+
+def preview_schema(path: str, file_format: str) -> dict:
+    # 投入せずに、先頭のバッチから推定した列の型を返す
+    if file_format == "csv":
+        sampled = schema_inference.sample(read_csv_batches(path))
+        columns = []
+    elif file_format == "shapefile":
+        with tempfile.TemporaryDirectory(dir=uploads.spool_dir()) as tmpdirname:
+            with zipfile.ZipFile(path) as zip_ref:
+                zip_ref.extractall(tmpdirname)
+            return preview_schema(find_shapefile(tmpdirname), "vector")
+    else:
+        sampled = schema_inference.sample(read_vector_batches(path))
+        columns = [{"name": "id", "type": "integer", "nulls": 0}, {"name": "geometry", "type": "geography", "nulls": sum(int(batch.geometry.isna().sum()) for batch in sampled)}]
+    return {
+        "sampled_rows": sum(len(batch) for batch in sampled),
+        "columns": columns + schema_inference.describe(sampled),
+    }
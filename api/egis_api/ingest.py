@@ -0,0 +1,236 @@
+import datetime
+import json
+import struct
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+from fastapi import HTTPException
+from geoalchemy2 import Geometry, Geography
+from sqlalchemy import Table, SmallInteger, Integer, BigInteger, Float, Boolean, String, Date, DateTime
+from sqlalchemy.dialects.postgresql import JSON, JSONB, REAL, DOUBLE_PRECISION
+from sqlalchemy.sql.sqltypes import NullType
+
+from . import metrics
+
+# COPYで対応するフォーマット
+COPY_FORMATS = ("csv", "binary")
+
+# 1回のエンコードで処理する行数（COPYストリームへの書き出し単位）
+COPY_CHUNK_ROWS = 10000
+
+# COPYストリームの読み出しバッファサイズ
+COPY_BUFFER_SIZE = 1024 * 1024
+
+_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_BINARY_TRAILER = struct.pack("!h", -1)
+_NULL_FIELD = struct.pack("!i", -1)
+_PG_EPOCH_DATE = datetime.date(2000, 1, 1)
+_PG_EPOCH = pd.Timestamp("2000-01-01")
+
+
+class _ChunkStream:
+    # psycopg2のcopy_expertが呼ぶread()に、エンコード済みのチャンクを順に渡すためのファイルライクオブジェクト
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def is_geometry_column(column) -> bool:
+    return isinstance(column.type, (Geometry, Geography))
+
+
+def encode_geometries(values, srid: int, hex: bool = False) -> np.ndarray:
+    # ジオメトリ列を1回のベクトル演算でEWKBに変換する（WKBのbytesが渡された場合はそのまま使う）
+    geoms = np.asarray(values, dtype=object)
+    first = next((geom for geom in geoms if geom is not None), None)
+    if isinstance(first, (bytes, bytearray)):
+        if hex:
+            return np.array([geom.hex() if geom is not None else None for geom in geoms], dtype=object)
+        return geoms
+    geoms = shapely.set_srid(geoms, srid) if srid else geoms
+    return shapely.to_wkb(geoms, hex=hex, include_srid=bool(srid))
+
+
+def _fixed_width_encoder(fmt: str, convert):
+    packer = struct.Struct("!i" + fmt)
+    size = packer.size - 4
+
+    def encode(values, nulls):
+        return [_NULL_FIELD if null else packer.pack(size, convert(value)) for value, null in zip(values, nulls)]
+
+    return encode
+
+
+def _variable_width_encoder(convert):
+    def encode(values, nulls):
+        fields = []
+        for value, null in zip(values, nulls):
+            if null:
+                fields.append(_NULL_FIELD)
+            else:
+                data = convert(value)
+                fields.append(struct.pack("!i", len(data)) + data)
+        return fields
+
+    return encode
+
+
+def _to_text(value) -> bytes:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False).encode("utf-8")
+    return str(value).encode("utf-8")
+
+
+def _to_jsonb(value) -> bytes:
+    # JSONBのバイナリ表現は先頭1バイトのバージョン番号とJSONテキスト
+    if isinstance(value, str):
+        return b"\x01" + value.encode("utf-8")
+    return b"\x01" + json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def _to_pg_date(value) -> int:
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return (value - _PG_EPOCH_DATE).days
+
+
+def _to_pg_timestamp(value) -> int:
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return (timestamp - _PG_EPOCH) // pd.Timedelta(microseconds=1)
+
+
+def _binary_encoder(column):
+    column_type = column.type
+    if is_geometry_column(column):
+        return _variable_width_encoder(bytes)
+    if isinstance(column_type, SmallInteger):
+        return _fixed_width_encoder("h", int)
+    if isinstance(column_type, BigInteger):
+        return _fixed_width_encoder("q", int)
+    if isinstance(column_type, Integer):
+        return _fixed_width_encoder("i", int)
+    if isinstance(column_type, REAL):
+        return _fixed_width_encoder("f", float)
+    if isinstance(column_type, (Float, DOUBLE_PRECISION)):
+        return _fixed_width_encoder("d", float)
+    if isinstance(column_type, Boolean):
+        return _fixed_width_encoder("?", bool)
+    if isinstance(column_type, DateTime):
+        return _fixed_width_encoder("q", _to_pg_timestamp)
+    if isinstance(column_type, Date):
+        return _fixed_width_encoder("i", _to_pg_date)
+    if isinstance(column_type, (JSONB, JSON)):
+        return _variable_width_encoder(_to_jsonb)
+    if isinstance(column_type, (String, NullType)):
+        return _variable_width_encoder(_to_text)
+    raise HTTPException(status_code=400, detail=f"Binary COPY does not support column type {column_type} ({column.name}); use copy_format=csv")
+
+
+def _csv_fields(values: pd.Series) -> np.ndarray:
+    # 欠損値は引用符なしの空欄（= COPYのNULL）、文字列の列の値は常に引用符で囲んで書き出す
+    # （DataFrame.to_csv は空文字列も引用符なしの空欄にするため、COPYで欠損値と区別できない）
+    fields = values.astype(str)
+    if values.dtype == object:
+        fields = '"' + fields.str.replace('"', '""', regex=False) + '"'
+    return fields.mask(values.isna(), "").to_numpy(dtype=object)
+
+
+def _csv_chunks(frame: pd.DataFrame):
+    for start in range(0, len(frame), COPY_CHUNK_ROWS):
+        chunk = frame.iloc[start:start + COPY_CHUNK_ROWS]
+        columns = [_csv_fields(chunk[name]) for name in chunk.columns]
+        lines = columns[0]
+        for fields in columns[1:]:
+            lines = lines + "," + fields
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _binary_chunks(frame: pd.DataFrame, columns: list):
+    encoders = [_binary_encoder(column) for column in columns]
+    row_header = struct.pack("!h", len(columns))
+    yield _BINARY_HEADER
+    for start in range(0, len(frame), COPY_CHUNK_ROWS):
+        chunk = frame.iloc[start:start + COPY_CHUNK_ROWS]
+        fields = [
+            encode(chunk[column.name].to_numpy(dtype=object), chunk[column.name].isna().to_numpy())
+            for column, encode in zip(columns, encoders)
+        ]
+        yield b"".join(row_header + b"".join(row) for row in zip(*fields))
+    yield _BINARY_TRAILER
+
+
+def _prepare_frame(df: pd.DataFrame, columns: list, copy_format: str) -> pd.DataFrame:
+    frame = pd.DataFrame(index=df.index)
+    for column in columns:
+        values = df[column.name]
+        if is_geometry_column(column):
+            values = pd.Series(encode_geometries(values, column.type.srid, hex=copy_format == "csv"), index=df.index, dtype=object)
+        elif isinstance(column.type, Integer) and pd.api.types.is_float_dtype(values.dtype):
+            # 欠損値を含む整数列は float64 になっているため、"1.0" と書き出さないよう整数に戻す
+            values = values.astype("Int64")
+        elif isinstance(column.type, (Date, DateTime)) and not pd.api.types.is_datetime64_any_dtype(values.dtype):
+            # ISO 8601の文字列から推定した日付・日時の列
+            values = pd.to_datetime(values, format="ISO8601", utc=bool(column.type.timezone) if isinstance(column.type, DateTime) else False)
+        elif copy_format == "csv" and values.dtype == object:
+            # dictやlistはCSVに書き出す前にJSON文字列にしておく
+            values = values.map(lambda value: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value)
+        frame[column.name] = values
+    return frame
+
+
+def copy_dataframe(connection, table: Table, df: pd.DataFrame, copy_format: str = "csv") -> int:
+    # DataFrameをCOPY ... FROM STDINで一括投入し、投入した行数を返す
+    if copy_format not in COPY_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported copy format: {copy_format}")
+
+    # DataFrameに存在する列だけを対象にする（id等のシリアル列はデフォルト値に任せる）
+    columns = [column for column in table.columns if column.name in df.columns]
+    if df.empty or not columns:
+        return 0
+
+    frame = _prepare_frame(df, columns, copy_format)
+    if copy_format == "csv":
+        chunks = _csv_chunks(frame)
+    else:
+        chunks = _binary_chunks(frame, columns)
+
+    preparer = connection.dialect.identifier_preparer
+    column_list = ", ".join(preparer.quote(column.name) for column in columns)
+    copy_sql = f"COPY {preparer.format_table(table)} ({column_list}) FROM STDIN WITH (FORMAT {copy_format})"
+
+    # COPYはDBAPIのカーソルで直接実行するため、SQLAlchemy側のトランザクションを明示的に開始しておく
+    if not connection.in_transaction():
+        connection.begin()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(copy_sql, _ChunkStream(chunks), size=COPY_BUFFER_SIZE)
+    finally:
+        cursor.close()
+    return len(frame)
+
+
+def throughput(rows: int, started: float) -> dict:
+    # インポート結果のスループットをレスポンス用にまとめる
+    elapsed = time.perf_counter() - started
+    metrics.record_import(rows, elapsed)
+    return {
+        "rows": rows,
+        "elapsed_seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 1) if elapsed > 0 else None,
+    }
@@ -0,0 +1,231 @@
+import contextvars
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from . import config, metrics
+from .database import engine
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+_executor = ThreadPoolExecutor(max_workers=config.JOB_WORKERS, thread_name_prefix="egis-job")
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+_current = contextvars.ContextVar("egis_current_job", default=None)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat() if timestamp else None
+
+
+class Job:
+    def __init__(self, kind: str, params: dict):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.state = QUEUED
+        self.progress = {"phase": None, "rows_done": 0, "rows_total": None}
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self._lock = threading.Lock()
+        self._cancel_requested = threading.Event()
+        self._backend_pids = set()
+        self._processes = set()
+        self._cleanup = None
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel_requested.is_set()
+
+    def update(self, **progress):
+        with self._lock:
+            self.progress.update({key: value for key, value in progress.items() if value is not None})
+
+    def add_rows(self, rows: int):
+        with self._lock:
+            self.progress["rows_done"] += rows
+
+    def check_cancelled(self):
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def cancel(self):
+        # キュー待ちのジョブはそのまま取り消し、実行中のジョブはDBのクエリと外部プロセスを中断させる
+        self._cancel_requested.set()
+        if self.future is not None and self.future.cancel():
+            self._finish(CANCELLED)
+            if self._cleanup is not None:
+                self._cleanup()
+            return
+        with self._lock:
+            backend_pids = list(self._backend_pids)
+            processes = list(self._processes)
+        if backend_pids:
+            with engine.connect() as connection:
+                for pid in backend_pids:
+                    connection.execute(text("SELECT pg_cancel_backend(:pid)"), {"pid": pid})
+        for process in processes:
+            process.terminate()
+
+    def _start(self):
+        with self._lock:
+            self.state = RUNNING
+            self.started_at = time.time()
+
+    def _finish(self, state: str, result=None, error=None):
+        with self._lock:
+            self.state = state
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "params": self.params,
+                "state": self.state,
+                "progress": dict(self.progress),
+                "result": self.result,
+                "error": self.error,
+                "submitted_at": _isoformat(self.submitted_at),
+                "started_at": _isoformat(self.started_at),
+                "finished_at": _isoformat(self.finished_at),
+                "queued_seconds": round((self.started_at or end) - self.submitted_at, 3),
+                "elapsed_seconds": round(end - self.started_at, 3) if self.started_at else None,
+            }
+
+
+def _run(job: Job, fn, args, kwargs):
+    token = _current.set(job)
+    job._start()
+    try:
+        job.check_cancelled()
+        result = fn(*args, **kwargs)
+        job._finish(SUCCEEDED, result=result)
+    except Exception as e:
+        if job.cancel_requested:
+            job._finish(CANCELLED)
+        else:
+            job._finish(FAILED, error=e.detail if isinstance(e, HTTPException) else str(e))
+    finally:
+        _current.reset(token)
+        if job._cleanup is not None:
+            job._cleanup()
+
+
+def _prune():
+    # 完了したジョブは新しいものから JOB_HISTORY_LIMIT 件だけ保持する
+    finished = [job_id for job_id, job in _jobs.items() if job.state in FINISHED_STATES]
+    for job_id in finished[:max(0, len(finished) - config.JOB_HISTORY_LIMIT)]:
+        del _jobs[job_id]
+
+
+def submit(kind: str, params: dict, fn, *args, cleanup=None, **kwargs) -> Job:
+    # 処理をワーカープールに投入し、すぐにジョブを返す
+    job = Job(kind, params)
+    job._cleanup = cleanup
+    with _jobs_lock:
+        _prune()
+        _jobs[job.id] = job
+    job.future = _executor.submit(_run, job, fn, args, kwargs)
+    return job
+
+
+def accepted(job: Job) -> dict:
+    return {"message": "Job submitted", "job_id": job.id, "status_url": f"/jobs/{job.id}"}
+
+
+def get(job_id: str) -> Job:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def list_jobs() -> list:
+    with _jobs_lock:
+        return list(_jobs.values())
+
+
+# 以下はジョブとして実行中の処理から呼び出す関数（ジョブ外で呼ばれた場合は何もしない）
+def current():
+    return _current.get()
+
+
+def check_cancelled():
+    job = current()
+    if job is not None:
+        job.check_cancelled()
+
+
+def report(**progress):
+    # フェーズの切り替えはジョブ外で実行された場合もメトリクスとして記録する
+    if "phase" in progress:
+        metrics.phase(progress["phase"])
+    job = current()
+    if job is not None:
+        job.update(**progress)
+
+
+def add_rows(rows: int):
+    job = current()
+    if job is not None:
+        job.add_rows(rows)
+
+
+@contextmanager
+def tracked_connection(connection):
+    # キャンセル時に pg_cancel_backend を発行できるよう、接続のバックエンドPIDを記録する
+    job = current()
+    if job is None:
+        yield connection
+        return
+    pid = connection.execute(text("SELECT pg_backend_pid()")).scalar()
+    with job._lock:
+        job._backend_pids.add(pid)
+    try:
+        yield connection
+    finally:
+        with job._lock:
+            job._backend_pids.discard(pid)
+
+
+@contextmanager
+def tracked_process(process):
+    # キャンセル時に外部プロセスを終了できるよう記録する
+    job = current()
+    if job is None:
+        yield process
+        return
+    with job._lock:
+        job._processes.add(process)
+    try:
+        yield process
+    finally:
+        with job._lock:
+            job._processes.discard(process)
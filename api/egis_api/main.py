@@ -14,9 +14,9 @@ from pandas.api.types import is_integer_dtype, is_float_dtype, is_object_dtype
 from pydantic import BaseModel
 from pyproj import CRS
 
-from .database import engine
-from . import config
-from .routes import database_api, geoserver, geoprocessing
+from .database import async_engine, engine
+from . import catalog, config, geoserver_client, metrics, resumable, tilecache
+from .routes import database_api, export, features, geoserver, geoprocessing, jobs, metrics as metrics_routes, tiles, uploads, wms
 
 app = FastAPI()
 app.add_middleware(
@@ -26,6 +26,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+# リクエスト数・処理時間とSQLの実行時間を計測する
+app.middleware("http")(metrics.track_request)
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
+# GeoServerとの共有接続はアプリケーション終了時に閉じる
+app.add_event_handler("shutdown", geoserver_client.close)
+app.add_event_handler("shutdown", async_engine.dispose)
+# 外部のDDLの通知を受けてカタログキャッシュを破棄する（CATALOG_LISTEN が有効な場合）
+app.add_event_handler("startup", catalog.start_listener)
+# このワーカープロセスのWMSタイルキャッシュのディレクトリを空にする（モジュールの読み込み時には行わない）
+app.add_event_handler("startup", tilecache.cache.start)
+# 期限切れの再開可能なアップロードを削除する（以降はセッションの作成時に削除する）
+app.add_event_handler("startup", resumable.collect_garbage)
 
 class DataStore(BaseModel):
     workspace_name: str
@@ -41,3 +54,10 @@ class BufferParameters(BaseModel):
 app.include_router(database_api.router)
 app.include_router(geoserver.router)
 app.include_router(geoprocessing.router)
+app.include_router(jobs.router)
+app.include_router(tiles.router)
+app.include_router(wms.router)
+app.include_router(features.router)
+app.include_router(export.router)
+app.include_router(uploads.router)
+app.include_router(metrics_routes.router)
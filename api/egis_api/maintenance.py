@@ -0,0 +1,128 @@
+import json
+from typing import Optional
+
+import numpy as np
+import geopandas as gpd
+from sqlalchemy import text
+
+from . import config, jobs, planar
+from .database import engine, qualified_name
+
+# バッチ間で同じ曲線を使うため、ヒルベルト曲線の範囲は常に全世界（EPSG:4326）とする
+WORLD_BOUNDS = (-180, -90, 180, 90)
+
+
+def hilbert_order(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    # バッチ内の行をヒルベルト曲線上の位置順に並べ替える（空・欠損ジオメトリは末尾）
+    if not isinstance(gdf, gpd.GeoDataFrame) or len(gdf) < 2:
+        return gdf
+    geometry = gdf.geometry
+    valid = (~(geometry.isna() | geometry.is_empty)).to_numpy()
+    keys = np.full(len(gdf), np.iinfo(np.int64).max, dtype=np.int64)
+    if valid.any():
+        keys[valid] = geometry[valid].hilbert_distance(total_bounds=WORLD_BOUNDS).to_numpy(dtype=np.int64)
+    return gdf.iloc[np.argsort(keys, kind="stable")]
+
+
+def _column_names(connection, schema_name: str, table_name: str) -> set:
+    result = connection.execute(text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = :schema_name AND table_name = :table_name
+    """), {"schema_name": schema_name, "table_name": table_name})
+    return {row[0] for row in result}
+
+
+def _has_index_on(connection, schema_name: str, table_name: str, column_name: str) -> bool:
+    # 指定した列を先頭に持つインデックス（主キーを含む）があるか
+    return connection.execute(text("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass(:table) AND a.attname = :column_name
+        )
+    """), {"table": qualified_name(schema_name, table_name), "column_name": column_name}).scalar()
+
+
+def _is_geography(connection, schema_name: str, table_name: str) -> bool:
+    return connection.execute(text("""
+        SELECT EXISTS (
+            SELECT 1 FROM geography_columns
+            WHERE f_table_schema = :schema_name AND f_table_name = :table_name AND f_geography_column = 'geometry'
+        )
+    """), {"schema_name": schema_name, "table_name": table_name}).scalar()
+
+
+def recorded_extent(connection, schema_name: str, table_name: str) -> Optional[list]:
+    # record_extent で記録した範囲 [minx, miny, maxx, maxy]（記録されていなければ None）
+    comment = connection.execute(text("""
+        SELECT col_description(attrelid, attnum) FROM pg_attribute
+        WHERE attrelid = to_regclass(:table) AND attname = 'geometry'
+    """), {"table": qualified_name(schema_name, table_name)}).scalar()
+    try:
+        return json.loads(comment)["extent"]
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def record_extent(connection, schema_name: str, table_name: str, source_table: Optional[str] = None):
+    # geography列の範囲（EPSG:4326）をgeometry列のコメントに記録する
+    # geography列の統計情報は地心座標のため ST_EstimatedExtent では範囲を求められず、GeoServerへの公開時に全件を走査しないよう投入時に求めておく
+    # source_table を指定した場合は、そのテーブル（追加・更新した行）の範囲で記録済みの範囲を広げる
+    if not _is_geography(connection, schema_name, table_name):
+        return
+    box = connection.execute(text(f"""
+        SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+        FROM (SELECT ST_Extent(geometry::geometry) AS e FROM {qualified_name(schema_name, source_table or table_name)}) AS extent
+    """)).first()
+    extent = [float(value) for value in box] if box[0] is not None else None
+    recorded = recorded_extent(connection, schema_name, table_name) if source_table else None
+    if recorded and extent:
+        extent = [min(recorded[0], extent[0]), min(recorded[1], extent[1]), max(recorded[2], extent[2]), max(recorded[3], extent[3])]
+    extent = extent or recorded
+    if extent is None:
+        return
+    # COMMENT にはバインド変数を使えないため、数値だけからなるJSONを埋め込む
+    comment = json.dumps({"extent": extent})
+    connection.exec_driver_sql(f"COMMENT ON COLUMN {qualified_name(schema_name, table_name)}.geometry IS '{comment}'")
+
+
+def finalize(connection, schema_name: str, table_name: str, spatial_index: bool = True, cluster: bool = None):
+    # 投入後のテーブルを検索向けに整える（呼び出し元のトランザクション内で実行する）
+    #   1. fillfactor を設定し、MAINTENANCE_CLUSTER の場合はジオハッシュ順に並べ直して（CLUSTER）近い地物を同じページに集める
+    #      （インポートではバッチごとのヒルベルト順の書き込みで同じ効果が得られるため、テーブル全体の書き直しは既定では行わない）
+    #   2. maintenance_work_mem を増やしてGiSTインデックスを作成し、id列にB-treeインデックスを作成する
+    #   3. geography列の範囲を記録し、ANALYZE で統計情報を更新する
+    cluster = config.MAINTENANCE_CLUSTER if cluster is None else cluster
+    table = qualified_name(schema_name, table_name)
+    preparer = engine.dialect.identifier_preparer
+    columns = _column_names(connection, schema_name, table_name)
+    has_geometry = spatial_index and 'geometry' in columns
+
+    connection.execute(text(f"SET LOCAL maintenance_work_mem = '{config.MAINTENANCE_WORK_MEM}'"))
+    connection.execute(text(f"ALTER TABLE {table} SET (fillfactor = {int(config.MAINTENANCE_FILLFACTOR)})"))
+
+    if has_geometry and cluster:
+        # ジオハッシュの式インデックスで並べ替える（CLUSTERは全インデックスを作り直すため、GiSTより先に行う）
+        jobs.report(phase="cluster")
+        index_name = f"{table_name[:40]}_egis_geohash_idx"
+        connection.execute(text(f"""
+            CREATE INDEX {preparer.quote(index_name)} ON {table} ((
+                CASE WHEN geometry IS NULL OR ST_IsEmpty(geometry::geometry) THEN NULL
+                ELSE ST_GeoHash(ST_Centroid(geometry::geometry), 12) END
+            ))
+        """))
+        connection.execute(text(f"CLUSTER {table} USING {preparer.quote(index_name)}"))
+        connection.execute(text(f"DROP INDEX {qualified_name(schema_name, index_name)}"))
+
+    jobs.report(phase="index")
+    if has_geometry:
+        connection.execute(text(f"CREATE INDEX ON {table} USING GIST (geometry) WITH (fillfactor = {int(config.MAINTENANCE_INDEX_FILLFACTOR)})"))
+        if planar.PLANAR_COLUMN in columns:
+            planar.create_index(connection, schema_name, table_name)
+    if 'id' in columns and not _has_index_on(connection, schema_name, table_name, 'id'):
+        connection.execute(text(f"CREATE INDEX ON {table} (id)"))
+
+    jobs.report(phase="analyze")
+    if 'geometry' in columns:
+        record_extent(connection, schema_name, table_name)
+    connection.execute(text(f"ANALYZE {table}"))
@@ -0,0 +1,178 @@
+import re
+from typing import Optional
+
+from fastapi import HTTPException
+from geoalchemy2 import Geography, Geometry
+from sqlalchemy import BigInteger, Column, MetaData, Table, text
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.exc import DataError, IntegrityError
+
+from . import changes, ingest, jobs, maintenance, metrics, overlay, planar, pyramid, schema_inference
+from .catalog import catalog
+from .database import engine, qualified_name
+
+# インポートの書き込み方法（create: 新しいテーブルを作成、append: 既存のテーブルに追加、upsert: キー列で照合して追加・更新）
+MODES = ("create", "append", "upsert")
+
+# 作業用テーブルでの読み込み順（同じキーが複数ある場合は後の行を採用する）
+_ROW_COLUMN = "_egis_row"
+
+
+def check_mode(mode: str, key: Optional[str]):
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported mode: {mode}")
+    if mode == "upsert" and not key:
+        raise HTTPException(status_code=400, detail="key is required for mode=upsert")
+
+
+def _comparable(column) -> str:
+    # 変更の有無を判定するための式（ジオメトリはバイト列、jsonは文字列として比較する）
+    name = engine.dialect.identifier_preparer.quote(column.name)
+    if isinstance(column.type, (Geometry, Geography)):
+        return f"ST_AsEWKB({{table}}.{name})"
+    if isinstance(column.type, JSON):
+        return f"{{table}}.{name}::text"
+    return f"{{table}}.{name}"
+
+
+def _has_unique_index(connection, schema_name: str, table_name: str, key: str) -> bool:
+    # キー列のみからなる一意インデックス（主キーを含む）があるか
+    return connection.execute(text("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass(:table) AND i.indisunique AND i.indnatts = 1
+                AND i.indpred IS NULL AND i.indexprs IS NULL AND a.attname = :key
+        )
+    """), {"table": qualified_name(schema_name, table_name), "key": key}).scalar()
+
+
+def _target_columns(schema_name: str, table_name: str) -> list:
+    # 書き込み対象の列（id と生成列を除く）
+    return [
+        Column(column['name'], column['type'])
+        for column in catalog.columns(schema_name, table_name)
+        if column['name'] not in ('id', planar.PLANAR_COLUMN)
+    ]
+
+
+def _staging_table(schema_name: str, table_name: str, staging_name: str) -> Table:
+    # 対象テーブルと同じ型の列を持つUNLOGGEDの作業用テーブル
+    return Table(staging_name, MetaData(), Column(_ROW_COLUMN, BigInteger, primary_key=True), *_target_columns(schema_name, table_name),
+                 schema=schema_name, prefixes=["UNLOGGED"])
+
+
+def _check_types(table_name: str, staging: Table, batch):
+    # 対象テーブルの列の型に収まらない値があれば400にする
+    # （列の型の変更はテーブル全体の書き直しとインデックスの再作成になり、その間は排他ロックで読み取りも止まるため行わない）
+    incompatible = schema_inference.incompatible_columns(staging, batch)
+    if incompatible:
+        detail = ", ".join(f"{name} ({current} in {table_name}, the imported data needs {needed})" for name, (current, needed) in incompatible.items())
+        raise HTTPException(status_code=400, detail=f"Imported values do not fit the column types of {table_name}: {detail}")
+
+
+def _data_error(error: DataError) -> HTTPException:
+    # 型の推定で検出できずに書き込めなかった値は、COPYのエラー位置（"COPY <テーブル>, line <行>, column <列>[: <値>]"）から列名を示して400にする
+    context = getattr(getattr(error.orig, "diag", None), "context", None) or ""
+    match = re.search(r"line (\d+), column (.+?)(?::|$)", context)
+    if match is None:
+        return HTTPException(status_code=400, detail=f"Invalid value in the imported data: {error.orig}")
+    return HTTPException(status_code=400, detail=f"Invalid value for column {match.group(2)} (row {match.group(1)} of the batch): {error.orig}")
+
+
+def _merge_sql(schema_name: str, table_name: str, staging: Table, columns: list, mode: str, key: Optional[str]) -> str:
+    preparer = engine.dialect.identifier_preparer
+    target = qualified_name(schema_name, table_name)
+    column_list = ", ".join(preparer.quote(column.name) for column in columns)
+    if mode == "append":
+        return f"""
+            WITH merged AS (
+                INSERT INTO {target} ({column_list})
+                SELECT {column_list} FROM {qualified_name(schema_name, staging.name)}
+                RETURNING 1
+            )
+            SELECT count(*), 0 FROM merged
+        """
+
+    # 同じキーの行は最後に読み込んだものだけを使い、値が変わらない行は更新しない（xmax = 0 の行が新規に追加された行）
+    quoted_key = preparer.quote(key)
+    updates = [column for column in columns if column.name != key]
+    set_clause = ", ".join(f"{preparer.quote(column.name)} = EXCLUDED.{preparer.quote(column.name)}" for column in updates)
+    current = ", ".join(_comparable(column).format(table="t") for column in updates)
+    incoming = ", ".join(_comparable(column).format(table="EXCLUDED") for column in updates)
+    conflict = f"DO UPDATE SET {set_clause} WHERE ({current}) IS DISTINCT FROM ({incoming})" if updates else "DO NOTHING"
+    return f"""
+        WITH merged AS (
+            INSERT INTO {target} AS t ({column_list})
+            SELECT DISTINCT ON ({quoted_key}) {column_list} FROM {qualified_name(schema_name, staging.name)}
+            WHERE {quoted_key} IS NOT NULL
+            ORDER BY {quoted_key}, {_ROW_COLUMN} DESC
+            ON CONFLICT ({quoted_key}) {conflict}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged
+    """
+
+
+def merge_batches(schema_name: str, table_name: str, batches, copy_format: str = "csv", mode: str = "append", key: Optional[str] = None) -> dict:
+    # バッチを作業用テーブルにCOPYし、1つのトランザクションで既存のテーブルに追加・更新する
+    # テーブルを作り直さないため、公開済みのレイヤーや空間インデックスはそのまま使われ続ける
+    check_mode(mode, key)
+    rows = 0
+    fed_columns = set()
+    with overlay.scratch_tables(schema_name, "stage") as (staging_name,):
+        staging = _staging_table(schema_name, table_name, staging_name)
+        if key is not None and key not in staging.c.keys():
+            raise HTTPException(status_code=400, detail=f"Unknown key column: {key}")
+
+        with engine.connect() as connection, jobs.tracked_connection(connection):
+            jobs.report(phase="load")
+            staging.create(connection)
+            for batch in batches:
+                jobs.check_cancelled()
+                fed_columns.update(batch.columns)
+                _check_types(table_name, staging, batch)
+                with metrics.step("sort"):
+                    batch = maintenance.hilbert_order(batch)
+                with metrics.step("copy"):
+                    try:
+                        batch_rows = ingest.copy_dataframe(connection, staging, batch, copy_format)
+                    except DataError as e:
+                        raise _data_error(e)
+                rows += batch_rows
+                jobs.add_rows(batch_rows)
+
+            # 入力に含まれる列だけを書き込む（含まれない列は既存の値のまま）
+            columns = [column for column in staging.columns if column.name in fed_columns and column.name != _ROW_COLUMN]
+            if key is not None and key not in fed_columns:
+                raise HTTPException(status_code=400, detail=f"Key column {key} is not in the imported data")
+
+            jobs.report(phase="merge")
+            # キーが空の行と、後の行で置き換えられた同じキーの行は書き込まない
+            merged_rows = rows
+            if mode == "upsert":
+                quoted_key = engine.dialect.identifier_preparer.quote(key)
+                merged_rows = connection.execute(text(f"SELECT count(DISTINCT {quoted_key}) FROM {qualified_name(schema_name, staging_name)}")).scalar()
+            if mode == "upsert" and not _has_unique_index(connection, schema_name, table_name, key):
+                # ON CONFLICT に必要な一意インデックスを作成する（初回のみ）
+                try:
+                    with connection.begin_nested():
+                        connection.execute(text(f"CREATE UNIQUE INDEX ON {qualified_name(schema_name, table_name)} ({engine.dialect.identifier_preparer.quote(key)})"))
+                except IntegrityError:
+                    raise HTTPException(status_code=400, detail=f"Key column {key} has duplicate values in {table_name}")
+            inserted, updated = connection.execute(text(_merge_sql(schema_name, table_name, staging, columns, mode, key))).first()
+            if any(column.name == "geometry" for column in columns):
+                # 記録済みの範囲を追加・更新した行の範囲で広げる
+                maintenance.record_extent(connection, schema_name, table_name, source_table=staging_name)
+            staging.drop(connection)
+
+            jobs.report(phase="analyze")
+            connection.execute(text(f"ANALYZE {qualified_name(schema_name, table_name)}"))
+            connection.commit()
+    changes.table_changed(schema_name, table_name)
+
+    # 簡略化テーブルがあれば、同じズームレベルで作り直す
+    levels = pyramid.levels(schema_name, table_name)
+    if levels:
+        pyramid.build(schema_name, table_name, list(levels))
+    return {"rows": rows, "inserted": inserted, "updated": updated, "unchanged": merged_rows - inserted - updated, "skipped": rows - merged_rows}
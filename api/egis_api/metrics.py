@@ -0,0 +1,181 @@
+import contextvars
+import logging
+import re
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+from sqlalchemy import event
+
+from . import config
+
+slow_query_logger = logging.getLogger("egis_api.slow_query")
+
+# 処理時間の分布（秒）。インポートや空間解析は数分かかるため長めの区間まで用意する
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+HTTP_REQUESTS = Counter("egis_http_requests_total", "HTTP requests", ["method", "route", "status"])
+HTTP_REQUEST_DURATION = Histogram("egis_http_request_duration_seconds", "HTTP request duration", ["method", "route"], buckets=DURATION_BUCKETS)
+DB_STATEMENT_DURATION = Histogram("egis_db_statement_duration_seconds", "SQL statement duration", ["operation", "statement"], buckets=DURATION_BUCKETS)
+PHASE_DURATION = Histogram("egis_phase_duration_seconds", "Duration of each phase of imports and geoprocessing", ["operation", "phase"], buckets=DURATION_BUCKETS)
+OPERATION_DURATION = Histogram("egis_operation_duration_seconds", "Duration of imports and geoprocessing", ["operation", "outcome"], buckets=DURATION_BUCKETS)
+IMPORT_ROWS = Counter("egis_import_rows_total", "Rows written by imports", ["operation"])
+IMPORT_ROWS_PER_SECOND = Histogram("egis_import_rows_per_second", "Import throughput", ["operation"],
+                                   buckets=(100, 1000, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000))
+STEP_DURATION = Histogram("egis_step_duration_seconds", "Duration of repeated steps within a phase (read, reproject, copy per batch)", ["operation", "step"], buckets=DURATION_BUCKETS)
+GEOSERVER_REQUEST_DURATION = Histogram("egis_geoserver_request_duration_seconds", "GeoServer request duration", ["method", "status"], buckets=DURATION_BUCKETS)
+
+# SQL文の種類（先頭のキーワード）
+_STATEMENT_KIND = re.compile(r"^\s*(?:--[^\n]*\n\s*)*(\w+)")
+# EXPLAINできる文
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+
+class _Operation:
+    # 実行中の処理と、現在のフェーズの開始時刻
+    def __init__(self, name: str):
+        self.name = name
+        self.phase = None
+        self.phase_started = None
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self.phase is not None:
+            PHASE_DURATION.labels(self.name, self.phase).observe(now - self.phase_started)
+        self.phase, self.phase_started = phase, now
+
+
+_current = contextvars.ContextVar("egis_metrics_operation", default=None)
+
+
+@contextmanager
+def operation(name: str):
+    # インポート・空間解析の処理全体を計測する（入れ子の場合は外側の処理として計測する）
+    if _current.get() is not None:
+        yield
+        return
+    current = _Operation(name)
+    token = _current.set(current)
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        current.enter(None)
+        OPERATION_DURATION.labels(name, outcome).observe(time.perf_counter() - started)
+        _current.reset(token)
+
+
+def phase(name: str):
+    # 実行中の処理のフェーズを切り替える（前のフェーズの時間を記録する）。処理の外では何もしない
+    current = _current.get()
+    if current is not None:
+        current.enter(name)
+
+
+@contextmanager
+def step(name: str):
+    # フェーズ内で繰り返す処理（バッチごとの読み込み・投影変換・COPYなど）の時間を記録する
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STEP_DURATION.labels(operation_name(), name).observe(time.perf_counter() - started)
+
+
+def timed_iter(iterable, name: str):
+    # イテレータから次の要素を取り出すのにかかった時間を step として記録する
+    iterator = iter(iterable)
+    while True:
+        with step(name):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+_END = object()
+
+
+def operation_name(default: str = "request") -> str:
+    current = _current.get()
+    return current.name if current is not None else default
+
+
+def record_import(rows: int, elapsed: float):
+    name = operation_name("import")
+    IMPORT_ROWS.labels(name).inc(rows)
+    if elapsed > 0:
+        IMPORT_ROWS_PER_SECOND.labels(name).observe(rows / elapsed)
+
+
+async def track_request(request, call_next):
+    # ルートのパステンプレート単位で集計する（一致しなかったリクエストは "unmatched" にまとめる）
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        HTTP_REQUESTS.labels(request.method, path, str(status)).inc()
+        HTTP_REQUEST_DURATION.labels(request.method, path).observe(time.perf_counter() - started)
+
+
+def _statement_kind(statement: str) -> str:
+    match = _STATEMENT_KIND.match(statement)
+    return match.group(1).upper() if match else "OTHER"
+
+
+def _explain(connection, statement: str, parameters) -> str:
+    # 同じトランザクション内でEXPLAINする（失敗しても元の処理に影響しないようセーブポイントで囲む）
+    connection.info["egis_explaining"] = True
+    try:
+        connection.exec_driver_sql("SAVEPOINT egis_explain")
+        try:
+            plan = connection.exec_driver_sql(f"EXPLAIN {statement}", parameters).fetchall()
+            connection.exec_driver_sql("RELEASE SAVEPOINT egis_explain")
+            return "\n".join(row[0] for row in plan)
+        except Exception as e:
+            connection.exec_driver_sql("ROLLBACK TO SAVEPOINT egis_explain")
+            return f"(EXPLAIN failed: {e})"
+    finally:
+        connection.info["egis_explaining"] = False
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("egis_statement_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = connection.info.get("egis_statement_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if connection.info.get("egis_explaining"):
+        return
+    kind = _statement_kind(statement)
+    DB_STATEMENT_DURATION.labels(operation_name(), kind).observe(elapsed)
+
+    # 閾値を超えた文はSQLと実行計画をログに出力する（SLOW_QUERY_LOG が有効な場合）
+    if config.SLOW_QUERY_LOG and elapsed >= config.SLOW_QUERY_THRESHOLD:
+        plan = ""
+        if config.SLOW_QUERY_EXPLAIN and not executemany and kind in _EXPLAINABLE:
+            plan = _explain(connection, statement, parameters)
+        slow_query_logger.warning("slow query (%.3fs, %s)\n%s\n%s", elapsed, operation_name(), statement, plan)
+
+
+def _handle_error(context):
+    # 失敗した文の開始時刻を破棄する
+    started = context.connection.info.get("egis_statement_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
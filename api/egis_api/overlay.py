@@ -0,0 +1,205 @@
+import contextvars
+import uuid
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from . import config, jobs, planar
+from .catalog import catalog
+from .database import engine, qualified_name
+
+
+@contextmanager
+def scratch_tables(schema_name: str, *prefixes):
+    # 処理中だけ使う作業用テーブル名を払い出し、終了時（失敗時も）に削除する
+    names = [f"_egis_{prefix}_{uuid.uuid4().hex[:12]}" for prefix in prefixes]
+    try:
+        yield names
+    finally:
+        with engine.connect() as connection:
+            for name in names:
+                connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(schema_name, name)}"))
+            connection.commit()
+
+
+def target_columns(schema_name: str, table_name: str) -> list:
+    # 既存テーブルから列名を取得（ジオメトリ以外。投影座標系の列は結果テーブルで計算し直す）
+    columns = [column['name'] for column in catalog.columns(schema_name, table_name)]
+    if 'id' not in columns:
+        raise HTTPException(status_code=400, detail=f"{table_name} has no id column")
+    return [column for column in columns if column not in ('geometry', planar.PLANAR_COLUMN)]
+
+
+def subdivide(connection, schema_name: str, table_name: str, parts_table: str, srid: Optional[int] = None):
+    # 演算に使うレイヤーを頂点数 OVERLAY_SUBDIVIDE_VERTICES 以下の小さなポリゴンに分割し、GiSTインデックスを作成する
+    # srid を指定した場合はその投影座標系に変換してから分割する
+    geom = f"ST_Transform(geometry::geometry, {int(srid)})" if srid else "geometry::geometry"
+    connection.execute(text(f"""
+        CREATE UNLOGGED TABLE {qualified_name(schema_name, parts_table)} AS
+        SELECT ST_Subdivide({geom}, :max_vertices) AS geom
+        FROM {qualified_name(schema_name, table_name)}
+        WHERE geometry IS NOT NULL
+    """), {"max_vertices": config.OVERLAY_SUBDIVIDE_VERTICES})
+    connection.execute(text(f"CREATE INDEX ON {qualified_name(schema_name, parts_table)} USING GIST (geom)"))
+    connection.execute(text(f"ANALYZE {qualified_name(schema_name, parts_table)}"))
+
+
+def partition(connection, schema_name: str, table_name: str, partition_table: str, partitions: int):
+    # 対象フィーチャーをジオハッシュ順に並べて partitions 個の空間的にまとまった区画に割り振る
+    connection.execute(text(f"""
+        CREATE UNLOGGED TABLE {qualified_name(schema_name, partition_table)} AS
+        SELECT
+            id,
+            ntile(:partitions) OVER (
+                ORDER BY CASE
+                    WHEN geometry IS NULL OR ST_IsEmpty(geometry::geometry) THEN ''
+                    ELSE ST_GeoHash(ST_Centroid(geometry::geometry), 10)
+                END
+            ) AS part
+        FROM {qualified_name(schema_name, table_name)}
+    """), {"partitions": partitions})
+    connection.execute(text(f"CREATE INDEX ON {qualified_name(schema_name, partition_table)} (part, id)"))
+    connection.execute(text(f"ANALYZE {qualified_name(schema_name, partition_table)}"))
+
+
+def run_partitioned(statement: str, params: dict, partitions: int) -> int:
+    # 区画ごとの処理を OVERLAY_PARALLELISM 個のセッションで並列に実行し、書き込んだ行数を返す
+    jobs.report(phase="overlay", partitions_total=partitions, partitions_done=0)
+    done = []
+
+    def run(part: int) -> int:
+        jobs.check_cancelled()
+        with engine.connect() as connection, jobs.tracked_connection(connection):
+            rows = connection.execute(text(statement), {**params, "part": part}).rowcount
+            connection.commit()
+        done.append(part)
+        jobs.add_rows(rows)
+        jobs.report(partitions_done=len(done))
+        return rows
+
+    rows = 0
+    with ThreadPoolExecutor(max_workers=config.OVERLAY_PARALLELISM, thread_name_prefix="egis-overlay") as executor:
+        # 各スレッドでジョブの進捗報告・キャンセルが使えるようコンテキストを引き継ぐ
+        futures = [executor.submit(contextvars.copy_context().run, run, part) for part in range(1, partitions + 1)]
+        try:
+            for future in as_completed(futures):
+                rows += future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    return rows
+
+
+def _create_output(connection, schema_name: str, table_name: str, new_table_name: str, columns: list):
+    preparer = engine.dialect.identifier_preparer
+    select_columns = ", ".join(preparer.quote(column) for column in columns)
+    connection.execute(text(f"""
+        CREATE TABLE {qualified_name(schema_name, new_table_name)} AS
+        SELECT {select_columns}, geometry
+        FROM {qualified_name(schema_name, table_name)}
+        WITH NO DATA
+    """))
+
+
+def _operand_expressions(srid: Optional[int]):
+    # 対象フィーチャーのジオメトリ式と、演算結果をgeographyに戻す式
+    if srid is None:
+        return "a.geometry::geometry", lambda expression: f"{expression}::geography"
+    return f"a.{planar.PLANAR_COLUMN}", lambda expression: f"ST_Transform({expression}, 4326)::geography"
+
+
+def _overlay(schema_name: str, table_name: str, operand_table: str, new_table_name: str, build_statement) -> int:
+    columns = target_columns(schema_name, table_name)
+    partitions = config.OVERLAY_PARTITIONS
+
+    with scratch_tables(schema_name, "parts", "partition") as (parts_table, partition_table):
+        with engine.connect() as connection, jobs.tracked_connection(connection):
+            # 対象レイヤーが投影座標系の列を持つ場合は、その座標系の平面上で演算する
+            srid = planar.planar_srid(connection, schema_name, table_name)
+            jobs.report(phase="subdivide")
+            subdivide(connection, schema_name, operand_table, parts_table, srid)
+            jobs.report(phase="partition")
+            partition(connection, schema_name, table_name, partition_table, partitions)
+            _create_output(connection, schema_name, table_name, new_table_name, columns)
+            if srid is not None:
+                planar.add_planar_column(connection, schema_name, new_table_name, srid)
+            connection.commit()
+
+        try:
+            rows = run_partitioned(build_statement(columns, parts_table, partition_table, srid), {}, partitions)
+        except Exception:
+            # 途中で失敗した場合は作りかけの結果テーブルを削除する
+            with engine.connect() as connection:
+                connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(schema_name, new_table_name)}"))
+                connection.commit()
+            raise
+    return rows
+
+
+def clip(schema_name: str, clippee_table: str, clipper_table: str, new_table_name: str) -> int:
+    # 入力フィーチャーごとに、重なるクリップ側の分割ポリゴンを結合してから1回だけST_Intersectionを計算する
+    preparer = engine.dialect.identifier_preparer
+
+    def build_statement(columns, parts_table, partition_table, srid):
+        geom, to_geography = _operand_expressions(srid)
+        if srid is None:
+            # 投影座標系の列がない場合は、分割前と同じくgeographyとして交差を求める
+            # （経度緯度の平面上で求めると、日付変更線・極の付近や長い辺で結果が変わるため）
+            intersection = "ST_Intersection(a.geometry, c.geom::geography)"
+        else:
+            intersection = to_geography(f"ST_Intersection({geom}, c.geom)")
+        column_list = ", ".join(preparer.quote(column) for column in columns)
+        select_columns = ", ".join(f"a.{preparer.quote(column)}" for column in columns)
+        return f"""
+            INSERT INTO {qualified_name(schema_name, new_table_name)} ({column_list}, geometry)
+            SELECT {select_columns}, r.geometry
+            FROM {qualified_name(schema_name, clippee_table)} AS a
+            JOIN {qualified_name(schema_name, partition_table)} AS p ON p.id = a.id AND p.part = :part
+            CROSS JOIN LATERAL (
+                SELECT ST_Union(s.geom) AS geom
+                FROM {qualified_name(schema_name, parts_table)} AS s
+                WHERE ST_Intersects(s.geom, {geom})
+            ) AS c
+            CROSS JOIN LATERAL (
+                SELECT {intersection} AS geometry
+            ) AS r
+            WHERE c.geom IS NOT NULL AND NOT ST_IsEmpty(r.geometry::geometry)
+        """
+
+    return _overlay(schema_name, clippee_table, clipper_table, new_table_name, build_statement)
+
+
+def erase(schema_name: str, erasee_table: str, eraser_table: str, new_table_name: str) -> int:
+    # 入力フィーチャーごとに、重なるイレース側の分割ポリゴンを結合してから1回だけST_Differenceを計算する
+    # （重なりがなければ元のジオメトリのまま、すべて消えたフィーチャーは出力しない）
+    # 投影座標系の列がない場合の差分は、分割前と同じく経度緯度の平面上で求める（geographyの ST_Difference はないため）
+    preparer = engine.dialect.identifier_preparer
+
+    def build_statement(columns, parts_table, partition_table, srid):
+        geom, to_geography = _operand_expressions(srid)
+        column_list = ", ".join(preparer.quote(column) for column in columns)
+        select_columns = ", ".join(f"a.{preparer.quote(column)}" for column in columns)
+        return f"""
+            INSERT INTO {qualified_name(schema_name, new_table_name)} ({column_list}, geometry)
+            SELECT {select_columns}, r.geometry
+            FROM {qualified_name(schema_name, erasee_table)} AS a
+            JOIN {qualified_name(schema_name, partition_table)} AS p ON p.id = a.id AND p.part = :part
+            CROSS JOIN LATERAL (
+                SELECT ST_Union(s.geom) AS geom
+                FROM {qualified_name(schema_name, parts_table)} AS s
+                WHERE ST_Intersects(s.geom, {geom})
+            ) AS e
+            CROSS JOIN LATERAL (
+                SELECT CASE
+                    WHEN e.geom IS NULL THEN a.geometry
+                    ELSE {to_geography(f'ST_Difference({geom}, e.geom)')}
+                END AS geometry
+            ) AS r
+            WHERE r.geometry IS NULL OR NOT ST_IsEmpty(r.geometry::geometry)
+        """
+
+    return _overlay(schema_name, erasee_table, eraser_table, new_table_name, build_statement)
@@ -0,0 +1,82 @@
+import math
+from typing import Optional
+
+import geopandas as gpd
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from . import config
+from .database import engine, qualified_name
+
+# インポート時の保存形式（geography: geography列のみ、both: 平面直角座標のgeometry列も併せて保持する）
+# 投影座標系のgeometry列のみを持つ形式は設けない（タイル・フィーチャー・空間解析はgeography列を前提とし、投影座標系の列はそこから生成する）
+STORAGE_MODES = ("geography", "both")
+
+PLANAR_COLUMN = "geometry_planar"  # 投影座標系で保持するgeometry列の名前
+
+
+def check_storage(storage: str):
+    if storage not in STORAGE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported storage: {storage}")
+
+
+def check_span(minx: float, miny: float, maxx: float, maxy: float):
+    if maxx - minx > config.PLANAR_MAX_SPAN_DEGREES or maxy - miny > config.PLANAR_MAX_SPAN_DEGREES:
+        raise HTTPException(status_code=400, detail="Data extent is too large for a local projected CRS; use storage=geography")
+
+
+def extend_extent(extent: Optional[tuple], gdf) -> Optional[tuple]:
+    # バッチ（EPSG:4326）の範囲で extent を広げる
+    # 範囲がUTMゾーンに収まらなくなった時点で400を返し、storage=both の投入を残りのバッチを書き込む前に打ち切る
+    if not isinstance(gdf, gpd.GeoDataFrame):
+        return extent
+    minx, miny, maxx, maxy = gdf.total_bounds
+    # 空・欠損ジオメトリのみのバッチ
+    if math.isnan(minx):
+        return extent
+    if extent is not None:
+        minx, miny, maxx, maxy = min(extent[0], minx), min(extent[1], miny), max(extent[2], maxx), max(extent[3], maxy)
+    check_span(minx, miny, maxx, maxy)
+    return minx, miny, maxx, maxy
+
+
+def utm_srid(minx: float, miny: float, maxx: float, maxy: float) -> int:
+    # データ範囲の中心が含まれるUTMゾーン（WGS84, EPSG:326xx / 327xx）を選ぶ
+    check_span(minx, miny, maxx, maxy)
+    lon, lat = (minx + maxx) / 2, (miny + maxy) / 2
+    zone = min(60, int(math.floor((lon + 180) / 6)) + 1)
+    return (32600 if lat >= 0 else 32700) + zone
+
+
+def add_planar_column(connection, schema_name: str, table_name: str, srid: Optional[int] = None) -> Optional[int]:
+    # geography列から自動計算される生成列として追加するため、以降の追記・更新でも常に同期される
+    # srid を省略した場合はデータの範囲から選ぶ（データが空の場合は追加しない）
+    if srid is None:
+        extent = connection.execute(text(f"""
+            SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+            FROM (SELECT ST_Extent(geometry::geometry) AS e FROM {qualified_name(schema_name, table_name)}) AS extent
+        """)).first()
+        if extent is None or extent[0] is None:
+            return None
+        srid = utm_srid(*extent)
+
+    column = engine.dialect.identifier_preparer.quote(PLANAR_COLUMN)
+    connection.execute(text(f"""
+        ALTER TABLE {qualified_name(schema_name, table_name)}
+        ADD COLUMN {column} geometry(GEOMETRY, {int(srid)})
+        GENERATED ALWAYS AS (ST_Transform(geometry::geometry, {int(srid)})) STORED
+    """))
+    return srid
+
+
+def create_index(connection, schema_name: str, table_name: str):
+    column = engine.dialect.identifier_preparer.quote(PLANAR_COLUMN)
+    connection.execute(text(f"CREATE INDEX ON {qualified_name(schema_name, table_name)} USING GIST ({column})"))
+
+
+def planar_srid(connection, schema_name: str, table_name: str) -> Optional[int]:
+    # 投影座標系の列を持つテーブルであればそのSRIDを返す
+    return connection.execute(text("""
+        SELECT srid FROM geometry_columns
+        WHERE f_table_schema = :schema_name AND f_table_name = :table_name AND f_geometry_column = :column
+    """), {"schema_name": schema_name, "table_name": table_name, "column": PLANAR_COLUMN}).scalar()
@@ -0,0 +1,197 @@
+import asyncio
+import math
+import re
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from . import changes, config, geoserver_client, jobs, maintenance, metrics, planar
+from .catalog import catalog
+from .database import engine, qualified_name
+
+# 簡略化したジオメトリを持つ付属テーブルの名前（<テーブル名>__z<そのテーブルを使う最大のズームレベル>）
+LEVEL_SUFFIX = "__z{zoom}"
+_LEVEL_PATTERN = re.compile(r"^(?P<table>.+)__z(?P<zoom>\d+)$")
+
+# PostgreSQLの識別子の最大長
+MAX_IDENTIFIER_LENGTH = 63
+
+# 256pxタイルで1ピクセルに相当する赤道上の経度幅（ズームレベル0）
+_DEGREES_PER_PIXEL = 360 / 256
+# EPSG:3857で1ピクセルに相当する距離（メートル、ズームレベル0）
+_METERS_PER_PIXEL = 40075016.68557849 / 256
+
+
+def level_name(table_name: str, zoom: int) -> str:
+    name = table_name + LEVEL_SUFFIX.format(zoom=zoom)
+    if len(name) > MAX_IDENTIFIER_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Table name is too long to build generalized levels: {table_name}")
+    return name
+
+
+def tolerance(zoom: int) -> float:
+    # そのズームレベルで PYRAMID_PIXEL_TOLERANCE ピクセルに相当する幅（度）
+    return config.PYRAMID_PIXEL_TOLERANCE * _DEGREES_PER_PIXEL / 2 ** zoom
+
+
+def _levels_in(tables: list, table_name: str) -> dict:
+    levels = {}
+    for name in tables:
+        match = _LEVEL_PATTERN.match(name)
+        if match and match.group("table") == table_name:
+            levels[int(match.group("zoom"))] = name
+    return dict(sorted(levels.items()))
+
+
+def levels(schema_name: str, table_name: str) -> dict:
+    # ズームレベル -> 簡略化テーブル名（ズームレベルの昇順）
+    return _levels_in(catalog.tables(schema_name), table_name)
+
+
+async def alevels(schema_name: str, table_name: str) -> dict:
+    return _levels_in(await catalog.atables(schema_name), table_name)
+
+
+def select_level(available: dict, zoom: float) -> Optional[str]:
+    # 指定したズームレベル以上の詳細さを持つ最も粗いレベルを選ぶ（該当しなければ元のテーブルを使う）
+    for level_zoom, name in available.items():
+        if zoom <= level_zoom:
+            return name
+    return None
+
+
+def drop(connection, schema_name: str, table_name: str) -> list:
+    dropped = []
+    for name in levels(schema_name, table_name).values():
+        connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(schema_name, name)}"))
+        dropped.append(name)
+    return dropped
+
+
+@metrics.operation("pyramid")
+def build(schema_name: str, table_name: str, zooms: Optional[list] = None) -> dict:
+    # 詳細なレベルから順に、1つ前のレベルを簡略化して次のレベルを作る（元のテーブルの全頂点を読むのは最初の1回だけ）
+    zooms = sorted(set(zooms or config.PYRAMID_ZOOMS), reverse=True)
+    columns = catalog.columns(schema_name, table_name)
+    if not any(column['name'] == 'geometry' for column in columns):
+        raise HTTPException(status_code=404, detail="Table with geometry column not found")
+    names = {zoom: level_name(table_name, zoom) for zoom in zooms}
+
+    preparer = engine.dialect.identifier_preparer
+    attribute_columns = [column['name'] for column in columns if column['name'] not in ('geometry', planar.PLANAR_COLUMN)]
+    select_columns = "".join(f"{preparer.quote(column)}, " for column in attribute_columns)
+
+    with engine.connect() as connection, jobs.tracked_connection(connection):
+        # 作り直す場合は既存のレベルを削除する
+        dropped = drop(connection, schema_name, table_name)
+        source = table_name
+        for zoom in zooms:
+            jobs.check_cancelled()
+            jobs.report(phase=f"simplify:z{zoom}")
+            connection.execute(text(f"""
+                CREATE TABLE {qualified_name(schema_name, names[zoom])} AS
+                SELECT {select_columns}
+                    ST_SimplifyPreserveTopology(ST_RemoveRepeatedPoints(geometry::geometry, :tolerance), :tolerance)::geography AS geometry
+                FROM {qualified_name(schema_name, source)}
+            """), {"tolerance": tolerance(zoom)})
+            if 'id' in attribute_columns:
+                connection.execute(text(f"ALTER TABLE {qualified_name(schema_name, names[zoom])} ADD PRIMARY KEY (id)"))
+            # 元のテーブルの並び順のまま作成されるため、並べ替えは行わない
+            maintenance.finalize(connection, schema_name, names[zoom], cluster=False)
+            source = names[zoom]
+        connection.commit()
+
+    for name in set(dropped) | set(names.values()):
+        changes.table_changed(schema_name, name)
+    return {"levels": {zoom: names[zoom] for zoom in sorted(names)}}
+
+
+def wms_zoom(params: dict) -> Optional[float]:
+    # GetMapのBBOXと画像サイズから、相当するタイルのズームレベルを求める
+    params = {key.lower(): value for key, value in params.items()}
+    srs = (params.get("srs") or params.get("crs") or "").upper()
+    try:
+        width, height = int(params.get("width", 0)), int(params.get("height", 0))
+        minx, miny, maxx, maxy = (float(value) for value in params.get("bbox", "").split(","))
+    except ValueError:
+        return None
+    if width <= 0 or height <= 0:
+        return None
+    # WMS 1.3.0 の EPSG:4326 は緯度・経度の順になるため、縦横の大きい方の解像度を使う
+    resolution = max((maxx - minx) / width, (maxy - miny) / height)
+    if resolution <= 0:
+        return None
+    if srs in ("EPSG:3857", "EPSG:900913"):
+        return math.log2(_METERS_PER_PIXEL / resolution)
+    if srs in ("EPSG:4326", "CRS:84"):
+        return math.log2(_DEGREES_PER_PIXEL / resolution)
+    return None
+
+
+def _entries(data: dict, collection: str, item: str) -> list:
+    # GeoServer REST APIの一覧（0件の場合は空文字列、1件の場合もリスト）
+    return (data.get(collection) or {}).get(item) or []
+
+
+async def _datastore_layers(workspace_name: str, datastore_name: str) -> dict:
+    base = f"/rest/workspaces/{workspace_name}/datastores/{datastore_name}"
+    datastore, featuretypes = await asyncio.gather(
+        geoserver_client.request("GET", f"{base}.json"), geoserver_client.request("GET", f"{base}/featuretypes.json"),
+    )
+    if datastore.status_code != 200 or featuretypes.status_code != 200:
+        return {}
+    parameters = _entries(datastore.json()["dataStore"], "connectionParameters", "entry")
+    schema_name = next((entry["$"] for entry in parameters if entry.get("@key") == "schema"), "public")
+    return {featuretype["name"]: schema_name for featuretype in _entries(featuretypes.json(), "featureTypes", "featureType")}
+
+
+async def workspace_layers(workspace_name: str) -> dict:
+    # ワークスペースに公開済みのレイヤー名 -> データストアのスキーマ名（CATALOG_TTL の間キャッシュする）
+    # 公開済みのレイヤーがない場合もキャッシュし、GetMapのたびにREST APIを呼び出さないようにする（取得に失敗した場合はキャッシュしない）
+    async def load():
+        response = await geoserver_client.request("GET", f"/rest/workspaces/{workspace_name}/datastores.json")
+        if response.status_code != 200:
+            return None
+        names = [datastore["name"] for datastore in _entries(response.json(), "dataStores", "dataStore")]
+        found = {}
+        for layers in await geoserver_client.gather_limited(_datastore_layers(workspace_name, name) for name in names):
+            found.update(layers)
+        return found
+    return await catalog.acached(("workspace_layers", workspace_name), load, keep_empty=True) or {}
+
+
+def forget_workspace(workspace_name: str):
+    # このAPIからレイヤーを公開・削除した後に呼び出す
+    catalog.discard(("workspace_layers", workspace_name))
+
+
+async def layer_levels(workspace_name: str, layer: str) -> dict:
+    # WMSのレイヤー（= ワークスペースのデータストアのスキーマのテーブル）の簡略化テーブルのうち、同じワークスペースに公開済みのもの
+    published = await workspace_layers(workspace_name)
+    schema_name = published.get(layer)
+    if schema_name is None:
+        return {}
+    return {zoom: name for zoom, name in (await alevels(schema_name, layer)).items() if published.get(name) == schema_name}
+
+
+async def wms_params(workspace_name: str, params: dict) -> dict:
+    # 低ズームのGetMapでは、LAYERSを簡略化レベルのレイヤーに置き換える（置き換えがなければそのまま返す）
+    if not config.PYRAMID_WMS:
+        return params
+    zoom = wms_zoom(params)
+    if zoom is None:
+        return params
+    key = next((key for key in params if key.lower() == "layers"), None)
+    if key is None:
+        return params
+
+    layers = []
+    for layer in params[key].split(","):
+        # 他のワークスペースのレイヤーを指定したもの（"<ワークスペース>:<レイヤー>"）は置き換えない
+        prefix, _, name = layer.rpartition(":")
+        level = None
+        if name and prefix in ("", workspace_name):
+            level = select_level(await layer_levels(workspace_name, name), zoom)
+        layers.append(f"{prefix}:{level}" if level and prefix else level or layer)
+    return {**params, key: ",".join(layers)}
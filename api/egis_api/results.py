@@ -0,0 +1,250 @@
+import hashlib
+import json
+import logging
+import threading
+
+from sqlalchemy import text
+
+from . import changes, config, jobs, planar
+from .database import engine, qualified_name
+
+logger = logging.getLogger(__name__)
+
+# 空間解析の結果を、操作・パラメータ・入力テーブルのバージョンをキーとして記録しておく
+# 初回は結果テーブル（と記録した時点のバージョン）を指すだけで複製せず、同じ入力で再実行された場合はそのテーブルを複製する
+# 2回目の要求で結果テーブルの複製を RESULT_CACHE_SCHEMA に保持し、以降は結果テーブルが変更・削除されても複製から作成する
+# 保持した複製の合計サイズと記録の数は RESULT_CACHE_MAX_BYTES・RESULT_CACHE_MAX_ENTRIES で抑え、超えた分は最後に使われた日時が古い記録から削除する
+# テーブルのバージョンは changes で記録・更新される（入力・出力になったテーブルを記録の対象にする）
+
+_SETUP_SQL = """
+CREATE TABLE IF NOT EXISTS {schema}.results (
+    key text PRIMARY KEY,
+    operation text NOT NULL,
+    parameters jsonb NOT NULL,
+    sources jsonb NOT NULL,
+    output_schema text NOT NULL,
+    output_table text NOT NULL,
+    output_version jsonb NOT NULL,
+    retained_table text,
+    planar_srid integer,
+    bytes bigint NOT NULL DEFAULT 0,
+    hits bigint NOT NULL DEFAULT 0,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_used_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+# 保持した複製が残っているか
+_RETAINED_SQL = "to_regclass(quote_ident({cache_schema}) || '.' || quote_ident({table_name})) IS NOT NULL"
+
+# 入力テーブルのバージョンが記録時から変わった結果と、結果テーブルが変更・削除され複製も保持していない結果
+_STALE_SQL = """
+SELECT r.key FROM {schema}.results r
+WHERE EXISTS (SELECT 1 FROM jsonb_array_elements(r.sources) AS s WHERE ({source_version}) IS DISTINCT FROM s -> 2)
+   OR (({output_version}) IS DISTINCT FROM r.output_version AND NOT coalesce({retained}, false))
+"""
+
+_ready = False
+_ready_lock = threading.Lock()
+
+
+def _schema() -> str:
+    return engine.dialect.identifier_preparer.quote(config.RESULT_CACHE_SCHEMA)
+
+
+def _drop_copies(connection):
+    # 以前の形式（結果を複製して保存していた）の記録があれば、複製したテーブルとともに削除する
+    copies = connection.execute(text("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = :schema_name AND table_name = 'results' AND column_name = 'table_name'
+    """), {"schema_name": config.RESULT_CACHE_SCHEMA}).first()
+    if copies is None:
+        return
+    for (table_name,) in connection.execute(text(f"SELECT table_name FROM {_schema()}.results")).all():
+        connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(config.RESULT_CACHE_SCHEMA, table_name)}"))
+    connection.execute(text(f"DROP TABLE {_schema()}.results"))
+
+
+def _setup():
+    # 管理用のテーブルを作成する（プロセスごとに1回）
+    global _ready
+    if _ready:
+        return
+    changes.setup()
+    with _ready_lock:
+        if not _ready:
+            with engine.connect() as setup_connection:
+                _drop_copies(setup_connection)
+                setup_connection.execute(text(_SETUP_SQL.format(schema=_schema())))
+                setup_connection.commit()
+            _ready = True
+
+
+def _versions(connection, sources) -> list:
+    # [スキーマ名, テーブル名, [バージョン, テーブルのOID]]（テーブルがなければ None）
+    return [[schema_name, table_name, changes.version(connection, schema_name, table_name)] for schema_name, table_name in sources]
+
+
+def _exists(versions: list) -> bool:
+    return all(version is not None for _, _, version in versions)
+
+
+def _key(operation: str, parameters: dict, versions: list) -> str:
+    document = json.dumps({"operation": operation, "parameters": parameters, "sources": versions}, sort_keys=True, default=str)
+    return hashlib.sha256(document.encode("utf-8")).hexdigest()
+
+
+def _normalize(parameters) -> dict:
+    # 結果のテーブル名は結果の内容に関係しないためキーに含めない
+    return {key: value for key, value in parameters.model_dump().items() if key != "new_table_name"}
+
+
+def _retained_name(key: str) -> str:
+    return f"result_{key[:40]}"
+
+
+def _copy(connection, source_schema: str, source_table: str, schema_name: str, table_name: str):
+    # テーブルを複製する（投影座標系の生成列は複製しない）
+    columns = [
+        row[0] for row in connection.execute(text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = :schema_name AND table_name = :table_name AND column_name <> :planar
+            ORDER BY ordinal_position
+        """), {"schema_name": source_schema, "table_name": source_table, "planar": planar.PLANAR_COLUMN})
+    ]
+    preparer = engine.dialect.identifier_preparer
+    connection.execute(text(f"""
+        CREATE TABLE {qualified_name(schema_name, table_name)} AS
+        SELECT {", ".join(preparer.quote(column) for column in columns)} FROM {qualified_name(source_schema, source_table)}
+    """))
+
+
+def _retain(connection, entry):
+    # 結果テーブルの複製を保持し、以降の要求ではそこから作成する
+    retained_table = _retained_name(entry.key)
+    connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(config.RESULT_CACHE_SCHEMA, retained_table)}"))
+    _copy(connection, entry.output_schema, entry.output_table, config.RESULT_CACHE_SCHEMA, retained_table)
+    srid = planar.planar_srid(connection, entry.output_schema, entry.output_table)
+    connection.execute(text(f"""
+        UPDATE {_schema()}.results SET retained_table = :retained_table, planar_srid = :srid,
+            bytes = pg_total_relation_size(to_regclass(:qualified_name))
+        WHERE key = :key
+    """), {"retained_table": retained_table, "srid": srid, "key": entry.key,
+           "qualified_name": qualified_name(config.RESULT_CACHE_SCHEMA, retained_table)})
+    return retained_table, srid
+
+
+def _restore(connection, entry, schema_name: str, new_table_name: str):
+    # 保持した複製（なければこの時点で保持する）から結果テーブルを作成する（投影座標系の生成列は複製後に付け直す）
+    if entry.retained_table is None:
+        retained_table, srid = _retain(connection, entry)
+    else:
+        retained_table, srid = entry.retained_table, entry.planar_srid
+    _copy(connection, config.RESULT_CACHE_SCHEMA, retained_table, schema_name, new_table_name)
+    if srid is not None:
+        planar.add_planar_column(connection, schema_name, new_table_name, srid)
+    connection.execute(text(f"UPDATE {_schema()}.results SET hits = hits + 1, last_used_at = now() WHERE key = :key"), {"key": entry.key})
+
+
+def _store(connection, key: str, operation: str, parameters: dict, versions: list, schema_name: str, new_table_name: str):
+    # 結果テーブルとその現在のバージョンを記録する（同じ入力の記録があれば、新しい結果テーブルを指すように置き換える）
+    changes.track(connection, [(schema_name, new_table_name)])
+    connection.execute(text(f"""
+        INSERT INTO {_schema()}.results (key, operation, parameters, sources, output_schema, output_table, output_version)
+        VALUES (:key, :operation, CAST(:parameters AS jsonb), CAST(:sources AS jsonb), :output_schema, :output_table, CAST(:output_version AS jsonb))
+        ON CONFLICT (key) DO UPDATE SET output_schema = EXCLUDED.output_schema, output_table = EXCLUDED.output_table,
+            output_version = EXCLUDED.output_version, created_at = now(), last_used_at = now()
+    """), {
+        "key": key, "operation": operation, "parameters": json.dumps(parameters, default=str), "sources": json.dumps(versions),
+        "output_schema": schema_name, "output_table": new_table_name,
+        "output_version": json.dumps(changes.version(connection, schema_name, new_table_name)),
+    })
+
+
+def over_budget(entries: list, max_bytes: int, max_entries: int) -> list:
+    # entries: 最後に使われた日時が新しい順の (キー, 保持した複製のサイズ)
+    # 新しいものから上限に収まる分だけ残し、それより古い記録のキーを返す
+    evicted = []
+    total = 0
+    for index, (key, size) in enumerate(entries):
+        total += size
+        if evicted or index >= max_entries or total > max_bytes:
+            evicted.append(key)
+    return evicted
+
+
+def _delete(connection, condition: str, params: dict = None) -> int:
+    # 記録を削除し、保持した複製も削除する
+    retained = connection.execute(text(f"DELETE FROM {_schema()}.results WHERE {condition} RETURNING retained_table"), params or {}).scalars().all()
+    for retained_table in retained:
+        if retained_table is not None:
+            connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(config.RESULT_CACHE_SCHEMA, retained_table)}"))
+    return len(retained)
+
+
+def evict(connection) -> int:
+    # 使えなくなった記録を1回の問い合わせで削除したうえで、上限を超えた分を最後に使われた日時が古いものから削除する
+    stale = _STALE_SQL.format(
+        schema=_schema(),
+        output_version=changes.VERSION_SQL.format(schema=_schema(), schema_name="r.output_schema", table_name="r.output_table"),
+        source_version=changes.VERSION_SQL.format(schema=_schema(), schema_name="s ->> 0", table_name="s ->> 1"),
+        retained=_RETAINED_SQL.format(cache_schema=":cache_schema", table_name="r.retained_table"),
+    )
+    removed = _delete(connection, f"key IN ({stale})", {"cache_schema": config.RESULT_CACHE_SCHEMA})
+    entries = connection.execute(text(f"SELECT key, bytes FROM {_schema()}.results ORDER BY last_used_at DESC")).all()
+    keys = over_budget([tuple(entry) for entry in entries], config.RESULT_CACHE_MAX_BYTES, config.RESULT_CACHE_MAX_ENTRIES)
+    if keys:
+        removed += _delete(connection, "key = ANY(:keys)", {"keys": keys})
+    return removed
+
+
+def memoize(operation: str, parameters, sources: list, compute, finish) -> bool:
+    # 同じ操作・パラメータ・入力テーブルのバージョンの結果テーブルが変更されずに残っていれば複製し、なければ compute() で計算する
+    # どちらの場合も finish() で結果テーブルを仕上げてから（バージョンが上がった後に）記録する
+    # 記録した結果を使った場合は True を返す
+    schema_name, new_table_name = parameters.schema_name, parameters.new_table_name
+    if not config.RESULT_CACHE_ENABLED:
+        compute()
+        finish()
+        return False
+
+    normalized = _normalize(parameters)
+    _setup()
+    with engine.connect() as connection:
+        # 計算中の入力の変更でキーが変わるように、バージョンを読む前に記録の対象にする
+        changes.track(connection, sources)
+        connection.commit()
+        versions = _versions(connection, sources)
+        key = _key(operation, normalized, versions)
+        # 複製を保持しているか、結果テーブルが記録時から変更されていなければ使える
+        output_version = changes.VERSION_SQL.format(schema=_schema(), schema_name="output_schema", table_name="output_table")
+        retained = _RETAINED_SQL.format(cache_schema=":cache_schema", table_name="retained_table")
+        entry = connection.execute(text(f"""
+            SELECT key, output_schema, output_table, planar_srid, CASE WHEN {retained} THEN retained_table END AS retained_table
+            FROM {_schema()}.results
+            WHERE key = :key AND (coalesce({retained}, false) OR ({output_version}) IS NOT DISTINCT FROM output_version)
+        """), {"key": key, "cache_schema": config.RESULT_CACHE_SCHEMA}).first()
+        if entry is not None and _exists(versions):
+            jobs.report(phase="restore")
+            _restore(connection, entry, schema_name, new_table_name)
+            evict(connection)
+            connection.commit()
+            finish()
+            return True
+        connection.commit()
+
+    compute()
+    finish()
+
+    # 入力テーブルが存在しない（計算が失敗するはずの）場合は記録しない
+    if not _exists(versions):
+        return False
+    try:
+        with engine.connect() as connection:
+            _store(connection, key, operation, normalized, versions, schema_name, new_table_name)
+            evict(connection)
+            connection.commit()
+    except Exception:
+        # 記録に失敗しても計算結果はそのまま返す
+        logger.warning("could not record the result of %s", operation, exc_info=True)
+    return False
@@ -0,0 +1,296 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from . import config, jobs, uploads
+
+logger = logging.getLogger(__name__)
+
+# 再開可能なアップロード
+# セッションごとに UPLOAD_SPOOL_DIR/sessions/<セッションID>/ を作成し、ファイル全体の大きさの data<拡張子> に
+# 受け取ったバイト範囲をそのまま書き込む。受信済みの範囲は session.json に記録し、複数のワーカープロセスからの
+# 同時書き込みはロックファイル（flock）で直列化する（データの書き込み自体は範囲が重ならないため並列に行う）
+
+UPLOADING = "uploading"
+IMPORTING = "importing"
+
+_SESSION_ID = re.compile(r"^[0-9a-f]{32}$")
+_CONTENT_RANGE = re.compile(r"^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+|\*)$")
+
+
+def _sessions_dir() -> str:
+    path = os.path.join(uploads.spool_dir(), "sessions")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _session_dir(session_id: str) -> str:
+    directory = os.path.join(_sessions_dir(), session_id)
+    if not _SESSION_ID.match(session_id) or not os.path.isdir(directory):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return directory
+
+
+def data_path(session: dict) -> str:
+    return os.path.join(_sessions_dir(), session["id"], "data" + session["suffix"])
+
+
+def _save(directory: str, session: dict):
+    # 書き込み途中の session.json を読まないように、一時ファイルに書いてから置き換える
+    path = os.path.join(directory, "session.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(session, f)
+    os.replace(path + ".tmp", path)
+
+
+@contextmanager
+def _locked(session_id: str):
+    # セッションをロックして読み込み、withブロックを抜けると保存する
+    directory = _session_dir(session_id)
+    with open(os.path.join(directory, "lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(os.path.join(directory, "session.json")) as f:
+                session = json.load(f)
+            yield session
+            session["updated_at"] = time.time()
+            _save(directory, session)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _merge(ranges: list, start: int, end: int) -> list:
+    # 受信済みの範囲（[開始, 終了) の昇順）に範囲を追加し、重なる・隣接する範囲をまとめる
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def _missing(session: dict) -> list:
+    missing, position = [], 0
+    for start, end in session["received"]:
+        if start > position:
+            missing.append([position, start])
+        position = end
+    if position < session["size"]:
+        missing.append([position, session["size"]])
+    return missing
+
+
+def status(session: dict) -> dict:
+    received = sum(end - start for start, end in session["received"])
+    missing = _missing(session)
+    return {
+        "upload_id": session["id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "state": session["state"],
+        "received_bytes": received,
+        # 受信済み・未受信の範囲は [開始, 終了) のバイト位置
+        "received": session["received"],
+        "missing": missing,
+        "complete": not missing,
+        "job_id": session.get("job_id"),
+    }
+
+
+def get(session_id: str) -> dict:
+    with _locked(session_id) as session:
+        return status(session)
+
+
+def create(filename: str, size: int) -> dict:
+    # ファイル全体の大きさの（疎な）ファイルを作成し、各チャンクはその位置に直接書き込む
+    collect_garbage()
+    if size < 0:
+        raise HTTPException(status_code=400, detail="size must not be negative")
+    if size > config.RESUMABLE_MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail="File is too large")
+    if shutil.disk_usage(_sessions_dir()).free < size:
+        raise HTTPException(status_code=507, detail="Not enough space in the upload spool")
+
+    now = time.time()
+    session = {
+        "id": uuid.uuid4().hex,
+        "filename": filename,
+        "suffix": os.path.splitext(filename)[1].lower(),
+        "size": size,
+        "state": UPLOADING,
+        "received": [],
+        "created_at": now,
+        "updated_at": now,
+    }
+    directory = os.path.join(_sessions_dir(), session["id"])
+    os.makedirs(directory)
+    with open(data_path(session), "wb") as f:
+        f.truncate(size)
+    _save(directory, session)
+    return status(session)
+
+
+def parse_range(content_range: Optional[str], size: int) -> tuple:
+    # Content-Range: bytes <開始>-<終了（含む）>/<全体の大きさ> -> [開始, 終了)
+    match = _CONTENT_RANGE.match(content_range or "")
+    if match is None:
+        raise HTTPException(status_code=400, detail="Content-Range must be 'bytes <start>-<end>/<size>'")
+    start, end = int(match.group("start")), int(match.group("end")) + 1
+    if match.group("total") != "*" and int(match.group("total")) != size:
+        raise HTTPException(status_code=400, detail="Content-Range size does not match the upload session")
+    if start >= end or end > size:
+        raise HTTPException(status_code=416, detail="Content-Range is outside the file")
+    if end - start > config.RESUMABLE_MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail="Chunk is too large")
+    return start, end
+
+
+async def write_range(session_id: str, content_range: Optional[str], checksum: Optional[str], stream) -> dict:
+    # 受け取ったバイト列をバッファリングしながら該当位置に書き込み、長さとSHA-256が一致した場合のみ受信済みとして記録する
+    # 一致しなかった範囲は記録されないため、クライアントは同じ範囲を送り直せばよい
+    with _locked(session_id) as session:
+        if session["state"] != UPLOADING:
+            raise HTTPException(status_code=409, detail="Upload session is already finalized")
+        start, end = parse_range(content_range, session["size"])
+    path = data_path(session)
+
+    digest = hashlib.sha256()
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        position, buffer = start, bytearray()
+
+        def flush(data: bytes, offset: int):
+            digest.update(data)
+            os.pwrite(fd, data, offset)
+
+        async for data in stream:
+            buffer += data
+            if position + len(buffer) > end:
+                raise HTTPException(status_code=400, detail="Request body is longer than Content-Range")
+            if len(buffer) >= config.UPLOAD_CHUNK_SIZE:
+                await run_in_threadpool(flush, bytes(buffer), position)
+                position += len(buffer)
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(flush, bytes(buffer), position)
+            position += len(buffer)
+    finally:
+        os.close(fd)
+
+    if position != end:
+        raise HTTPException(status_code=400, detail="Request body is shorter than Content-Range")
+    if checksum is not None and checksum.lower() != digest.hexdigest():
+        raise HTTPException(status_code=422, detail="Chunk checksum mismatch")
+
+    with _locked(session_id) as session:
+        if session["state"] != UPLOADING:
+            raise HTTPException(status_code=409, detail="Upload session is already finalized")
+        session["received"] = _merge(session["received"], start, end)
+        return status(session)
+
+
+def begin_import(session_id: str) -> dict:
+    # すべての範囲を受信済みであれば、インポート中の状態にする（インポート中は書き込み・削除を受け付けない）
+    with _locked(session_id) as session:
+        # APIサーバーの再起動などでジョブが失われた場合は、もう一度 finalize できる
+        if session["state"] == IMPORTING and _job_running(session.get("job_id")):
+            raise HTTPException(status_code=409, detail="Upload session is already finalized")
+        if _missing(session):
+            raise HTTPException(status_code=409, detail={"message": "Upload is incomplete", **status(session)})
+        session["state"] = IMPORTING
+        return dict(session)
+
+
+def set_job(session_id: str, job_id: str):
+    # ジョブが先に終わってセッションが削除されている場合は何もしない
+    try:
+        with _locked(session_id) as session:
+            session["job_id"] = job_id
+    except HTTPException:
+        pass
+
+
+def _verify(path: str, sha256: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(config.UPLOAD_CHUNK_SIZE), b""):
+            jobs.check_cancelled()
+            digest.update(data)
+    if digest.hexdigest() != sha256.lower():
+        raise HTTPException(status_code=422, detail="File checksum mismatch")
+
+
+def import_file(session: dict, sha256: Optional[str], import_fn, *args, **kwargs):
+    # ジョブとして実行する：ファイル全体のチェックサムを確認してから、既存のインポート関数にパスで渡す
+    # 成功した場合はセッションを削除し、失敗した場合は（release で）再度 finalize できる状態に戻す
+    path = data_path(session)
+    if sha256:
+        jobs.report(phase="verify")
+        _verify(path, sha256)
+    result = import_fn(path, *args, **kwargs)
+    remove(session["id"])
+    return result
+
+
+def release(session_id: str):
+    # インポートが失敗・取り消しされた場合に、セッションをアップロード中の状態に戻す
+    try:
+        with _locked(session_id) as session:
+            if session["state"] == IMPORTING:
+                session["state"] = UPLOADING
+    except HTTPException:
+        pass
+
+
+def remove(session_id: str):
+    shutil.rmtree(_session_dir(session_id), ignore_errors=True)
+
+
+def delete(session_id: str):
+    with _locked(session_id) as session:
+        if session["state"] == IMPORTING:
+            raise HTTPException(status_code=409, detail="Upload session is being imported")
+    remove(session_id)
+
+
+def _job_running(job_id: Optional[str]) -> bool:
+    if job_id is None:
+        return False
+    try:
+        return jobs.get(job_id).state not in jobs.FINISHED_STATES
+    except HTTPException:
+        return False
+
+
+def collect_garbage() -> int:
+    # RESUMABLE_SESSION_TTL 秒以上更新されていないセッションを削除する（インポート中のものを除く）
+    removed = 0
+    expires = time.time() - config.RESUMABLE_SESSION_TTL
+    for session_id in os.listdir(_sessions_dir()):
+        directory = os.path.join(_sessions_dir(), session_id)
+        try:
+            with open(os.path.join(directory, "session.json")) as f:
+                session = json.load(f)
+            updated_at = session["updated_at"]
+        except (OSError, ValueError, KeyError):
+            # 作成途中で中断されたセッションはディレクトリの更新日時で判定する
+            session, updated_at = {}, os.path.getmtime(directory) if os.path.isdir(directory) else time.time()
+        if updated_at < expires and not _job_running(session.get("job_id")):
+            shutil.rmtree(directory, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info("removed %d expired upload sessions", removed)
+    return removed
@@ -1,5 +1,9 @@
-from fastapi import APIRouter
-from ..database import engine
+from typing import List, Optional
+
+from fastapi import APIRouter, Query
+from ..database import async_engine, engine, qualified_name
+from ..catalog import catalog
+from .. import archives, changes, config, geoparquet, importers, jobs, pyramid, summary, uploads
 
 import os
 import tempfile
@@ -17,282 +21,189 @@ from sqlalchemy.sql.elements import quoted_name
 import pandas as pd
 import geopandas as gpd
 
-import fiona
-fiona.drvsupport.supported_drivers["FlatGeobuf"] = "rw"
-
 router = APIRouter()
 
+def _submit_import(kind: str, file: UploadFile, suffix: str, import_fn, schema_name: str, table_name: str, *args, **kwargs):
+    # アップロードファイルをディスクに書き出してジョブとして投入し、ファイルはジョブ終了後に削除する
+    path = uploads.spool_upload(file, suffix)
+    params = {"schema_name": schema_name, "table_name": table_name, "filename": file.filename}
+    job = jobs.submit(kind, params, import_fn, path, schema_name, table_name, *args, cleanup=lambda: uploads.remove(path), **kwargs)
+    return jobs.accepted(job)
+
 @router.get("/schemas")
-def get_schemas():
-    with engine.connect() as connection:
-        result = connection.execute(text("SELECT schema_name FROM information_schema.schemata"))
-        schemas = [row[0] for row in result.fetchall()]
-    return {"schemas": schemas}
+async def get_schemas():
+    return {"schemas": await catalog.aschemas()}
 
 @router.post("/create_schema/{schema_name}")
 def create_schema(schema_name: str):
     with engine.connect() as connection:
         connection.execute(text(f"CREATE SCHEMA {quoted_name(schema_name, quote=True)}"))
         connection.commit()
+    changes.schema_changed(schema_name)
     return {"message": f"Schema {schema_name} created successfully"}
 
 @router.get("/tables/{schema_name}")
-def get_tables(schema_name: str):
-    inspector = inspect(engine)
-    tables = inspector.get_table_names(schema=schema_name)
-    return {"tables": tables}
+async def get_tables(schema_name: str):
+    return {"tables": await catalog.atables(schema_name)}
 
 @router.get("/table/{schema_name}/{table_name}")
-def get_table(schema_name: str, table_name: str):
-    inspector = inspect(engine)
-    columns = inspector.get_columns(table_name, schema=schema_name)
+async def get_table(schema_name: str, table_name: str):
+    columns = await catalog.acolumns(schema_name, table_name)
     schema = {column['name']: str(column['type']) for column in columns}
 
-    with engine.connect() as connection:
-        query = text(f"SELECT * FROM {quoted_name(schema_name, quote=True)}.{quoted_name(table_name, quote=True)} LIMIT 10")
-        result = connection.execute(query)
+    async with async_engine.connect() as connection:
+        query = text(f"SELECT * FROM {qualified_name(schema_name, table_name)} LIMIT 10")
+        result = await connection.execute(query)
         rows = [list(row) for row in result.fetchall()]
 
     return {"schema": schema, "rows": rows}
 
+@router.get("/table/{schema_name}/{table_name}/summary")
+def get_table_summary(schema_name: str, table_name: str, preview: bool = False, preview_rows: int = Query(default=config.SUMMARY_PREVIEW_ROWS, ge=1, le=1000)):
+    # 件数・範囲・列の統計・ジオメトリの種類・サイズを全件走査せずに返す（テーブルが変更されるまでキャッシュ）
+    # preview=true の場合は先頭の行を簡略化したGeoJSONのジオメトリとともに返す
+    result = summary.summarize(schema_name, table_name)
+    if preview:
+        extent = result.get("geometry", {}).get("extent")
+        result = {**result, "preview": summary.preview(schema_name, table_name, extent, preview_rows)}
+    return result
+
 @router.post("/import/{schema_name}/{table_name}")
-async def import_data(schema_name: str, table_name: str, file: UploadFile = File(...)):
+def import_data(schema_name: str, table_name: str, copy_format: str = "csv", mode: str = "create", key: Optional[str] = None, background: bool = False, file: UploadFile = File(...)):
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="Invalid file format")
 
-    df = pd.read_csv(io.StringIO(file.file.read().decode('utf-8')))
-
-    metadata = MetaData()
+    if background:
+        return _submit_import("import_data", file, ".csv", importers.import_csv, schema_name, table_name, copy_format, mode=mode, key=key)
 
-    # Create a new table based on the CSV file
-    columns = []
-    for column_name, dtype in df.dtypes.items():
-        if dtype == 'int64':
-            columns.append(Column(column_name, Integer))
-        elif dtype == 'float64':
-            columns.append(Column(column_name, Float))
-        elif dtype == 'object':
-            columns.append(Column(column_name, String))
-        else:
-            columns.append(Column(column_name, NullType))
+    # アップロードファイルをディスクに書き出し、チャンク単位で読み込んで投入する
+    with uploads.spooled_upload(file, suffix=".csv") as path:
+        stats = importers.import_csv(path, schema_name, table_name, copy_format, mode=mode, key=key)
 
-    table = Table(table_name, metadata, *columns, schema=schema_name)
-    table.create(engine)
-
-    # Insert data into the table
-    data = df.to_dict(orient='records')
-    with engine.connect() as connection:
-        for row in data:
-            connection.execute(table.insert().values(**row))
-        connection.commit()
-
-    return {"message": "Data imported successfully"}
+    return {"message": "Data imported successfully", **stats}
 
 @router.post("/import_geojson/{schema_name}/{table_name}")
-async def import_geojson(schema_name: str, table_name: str, file: UploadFile = File(...)):
+def import_geojson(schema_name: str, table_name: str, copy_format: str = "csv", storage: str = "geography", generalize: bool = False,
+                   mode: str = "create", key: Optional[str] = None, background: bool = False, file: UploadFile = File(...)):
     if not file.filename.endswith('.geojson'):
         raise HTTPException(status_code=400, detail="Invalid file format")
 
-    # ファイルからGeoJSONを読み込む
-    geojson = json.loads(file.file.read().decode('utf-8'))
-    
-    # GeoDataFrameに変換
-    gdf = gpd.GeoDataFrame.from_features(geojson['features'])
-    
-    # GeoDataFrameにCRSが設定されていない場合、デフォルトでEPSG:4326を設定
-    if gdf.crs is None:
-        gdf.set_crs(epsg=4326, inplace=True)
-    else:
-        # 元のデータの座標系がEPSG:4326以外の場合、EPSG:4326に投影変換する
-        gdf = gdf.to_crs(epsg=4326)
-
-    srid = 4326  # WGS84
-
-    metadata = MetaData()
-
-    # 新しいテーブルを作成するための列を定義する
-    columns = [Column('id', Integer, primary_key=True),
-               Column('geometry', Geography('GEOMETRY', srid=srid))]
-
-    # GeoDataFrameのプロパティに基づいて列を追加する
-    if not gdf.empty:
-        for key, value in gdf.iloc[0].items():
-            if key != 'geometry':  # 'geometry'列は別途処理される
-                if pd.api.types.is_integer_dtype(value):
-                    columns.append(Column(key, Integer))
-                elif pd.api.types.is_float_dtype(value):
-                    columns.append(Column(key, Float))
-                else:
-                    columns.append(Column(key, String))
-
-    table = Table(table_name, metadata, *columns, schema=schema_name)
-    table.create(engine)
-
-    # テーブルにデータを挿入する
-    with engine.connect() as connection:
-        for _, row in gdf.iterrows():
-            geom = from_shape(row['geometry'], srid=srid) if row['geometry'] else None
-            row_data = row.drop('geometry').to_dict()
-            row_data['geometry'] = geom
-            connection.execute(table.insert().values(**row_data))
-        connection.commit()
+    if background:
+        return _submit_import("import_geojson", file, ".geojson", importers.import_vector, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
 
-        # 空間インデックスを作成
-        connection.execute(text(f"""
-            CREATE INDEX ON {quoted_name(schema_name, quote=True)}.{quoted_name(table_name, quote=True)} USING GIST (geometry);
-        """))
-        connection.commit()
+    # アップロードファイルをディスクに書き出し、バッチ単位で読み込んで投入する
+    with uploads.spooled_upload(file, suffix=".geojson") as path:
+        stats = importers.import_vector(path, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
 
-    return {"message": "GeoJSON data imported successfully"}
+    return {"message": "GeoJSON data imported successfully", **stats}
 
 @router.post("/import_shapefile/{schema_name}/{table_name}")
-async def import_shapefile(schema_name: str, table_name: str, file: UploadFile = File(...)):
+def import_shapefile(schema_name: str, table_name: str, copy_format: str = "csv", storage: str = "geography", generalize: bool = False,
+                     mode: str = "create", key: Optional[str] = None, background: bool = False, file: UploadFile = File(...)):
     if not file.filename.endswith('.zip'):
         raise HTTPException(status_code=400, detail="Invalid file format")
 
-    # Unzip the shapefile
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        with zipfile.ZipFile(io.BytesIO(file.file.read())) as zip_ref:
-            zip_ref.extractall(tmpdirname)
-        
-        # Recursively find the .shp file in the extracted files
-        shapefile_path = None
-        for root, dirs, files in os.walk(tmpdirname):
-            for filename in files:
-                if filename.endswith('.shp'):
-                    shapefile_path = os.path.join(root, filename)
-                    break
-            if shapefile_path:
-                break
-        
-        if shapefile_path is None:
-            raise HTTPException(status_code=400, detail="No .shp file found in the zip")
-
-        # Read the shapefile into a GeoDataFrame
-        gdf = gpd.read_file(shapefile_path)
-
-    # GeoDataFrameにCRSが設定されていない場合、デフォルトでEPSG:4326を設定
-    if gdf.crs is None:
-        gdf.set_crs(epsg=4326, inplace=True)
-    else:
-        # 元のデータの座標系がEPSG:4326以外の場合、EPSG:4326に投影変換する
-        gdf = gdf.to_crs(epsg=4326)
-
-    # Get the CRS from the GeoDataFrame
-    srid = 4326  # WGS84
-
-    metadata = MetaData()
-
-    # Create a new table with a geometry column and columns based on the GeoDataFrame
-    columns = [
-        Column('id', Integer, primary_key=True),
-        Column('geometry', Geography('GEOMETRY', srid=srid)),
-    ]
-
-    # Add columns based on the properties of the GeoDataFrame
-    for column_name, dtype in zip(gdf.columns, gdf.dtypes):
-        if dtype == 'int64':
-            columns.append(Column(column_name, Integer))
-        elif dtype == 'float':
-            columns.append(Column(column_name, Float))
-        elif dtype == 'object':
-            columns.append(Column(column_name, String))
-        elif dtype == 'geometry':
-            pass
-        else:
-            columns.append(Column(column_name, String))
-
-    table = Table(table_name, metadata, *columns, schema=schema_name)
-    table.create(engine)
-
-    # Insert data into the table
-    with engine.connect() as connection:
-        for index, row in gdf.iterrows():
-            geom = from_shape(row['geometry'], srid=srid) if row['geometry'] else None
-            row_data = row.to_dict()
-            row_data['geometry'] = geom
-            connection.execute(table.insert().values(**row_data))
-        connection.commit()
+    if background:
+        return _submit_import("import_shapefile", file, ".zip", importers.import_shapefile_zip, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
 
-        # 空間インデックスを作成
-        connection.execute(text(f"""
-            CREATE INDEX ON {quoted_name(schema_name, quote=True)}.{quoted_name(table_name, quote=True)} USING GIST (geometry);
-        """))
-        connection.commit()
+    with uploads.spooled_upload(file, suffix=".zip") as path:
+        stats = importers.import_shapefile_zip(path, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
 
-    return {"message": "Shapefile data imported successfully"}
+    return {"message": "Shapefile data imported successfully", **stats}
+
+@router.post("/import_archive/{schema_name}")
+def import_archive(schema_name: str, copy_format: str = "csv", storage: str = "geography", generalize: bool = False, mode: str = "create",
+                   key: Optional[str] = None, table_prefix: str = "", background: bool = False, file: UploadFile = File(...)):
+    # ZIP内のすべてのレイヤー（Shapefile・GeoJSON・FlatGeobuf・GeoPackageの各レイヤー）をレイヤーごとのテーブルに並列に取り込む
+    # テーブル名は table_prefix + レイヤー名（結果の results にレイヤーごとのテーブル名と件数が含まれる）
+    if not file.filename.endswith('.zip'):
+        raise HTTPException(status_code=400, detail="Invalid file format")
+
+    if background:
+        path = uploads.spool_upload(file, ".zip")
+        params = {"schema_name": schema_name, "filename": file.filename, "table_prefix": table_prefix}
+        job = jobs.submit("import_archive", params, archives.import_archive, path, schema_name, copy_format, storage, generalize=generalize,
+                          mode=mode, key=key, table_prefix=table_prefix, cleanup=lambda: uploads.remove(path))
+        return jobs.accepted(job)
+
+    with uploads.spooled_upload(file, suffix=".zip") as path:
+        result = archives.import_archive(path, schema_name, copy_format, storage, generalize=generalize, mode=mode, key=key, table_prefix=table_prefix)
+
+    return {"message": "Archive imported successfully", **result}
+
+# プレビューできるファイルの拡張子 -> (一時ファイルの拡張子, フォーマット)
+PREVIEW_FORMATS = {
+    ".csv": (".csv", "csv"),
+    ".geojson": (".geojson", "vector"),
+    ".fgb": (".fgb", "vector"),
+    ".zip": (".zip", "shapefile"),
+    ".parquet": (".parquet", "geoparquet"),
+}
+
+@router.post("/preview_schema")
+def preview_schema(file: UploadFile = File(...)):
+    # インポート前に、推定される列の型を確認する
+    extension = os.path.splitext(file.filename)[1].lower()
+    if extension not in PREVIEW_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid file format")
+
+    suffix, file_format = PREVIEW_FORMATS[extension]
+    with uploads.spooled_upload(file, suffix=suffix) as path:
+        # GeoParquetは推定せずにファイルのArrowスキーマから列の型を決める
+        if file_format == "geoparquet":
+            return geoparquet.describe(path)
+        return importers.preview_schema(path, file_format)
 
 @router.delete("/table/{schema_name}/{table_name}")
 def delete_table(schema_name: str, table_name: str):
-    inspector = inspect(engine)
-    tables = inspector.get_table_names(schema=schema_name)
-    if table_name not in tables:
+    if not catalog.has_table(schema_name, table_name):
         raise HTTPException(status_code=400, detail="Table not found")
 
-    metadata = MetaData()
-    table = Table(table_name, metadata, autoload_with=engine, schema=schema_name)
-    table.drop(engine)
+    # 列定義を読み込まずにそのまま削除する（簡略化テーブルも併せて削除する）
+    with engine.connect() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(schema_name, table_name)}"))
+        levels = pyramid.drop(connection, schema_name, table_name)
+        connection.commit()
+    for name in [table_name, *levels]:
+        changes.table_changed(schema_name, name)
     return {"message": f"Table {table_name} deleted successfully"}
 
 @router.post("/import_flatgeobuf/{schema_name}/{table_name}")
-async def import_flatgeobuf(schema_name: str, table_name: str, background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+def import_flatgeobuf(schema_name: str, table_name: str, copy_format: str = "csv", storage: str = "geography", generalize: bool = False,
+                      mode: str = "create", key: Optional[str] = None, background: bool = False, file: UploadFile = File(...)):
     if not file.filename.endswith('.fgb'):
         raise HTTPException(status_code=400, detail="Invalid file format")
 
-    # 一時ファイルとしてFlatGeobufファイルを保存
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".fgb") as tmpfile:
-        contents = await file.read()
-        tmpfile.write(contents)
-        tmpfile_path = tmpfile.name
-
-    # 一時ファイルからGeoDataFrameを読み込む
-    gdf = gpd.read_file(tmpfile_path)
-
-    # GeoDataFrameにCRSが設定されていない場合、デフォルトでEPSG:4326を設定
-    if gdf.crs is None:
-        gdf.set_crs(epsg=4326, inplace=True)
-    else:
-        # 元のデータの座標系がEPSG:4326以外の場合、EPSG:4326に投影変換する
-        gdf = gdf.to_crs(epsg=4326)
-
-    srid = 4326  # WGS84
-
-    metadata = MetaData()
-
-    # 新しいテーブルを作成するための列を定義する
-    columns = [Column('id', Integer, primary_key=True),
-               Column('geometry', Geography('GEOMETRY', srid=srid))]
-
-    # GeoDataFrameのプロパティに基づいて列を追加する
-    if not gdf.empty:
-        for key, value in gdf.iloc[0].items():
-            if key != 'geometry':  # 'geometry'列は別途処理される
-                if pd.api.types.is_integer_dtype(value):
-                    columns.append(Column(key, Integer))
-                elif pd.api.types.is_float_dtype(value):
-                    columns.append(Column(key, Float))
-                else:
-                    columns.append(Column(key, String))
-
-    table = Table(table_name, metadata, *columns, schema=schema_name)
-    table.create(engine)
-
-    # テーブルにデータを挿入する
-    with engine.connect() as connection:
-        for _, row in gdf.iterrows():
-            geom = from_shape(row['geometry'], srid=srid) if row['geometry'] else None
-            row_data = row.drop('geometry').to_dict()
-            row_data['geometry'] = geom
-            connection.execute(table.insert().values(**row_data))
-        connection.commit()
+    if background:
+        return _submit_import("import_flatgeobuf", file, ".fgb", importers.import_vector, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
 
-        # 空間インデックスを作成
-        connection.execute(text(f"""
-            CREATE INDEX ON {quoted_name(schema_name, quote=True)}.{quoted_name(table_name, quote=True)} USING GIST (geometry);
-        """))
-        connection.commit()
+    # 一時ファイルとしてFlatGeobufファイルを保存し、バッチ単位で読み込んで投入する
+    with uploads.spooled_upload(file, suffix=".fgb") as path:
+        stats = importers.import_vector(path, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
+
+    return {"message": "FlatGeobuf data imported successfully", **stats}
+
+@router.post("/import_geoparquet/{schema_name}/{table_name}")
+def import_geoparquet(schema_name: str, table_name: str, copy_format: str = "binary", storage: str = "geography", generalize: bool = False,
+                      mode: str = "create", key: Optional[str] = None, background: bool = False, file: UploadFile = File(...)):
+    if not file.filename.endswith('.parquet'):
+        raise HTTPException(status_code=400, detail="Invalid file format")
+
+    if background:
+        return _submit_import("import_geoparquet", file, ".parquet", geoparquet.import_geoparquet, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
 
-    # 一時ファイルを削除するタスクを追加
-    background_tasks.add_task(os.unlink, tmpfile_path)
+    # 行グループ単位で読み込み、WKBのままCOPYで投入する
+    with uploads.spooled_upload(file, suffix=".parquet") as path:
+        stats = geoparquet.import_geoparquet(path, schema_name, table_name, copy_format, storage, generalize=generalize, mode=mode, key=key)
 
-    return {"message": "FlatGeobuf data imported successfully"}
+    return {"message": "GeoParquet data imported successfully", **stats}
+
+@router.post("/generalize/{schema_name}/{table_name}")
+def generalize_table(schema_name: str, table_name: str, zooms: Optional[List[int]] = Query(None), background: bool = False):
+    # 低ズーム描画用の簡略化テーブルを作成する（既存のレベルは作り直す）
+    if not catalog.has_table(schema_name, table_name):
+        raise HTTPException(status_code=400, detail="Table not found")
+    if background:
+        params = {"schema_name": schema_name, "table_name": table_name, "zooms": zooms}
+        return jobs.accepted(jobs.submit("generalize", params, pyramid.build, schema_name, table_name, zooms))
+    return {"message": f"Generalized levels of {table_name} created successfully", **pyramid.build(schema_name, table_name, zooms)}
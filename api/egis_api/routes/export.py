@@ -0,0 +1,52 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import FileResponse
+from starlette.background import BackgroundTask
+
+from .. import exporters, feature_query, uploads
+
+router = APIRouter()
+
+# 出力フォーマット（拡張子, Content-Type）
+EXPORT_FORMATS = {
+    "fgb": (".fgb", "application/flatgeobuf"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "gpkg": (".gpkg", "application/geopackage+sqlite3"),
+}
+
+@router.get("/export/{schema_name}/{table_name}")
+def export_table(
+    schema_name: str,
+    table_name: str,
+    format: str = "fgb",
+    bbox: Optional[str] = None,
+    columns: Optional[str] = None,
+    where: List[str] = Query(default=[]),
+):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported format")
+
+    table_columns = feature_query.table_columns(schema_name, table_name)
+    select_columns = feature_query.attribute_columns(table_columns, columns)
+    # FlatGeobufの空間インデックスはNULLジオメトリを扱えないため、fgbではジオメトリのない行を除く
+    query, params = feature_query.build_query(schema_name, table_name, table_columns, select_columns, "ST_AsBinary(t.geometry)",
+                                              bbox=bbox, where=where, skip_null_geometry=format == "fgb")
+
+    # サーバーサイドカーソルでチャンク単位に読み込み、一時ファイルへ書き出してから送信する
+    suffix, media_type = EXPORT_FORMATS[format]
+    path = exporters.spool_path(suffix)
+    partitions = feature_query.stream_rows(query, params)
+    try:
+        if format == "fgb":
+            # パックドHilbert R-treeの空間インデックスを付与（範囲読み込みに使われる）
+            exporters.write_fiona(path, "FlatGeobuf", partitions, exporters.fiona_schema(table_columns, select_columns), layer=table_name, SPATIAL_INDEX="YES")
+        elif format == "gpkg":
+            exporters.write_fiona(path, "GPKG", partitions, exporters.fiona_schema(table_columns, select_columns), layer=table_name)
+        else:
+            exporters.write_parquet(path, partitions, table_columns, select_columns)
+    except Exception:
+        uploads.remove(path)
+        raise
+
+    return FileResponse(path, media_type=media_type, filename=f"{table_name}{suffix}", background=BackgroundTask(uploads.remove, path))
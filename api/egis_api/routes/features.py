@@ -0,0 +1,42 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from .. import feature_query, flatgeobuf
+
+router = APIRouter()
+
+@router.get("/features/{schema_name}/{table_name}")
+def get_features(
+    schema_name: str,
+    table_name: str,
+    bbox: Optional[str] = None,
+    intersects: Optional[str] = None,
+    columns: Optional[str] = None,
+    where: List[str] = Query(default=[]),
+    after_id: Optional[int] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
+    format: str = "geojsonl",
+):
+    # bbox/intersects: EPSG:4326の範囲で絞り込み（GiSTインデックスを使用）
+    # where: 列名:演算子:値（例: where=pop:gt:1000）
+    # after_id/limit: id列によるキーセットページネーション（次ページは最後に受け取ったidをafter_idに指定）
+    table_columns = feature_query.table_columns(schema_name, table_name)
+    select_columns = feature_query.attribute_columns(table_columns, columns)
+    if 'id' in table_columns and 'id' not in select_columns:
+        select_columns = ['id'] + select_columns
+    filters = dict(bbox=bbox, intersects=intersects, where=where, after_id=after_id, limit=limit)
+
+    if format == "geojsonl":
+        query, params = feature_query.build_query(schema_name, table_name, table_columns, select_columns, "ST_AsGeoJSON(t.geometry)", **filters)
+        return StreamingResponse(feature_query.geojsonl_lines(query, params), media_type="application/x-ndjson")
+
+    if format == "fgb":
+        # 空間インデックスなしのFlatGeobufを、取得した行のまとまりごとに生成しながら送信する
+        query, params = feature_query.build_query(schema_name, table_name, table_columns, select_columns, "ST_AsBinary(t.geometry)", **filters)
+        columns = [(column, table_columns[column]) for column in select_columns]
+        return StreamingResponse(flatgeobuf.stream(feature_query.stream_rows(query, params), table_name, columns), media_type="application/flatgeobuf",
+                                 headers={"Content-Disposition": f'attachment; filename="{table_name}.fgb"'})
+
+    raise HTTPException(status_code=400, detail="Unsupported format")
@@ -5,13 +5,15 @@ import asyncio
 import shutil
 from tempfile import TemporaryDirectory
 
+from typing import List, Optional
+
 from fastapi import APIRouter, HTTPException, BackgroundTasks, File, UploadFile
-from sqlalchemy import inspect, text
-from sqlalchemy.sql.elements import quoted_name
+from sqlalchemy import text
 from pydantic import BaseModel
-from .. import config
+from .. import changes, citygml, config, jobs, maintenance, metrics, overlay, planar, results, spatial_join, uploads
 
-from ..database import engine
+from ..catalog import catalog
+from ..database import engine, qualified_name
 
 router = APIRouter()
 
@@ -34,9 +36,32 @@ class EraseParameters(BaseModel):
     eraser_table_name: str  # イレースするレイヤーのテーブル名
     new_table_name: str  # 結果を格納する新しいテーブル名
 
+class Aggregate(BaseModel):
+    function: str  # count / sum / avg / min / max
+    column: Optional[str] = None  # 集計する列（count では省略可）
+    alias: Optional[str] = None  # 結果の列名（省略時は <function>_<column>）
+
+class SpatialJoinParameters(BaseModel):
+    schema_name: str  # スキーマ名
+    target_table_name: str  # 結果の各行になるレイヤーのテーブル名（例: 区画ポリゴン）
+    join_table_name: str  # 集計されるレイヤーのテーブル名（例: ポイント）
+    predicate: str = "intersects"  # intersects / within / dwithin / nearest
+    distance: Optional[float] = None  # dwithin の距離、nearest の最大距離（メートル）
+    k: int = 1  # nearest で集計する近傍フィーチャーの数
+    aggregates: List[Aggregate] = [Aggregate(function="count")]
+    keep_unmatched: bool = True  # 結合するフィーチャーがない対象フィーチャーも出力する
+    new_table_name: str  # 結果を格納する新しいテーブル名
+
 # 空間解析
 @router.post("/create_buffer")
-def create_buffer(buffer_parameters: BufferParameters):
+def create_buffer(buffer_parameters: BufferParameters, background: bool = False):
+    # background=true の場合はジョブとして投入し、ジョブIDをすぐに返す
+    if background:
+        return jobs.accepted(jobs.submit("create_buffer", buffer_parameters.model_dump(), run_buffer, buffer_parameters))
+    return run_buffer(buffer_parameters)
+
+@metrics.operation("buffer")
+def run_buffer(buffer_parameters: BufferParameters):
     schema_name = buffer_parameters.schema_name
     table_name = buffer_parameters.table_name
     distance = buffer_parameters.distance
@@ -52,144 +77,134 @@ def create_buffer(buffer_parameters: BufferParameters):
         # サポートされていない単位が指定された場合はエラーを返す
         raise HTTPException(status_code=400, detail="Unsupported unit")
 
-    # 既存テーブルから列名を取得
-    inspector = inspect(engine)
-    columns = [column['name'] for column in inspector.get_columns(table_name, schema=schema_name) if column['name'] != 'geometry']
+    # 既存テーブルから列名を取得（投影座標系の列は結果テーブルで計算し直す）
+    columns = [column['name'] for column in catalog.columns(schema_name, table_name) if column['name'] not in ('geometry', planar.PLANAR_COLUMN)]
 
     # 列名リストからSQLクエリのSELECT部分を生成
     select_columns = ', '.join([f'"{col}"' for col in columns])
 
-    with engine.connect() as connection:
-        # 新しいテーブルを作成
-        connection.execute(
-            text(f"""
-                CREATE TABLE {quoted_name(schema_name, quote=True)}.{quoted_name(new_table_name, quote=True)} AS
-                SELECT 
-                    {select_columns}, 
-                    ST_Buffer(geometry, {distance_expr}) AS geometry
-                FROM {quoted_name(schema_name, quote=True)}.{quoted_name(table_name, quote=True)}
-            """))
-        # 空間インデックスを作成
-        connection.execute(text(f"""
-            CREATE INDEX ON {quoted_name(schema_name, quote=True)}.{quoted_name(new_table_name, quote=True)} USING GIST (geometry);
-        """))
-        connection.commit()
-    return {"message": f"バッファが作成され、{new_table_name}に格納されました。"}
+    def compute():
+        with engine.connect() as connection, jobs.tracked_connection(connection):
+            jobs.report(phase="buffer")
+            srid = planar.planar_srid(connection, schema_name, table_name)
+            if srid is None:
+                # 新しいテーブルを作成
+                connection.execute(
+                    text(f"""
+                        CREATE TABLE {qualified_name(schema_name, new_table_name)} AS
+                        SELECT 
+                            {select_columns}, 
+                            ST_Buffer(geometry, {distance_expr}) AS geometry
+                        FROM {qualified_name(schema_name, table_name)}
+                    """))
+            else:
+                # 投影座標系の列があれば、回転楕円体上の計算を避けて平面上でメートル単位のバッファを作成する
+                connection.execute(text(f"""
+                    CREATE TABLE {qualified_name(schema_name, new_table_name)} AS
+                    SELECT {select_columns}, geometry
+                    FROM {qualified_name(schema_name, table_name)}
+                    WITH NO DATA
+                """))
+                planar.add_planar_column(connection, schema_name, new_table_name, srid)
+                connection.execute(
+                    text(f"""
+                        INSERT INTO {qualified_name(schema_name, new_table_name)} ({select_columns}, geometry)
+                        SELECT 
+                            {select_columns}, 
+                            ST_Transform(ST_Buffer({planar.PLANAR_COLUMN}, :distance), 4326)::geography
+                        FROM {qualified_name(schema_name, table_name)}
+                    """), {"distance": distance_expr})
+            connection.commit()
+
+    # 同じ入力テーブル・パラメータの結果が保存されていれば、計算せずに複製する
+    cached = results.memoize("buffer", buffer_parameters, [(schema_name, table_name)], compute, lambda: _finalize(schema_name, new_table_name))
+    return {"message": f"バッファが作成され、{new_table_name}に格納されました。", "cached": cached}
 
 
 @router.post("/clip")
-def clip_feature(clip_parameters: ClipParameters):
+def clip_feature(clip_parameters: ClipParameters, background: bool = False):
+    if background:
+        return jobs.accepted(jobs.submit("clip", clip_parameters.model_dump(), run_clip, clip_parameters))
+    return run_clip(clip_parameters)
+
+@metrics.operation("clip")
+def run_clip(clip_parameters: ClipParameters):
     # パラメータから値を取得
     schema_name = clip_parameters.schema_name
     clippee_table = clip_parameters.clippee_table_name
     clipper_table = clip_parameters.clipper_table_name
     new_table_name = clip_parameters.new_table_name
 
-    # 既存テーブルから列名を取得
-    inspector = inspect(engine)
-    columns = [column['name'] for column in inspector.get_columns(clippee_table, schema=schema_name) if column['name'] != 'geometry']
-
-    # 列名リストからSQLクエリのSELECT部分を生成
-    select_columns = ', '.join([f'a."{col}"' for col in columns])
-
-    with engine.connect() as connection:
-        # クリップ機能を実行するSQLクエリ
-        connection.execute(
-            text(f"""
-                CREATE TABLE {schema_name}.{new_table_name} AS
-                SELECT 
-                    {select_columns}, 
-                    ST_Intersection(a.geometry, b.geometry) AS geometry
-                FROM 
-                    {schema_name}.{clippee_table} AS a,
-                    {schema_name}.{clipper_table} AS b
-                WHERE 
-                    ST_Intersects(a.geometry, b.geometry);
-            """))
-        # 空間インデックスを作成
-        connection.execute(text(f"""
-            CREATE INDEX ON {schema_name}.{new_table_name} USING GIST (geometry);
-        """))
-        connection.commit()
-    return {"message": f"クリップが完了し、結果が{new_table_name}に格納されました。"}
+    # クリップ側を分割したうえで、空間区画ごとに並列に処理する（入力フィーチャー1件につき最大1行）
+    cached = results.memoize("clip", clip_parameters, [(schema_name, clippee_table), (schema_name, clipper_table)],
+                             lambda: overlay.clip(schema_name, clippee_table, clipper_table, new_table_name),
+                             lambda: _finalize(schema_name, new_table_name))
+    return {"message": f"クリップが完了し、結果が{new_table_name}に格納されました。", "cached": cached}
 
 
 @router.post("/erase")
-def erase_feature(erase_parameters: EraseParameters):
+def erase_feature(erase_parameters: EraseParameters, background: bool = False):
+    if background:
+        return jobs.accepted(jobs.submit("erase", erase_parameters.model_dump(), run_erase, erase_parameters))
+    return run_erase(erase_parameters)
+
+@metrics.operation("erase")
+def run_erase(erase_parameters: EraseParameters):
     # パラメータから値を取得
     schema_name = erase_parameters.schema_name
     erasee_table = erase_parameters.erasee_table_name
     eraser_table = erase_parameters.eraser_table_name
     new_table_name = erase_parameters.new_table_name
 
-    # 既存テーブルから列名を取得
-    inspector = inspect(engine)
-    columns = [column['name'] for column in inspector.get_columns(erasee_table, schema=schema_name) if column['name'] != 'geometry']
-
-    # 列名リストからSQLクエリのSELECT部分を生成
-    select_columns = ', '.join([f'a."{col}"' for col in columns])
-
-    # イレース機能を実行するSQLクエリ
-    # 1つのクエリで処理を行う
-    optimized_query = f"""
-        CREATE TABLE {schema_name}.{new_table_name} AS
-        SELECT 
-            {select_columns}, 
-            CASE 
-                WHEN ST_Intersects(a.geometry, b.geometry) THEN ST_Difference(a.geometry::geometry, b.geometry::geometry)::geography
-                ELSE a.geometry
-            END AS geometry
-        FROM 
-            {schema_name}.{erasee_table} AS a
-        LEFT JOIN 
-            {schema_name}.{eraser_table} AS b ON ST_Intersects(a.geometry, b.geometry);
-    """
-
+    # イレース側を分割したうえで、空間区画ごとに並列に処理する
+    # 重なるイレース側ポリゴンはフィーチャーごとに結合してから差分を取るため、入力フィーチャー1件につき最大1行になる
+    cached = results.memoize("erase", erase_parameters, [(schema_name, erasee_table), (schema_name, eraser_table)],
+                             lambda: overlay.erase(schema_name, erasee_table, eraser_table, new_table_name),
+                             lambda: _finalize(schema_name, new_table_name))
+    return {"message": f"イレースが完了し、結果が{new_table_name}に格納されました。", "cached": cached}
+
+@router.post("/spatial_join")
+def create_spatial_join(spatial_join_parameters: SpatialJoinParameters, background: bool = False):
+    if background:
+        return jobs.accepted(jobs.submit("spatial_join", spatial_join_parameters.model_dump(), run_spatial_join, spatial_join_parameters))
+    return run_spatial_join(spatial_join_parameters)
+
+@metrics.operation("spatial_join")
+def run_spatial_join(spatial_join_parameters: SpatialJoinParameters):
+    schema_name = spatial_join_parameters.schema_name
+    target_table = spatial_join_parameters.target_table_name
+    join_table = spatial_join_parameters.join_table_name
+    new_table_name = spatial_join_parameters.new_table_name
+
+    # 対象レイヤーの空間区画ごとに、結合レイヤーをGiSTインデックスで探して集計する
+    cached = results.memoize("spatial_join", spatial_join_parameters, [(schema_name, target_table), (schema_name, join_table)], lambda: spatial_join.spatial_join(
+        schema_name,
+        target_table,
+        join_table,
+        new_table_name,
+        predicate=spatial_join_parameters.predicate,
+        aggregates=[aggregate.model_dump() for aggregate in spatial_join_parameters.aggregates],
+        distance=spatial_join_parameters.distance,
+        k=spatial_join_parameters.k,
+        keep_unmatched=spatial_join_parameters.keep_unmatched,
+    ), lambda: _finalize(schema_name, new_table_name))
     with engine.connect() as connection:
-        connection.execute(text(optimized_query))
-        # 空間インデックスを作成
-        connection.execute(text(f"""
-            CREATE INDEX ON {schema_name}.{new_table_name} USING GIST (geometry);
-        """))
+        rows = connection.execute(text(f"SELECT count(*) FROM {qualified_name(schema_name, new_table_name)}")).scalar()
+    return {"message": f"空間結合が完了し、結果が{new_table_name}に格納されました。", "rows": rows, "cached": cached}
+
+def _finalize(schema_name: str, table_name: str):
+    # 結果テーブルもインポートと同様に並べ替え・インデックス作成・統計情報の更新を行い、変更を通知する
+    # （結果のキャッシュは通知後のバージョンを記録するため、results.memoize から呼び出す）
+    with engine.connect() as connection, jobs.tracked_connection(connection):
+        maintenance.finalize(connection, schema_name, table_name)
         connection.commit()
-
-    return {"message": f"イレースが完了し、結果が{new_table_name}に格納されました。"}
-
-def import_citygml_to_3dcitydb(citygml_file_path: str):
-    # Importer/Exporter CLIコマンドの構築
-    command = [
-        "impexp", "import",
-        "-H", config.DB_HOST,
-        "-P", config.DB_PORT,
-        "-d", config.DB_NAME,
-        "-u", config.DB_USER_NAME,
-        "-p", config.DB_USER_PASS,
-        citygml_file_path
-    ]
-    
-    # コマンドの実行
-    result = subprocess.run(command, capture_output=True, text=True)
-    
-    if result.returncode != 0:
-        raise HTTPException(status_code=500, detail=f"CityGML import failed: {result.stderr}")
-    
-    return result.stdout
+    changes.table_changed(schema_name, table_name)
 
 @router.post("/import_citygml")
-async def import_citygml(file: UploadFile = File(...)):
-    background_tasks = BackgroundTasks()
-    
-    # 一時ディレクトリの作成
-    with TemporaryDirectory() as temp_dir:
-        # ZIPファイルの保存先パス
-        zip_path = os.path.join(temp_dir, file.filename)
-        
-        # ZIPファイルの保存
-        with open(zip_path, 'wb') as f:
-            f.write(await file.read())
-        
-        # 同期処理でCityGMLインポート処理を実行
-        import_citygml_to_3dcitydb(zip_path)
-    
-    # 一時ディレクトリはwithブロックを抜けると自動的に削除されます
-    return {"message": "CityGML import started successfully."}
+def import_citygml(file: UploadFile = File(...)):
+    # ZIPファイルをディスクに書き出し、インポートはジョブとして実行する（タイルごとの進捗は /jobs/{job_id} で確認できる）
+    # 一時ファイルはジョブの終了時に削除される
+    zip_path = uploads.spool_upload(file, suffix=os.path.splitext(file.filename)[1])
+    job = jobs.submit("import_citygml", {"filename": file.filename}, citygml.import_archive, zip_path, cleanup=lambda: uploads.remove(zip_path))
+
+    return {**jobs.accepted(job), "message": "CityGML import started successfully."}
@@ -1,10 +1,25 @@
-import requests
-from fastapi import  HTTPException, APIRouter
+import asyncio
+from typing import List, Optional
 
-from .. import config
+from fastapi import  HTTPException, APIRouter, Query
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from starlette.concurrency import run_in_threadpool
+
+from .. import config, geoserver_client, maintenance, planar, pyramid, tilecache
+from ..database import engine, qualified_name
 
 router = APIRouter()
 
+WORLD_BBOX = (-180, -90, 180, 90)
+
+class PublishParameters(BaseModel):
+    workspace_name: str
+    datastore_name: str
+    table_names: List[str]
+    schema_name: Optional[str] = None  # 省略した場合はデータストアの接続設定から取得する
+
 @router.post("/create_workspace/")
 async def create_workspace(workspace_name: str):
     headers = {'Content-type': 'text/xml'}
@@ -14,8 +29,7 @@ async def create_workspace(workspace_name: str):
 </workspace>
 """
 
-    url = f"{config.GEOSERVER_URL}/rest/workspaces"
-    response = requests.post(url, headers=headers, data=workspace_xml, auth=(config.GEOSERVER_USER_NAME, config.GEOSERVER_USER_PASS))
+    response = await geoserver_client.request("POST", "/rest/workspaces", headers=headers, content=workspace_xml)
 
     if response.status_code == 201:
         return {"message": "ワークスペースが正常に作成されました。"}
@@ -41,8 +55,7 @@ async def create_datastore(workspace_name: str, datastore_name: str, schema_name
 </dataStore>
 """
 
-    url = f"{config.GEOSERVER_URL}/rest/workspaces/{workspace_name}/datastores"
-    response = requests.post(url, headers=headers, data=datastore_xml, auth=(config.GEOSERVER_USER_NAME, config.GEOSERVER_USER_PASS))
+    response = await geoserver_client.request("POST", f"/rest/workspaces/{workspace_name}/datastores", headers=headers, content=datastore_xml)
 
     if response.status_code == 201:
         return {"message": "データストアが正常に作成されました。"}
@@ -50,45 +63,162 @@ async def create_datastore(workspace_name: str, datastore_name: str, schema_name
         raise HTTPException(status_code=400, detail=f"データストアの作成に失敗しました。ステータスコード: {response.status_code}, メッセージ: {response.text}")
 
 
-@router.post("/publish_service/")
-async def publish_service(workspace_name: str, datastore_name: str, table_name: str):
+def _estimated_extent(connection, schema_name: str, table_name: str, column: str, srid: int):
+    # 統計情報から推定した範囲をEPSG:4326に変換する（統計情報がない ANALYZE 前のテーブルでは None）
+    try:
+        with connection.begin_nested():
+            return connection.execute(text("""
+                SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+                FROM (SELECT ST_Transform(ST_SetSRID(ST_EstimatedExtent(:schema_name, :table_name, :column)::geometry, :srid), 4326) AS e) AS extent
+            """), {"schema_name": schema_name, "table_name": table_name, "column": column, "srid": srid}).first()
+    except DBAPIError:
+        return None
+
+
+def _table_extent(schema_name: str, table_name: str):
+    # テーブルの範囲（EPSG:4326）。geometry列は統計情報からの推定値を使う
+    # geography列の統計情報は地心座標で持たれるため、インポート時に記録した範囲か、投影座標系の列の統計情報を使う
+    with engine.connect() as connection:
+        srid = connection.execute(text("""
+            SELECT srid FROM geometry_columns
+            WHERE f_table_schema = :schema_name AND f_table_name = :table_name AND f_geometry_column = 'geometry'
+        """), {"schema_name": schema_name, "table_name": table_name}).scalar()
+        planar_srid = planar.planar_srid(connection, schema_name, table_name)
+        extent = None
+        if srid is not None:
+            extent = _estimated_extent(connection, schema_name, table_name, "geometry", srid or 4326)
+        elif connection.execute(text("SELECT to_regclass(:table) IS NOT NULL"), {"table": qualified_name(schema_name, table_name)}).scalar():
+            extent = maintenance.recorded_extent(connection, schema_name, table_name)
+            if extent is None and planar_srid is not None:
+                extent = _estimated_extent(connection, schema_name, table_name, planar.PLANAR_COLUMN, planar_srid)
+            if extent is None or extent[0] is None:
+                # 範囲を記録する前に作成されたテーブルは一度だけ全件から求めて記録する
+                maintenance.record_extent(connection, schema_name, table_name)
+                connection.commit()
+                extent = maintenance.recorded_extent(connection, schema_name, table_name)
+    if extent is None or extent[0] is None:
+        return WORLD_BBOX
+    return tuple(extent)
+
+
+async def _datastore_schema(workspace_name: str, datastore_name: str) -> str:
+    # データストアの接続設定に登録されたスキーマ名
+    response = await geoserver_client.request("GET", f"/rest/workspaces/{workspace_name}/datastores/{datastore_name}.json")
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"データストアの取得に失敗しました。ステータスコード: {response.status_code}, メッセージ: {response.text}")
+    entries = response.json()["dataStore"]["connectionParameters"]["entry"]
+    return next((entry["$"] for entry in entries if entry.get("@key") == "schema"), "public")
+
+
+async def _publish(workspace_name: str, datastore_name: str, schema_name: str, table_name: str):
+    # 実際のデータ範囲を指定して、GeoServerが全世界の範囲でデータを走査しないようにする
+    minx, miny, maxx, maxy = await run_in_threadpool(_table_extent, schema_name, table_name)
     headers = {'Content-type': 'text/xml'}
+    bbox_xml = f"""
+    <minx>{minx}</minx>
+    <maxx>{maxx}</maxx>
+    <miny>{miny}</miny>
+    <maxy>{maxy}</maxy>
+    <crs>EPSG:4326</crs>"""
     featuretype_xml = f"""
 <featureType>
   <name>{table_name}</name>
   <nativeName>{table_name}</nativeName>
   <title>{table_name}</title>
   <srs>EPSG:4326</srs>
-  <latLonBoundingBox>
-    <minx>-180</minx>
-    <maxx>180</maxx>
-    <miny>-90</miny>
-    <maxy>90</maxy>
-    <crs>EPSG:4326</crs>
+  <nativeBoundingBox>{bbox_xml}
+  </nativeBoundingBox>
+  <latLonBoundingBox>{bbox_xml}
   </latLonBoundingBox>
   <enabled>true</enabled>
 </featureType>
 """
 
-    url = f"{config.GEOSERVER_URL}/rest/workspaces/{workspace_name}/datastores/{datastore_name}/featuretypes"
-    response = requests.post(url, headers=headers, data=featuretype_xml, auth=(config.GEOSERVER_USER_NAME, config.GEOSERVER_USER_PASS))
+    url = f"/rest/workspaces/{workspace_name}/datastores/{datastore_name}/featuretypes"
+    response = await geoserver_client.request("POST", url, headers=headers, content=featuretype_xml)
+    if response.status_code == 201:
+        # WMSプロキシが簡略化したレイヤーを選ぶための公開済みレイヤーの一覧を取得し直す
+        pyramid.forget_workspace(workspace_name)
+    return response
+
+
+async def _publish_levels(workspace_name: str, datastore_name: str, schema_name: str, table_name: str, semaphore=None) -> list:
+    # 簡略化テーブルも同じワークスペースにレイヤーとして公開する（WMSプロキシが低ズームで切り替えて使う）
+    levels = await pyramid.alevels(schema_name, table_name)
+    responses = await geoserver_client.gather_limited((_publish(workspace_name, datastore_name, schema_name, name) for name in levels.values()), semaphore)
+    return [name for name, response in zip(levels.values(), responses) if response.status_code == 201]
+
+
+@router.post("/publish_service/")
+async def publish_service(workspace_name: str, datastore_name: str, table_name: str, schema_name: Optional[str] = None):
+    schema_name = schema_name or await _datastore_schema(workspace_name, datastore_name)
+    response = await _publish(workspace_name, datastore_name, schema_name, table_name)
 
     if response.status_code == 201:
-        return {"message": f"テーブル '{table_name}' がデータストア '{datastore_name}' に正常に公開されました。"}
+        levels = await _publish_levels(workspace_name, datastore_name, schema_name, table_name)
+        return {"message": f"テーブル '{table_name}' がデータストア '{datastore_name}' に正常に公開されました。", "generalized_layers": levels}
     else:
         raise HTTPException(status_code=response.status_code, detail=f"テーブルの公開に失敗しました。ステータスコード: {response.status_code}, メッセージ: {response.text}")
 
-@router.delete("/delete_layer/{workspace_name}/{layer_name}")
-async def delete_layer(workspace_name: str, layer_name: str):
+@router.post("/publish_services/")
+async def publish_services(parameters: PublishParameters):
+    # 複数のテーブルをまとめて公開する（簡略化したレイヤーを含め、同時リクエスト数は全体で GEOSERVER_BATCH_CONCURRENCY まで）
+    schema_name = parameters.schema_name or await _datastore_schema(parameters.workspace_name, parameters.datastore_name)
+    semaphore = geoserver_client.limiter()
+
+    async def publish(table_name: str):
+        try:
+            async with semaphore:
+                response = await _publish(parameters.workspace_name, parameters.datastore_name, schema_name, table_name)
+            levels = await _publish_levels(parameters.workspace_name, parameters.datastore_name, schema_name, table_name, semaphore) if response.status_code == 201 else []
+        except Exception as e:
+            return {"table_name": table_name, "published": False, "message": str(e)}
+        return {"table_name": table_name, "published": response.status_code == 201, "status_code": response.status_code, "message": response.text, "generalized_layers": levels}
+
+    results = await asyncio.gather(*(publish(table_name) for table_name in parameters.table_names))
+    return {"published": sum(result["published"] for result in results), "results": results}
+
+
+async def _delete_layer(workspace_name: str, layer_name: str, semaphore=None):
     # GeoServer REST APIを使用してレイヤーを削除
-    url = f"{config.GEOSERVER_URL}/rest/layers/{workspace_name}:{layer_name}"
     headers = {
         "Content-Type": "application/json",
     }
-    response = requests.delete(url, auth=(config.GEOSERVER_USER_NAME, config.GEOSERVER_USER_PASS), headers=headers)
-    
+    # 同じワークスペースに公開済みの簡略化したレイヤー（レイヤーを削除する前に、そのスキーマから探す）
+    levels = await pyramid.layer_levels(workspace_name, layer_name)
+    async with semaphore or geoserver_client.limiter():
+        response = await geoserver_client.request("DELETE", f"/rest/layers/{workspace_name}:{layer_name}", headers=headers)
+    if response.status_code == 200 or response.status_code == 202:
+        # 削除したレイヤーのキャッシュ済みタイルを破棄
+        tilecache.cache.invalidate_layer(layer_name)
+        # 簡略化したレイヤーも併せて削除する
+        await geoserver_client.gather_limited(
+            (geoserver_client.request("DELETE", f"/rest/layers/{workspace_name}:{name}", headers=headers) for name in levels.values()), semaphore
+        )
+        pyramid.forget_workspace(workspace_name)
+    return response
+
+@router.delete("/delete_layer/{workspace_name}/{layer_name}")
+async def delete_layer(workspace_name: str, layer_name: str):
+    response = await _delete_layer(workspace_name, layer_name)
+
     if response.status_code == 200 or response.status_code == 202:
         return {"message": f"Layer {layer_name} in workspace {workspace_name} deleted successfully."}
     else:
         # GeoServerからのエラーレスポンスをそのまま返す
-        return HTTPException(status_code=response.status_code, detail=response.text)
\ No newline at end of file
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+
+@router.delete("/delete_layers/{workspace_name}")
+async def delete_layers(workspace_name: str, layer_names: List[str] = Query(...)):
+    # 複数のレイヤーをまとめて削除する（簡略化したレイヤーを含め、同時リクエスト数は全体で GEOSERVER_BATCH_CONCURRENCY まで）
+    semaphore = geoserver_client.limiter()
+
+    async def delete(layer_name: str):
+        try:
+            response = await _delete_layer(workspace_name, layer_name, semaphore)
+        except Exception as e:
+            return {"layer_name": layer_name, "deleted": False, "message": str(e)}
+        return {"layer_name": layer_name, "deleted": response.status_code in (200, 202), "status_code": response.status_code, "message": response.text}
+
+    results = await asyncio.gather(*(delete(layer_name) for layer_name in layer_names))
+    return {"deleted": sum(result["deleted"] for result in results), "results": results}
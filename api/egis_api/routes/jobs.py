@@ -0,0 +1,20 @@
+from fastapi import APIRouter
+
+from .. import jobs
+
+router = APIRouter()
+
+@router.get("/jobs")
+def get_jobs():
+    return {"jobs": [job.to_dict() for job in jobs.list_jobs()]}
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return jobs.get(job_id).to_dict()
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    # 実行中のジョブはDBのクエリに pg_cancel_backend を発行して中断する
+    job = jobs.get(job_id)
+    job.cancel()
+    return job.to_dict()
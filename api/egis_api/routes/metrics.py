@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+router = APIRouter()
+
+@router.get("/metrics")
+def get_metrics():
+    # Prometheusのテキスト形式で出力する
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response
+from sqlalchemy import text
+from geoalchemy2 import Geography, Geometry
+
+from .. import changes, config, pyramid
+from ..catalog import catalog
+from ..database import async_engine, engine, qualified_name
+
+router = APIRouter()
+
+MAX_ZOOM = 24
+
+def _feature_limit(z: int, limit: Optional[int]) -> int:
+    # ズームレベルに応じた上限を求め、リクエストで指定された値があればそれ以下に抑える
+    max_features = config.TILE_FEATURE_LIMITS[max(zoom for zoom in config.TILE_FEATURE_LIMITS if zoom <= z)]
+    return min(limit, max_features) if limit else max_features
+
+def _tile_query(schema_name: str, table_name: str, geometry_type, attribute_columns: list, z: int) -> str:
+    preparer = engine.dialect.identifier_preparer
+    select_columns = "".join(f", t.{preparer.quote(column)}" for column in attribute_columns)
+
+    # 既存のGiSTインデックス（geometry列）が使えるよう、タイル範囲をテーブルの型・SRIDに合わせて絞り込む
+    if isinstance(geometry_type, Geography):
+        # 経度方向に180度以上の範囲はgeographyとして扱えないため、低ズームでは絞り込まない
+        where = "WHERE t.geometry && bounds.geom_4326::geography" if z >= 2 else ""
+    else:
+        srid = geometry_type.srid if geometry_type.srid and geometry_type.srid > 0 else 4326
+        where = f"WHERE t.geometry && ST_Transform(bounds.geom_margin, {int(srid)})"
+
+    return f"""
+        WITH bounds AS (
+            SELECT
+                ST_TileEnvelope(:z, :x, :y) AS geom,
+                ST_TileEnvelope(:z, :x, :y, margin => :margin) AS geom_margin,
+                ST_Transform(ST_TileEnvelope(:z, :x, :y, margin => :margin), 4326) AS geom_4326
+        ),
+        mvtgeom AS (
+            SELECT
+                ST_AsMVTGeom(ST_Transform(t.geometry::geometry, 3857), bounds.geom, :extent, :buffer, true) AS geom
+                {select_columns}
+            FROM {qualified_name(schema_name, table_name)} AS t, bounds
+            {where}
+            LIMIT :limit
+        )
+        SELECT ST_AsMVT(mvtgeom.*, :layer_name, :extent, 'geom') FROM mvtgeom
+    """
+
+@router.get("/tiles/{schema_name}/{table_name}/{z}/{x}/{y}.pbf")
+async def get_tile(schema_name: str, table_name: str, z: int, x: int, y: int, request: Request, columns: Optional[str] = None, limit: Optional[int] = Query(None, ge=1)):
+    if not 0 <= z <= MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise HTTPException(status_code=400, detail="Invalid tile coordinates")
+
+    # 既存テーブルから列名を取得
+    table_columns = {column['name']: column['type'] for column in await catalog.acolumns(schema_name, table_name)}
+    if 'geometry' not in table_columns:
+        raise HTTPException(status_code=404, detail="Table with geometry column not found")
+
+    # タイルに含める属性列（指定がなければジオメトリ以外のすべての列）
+    attribute_columns = [name for name, column_type in table_columns.items() if not isinstance(column_type, (Geometry, Geography))]
+    if columns is not None:
+        requested = [column for column in columns.split(",") if column]
+        unknown = [column for column in requested if column not in attribute_columns]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}")
+        attribute_columns = requested
+
+    # 簡略化テーブルがあれば、ズームレベルに合ったものから描画する（レイヤー名は元のテーブル名のまま）
+    source_table = pyramid.select_level(await pyramid.alevels(schema_name, table_name), z) or table_name
+    feature_limit = _feature_limit(z, limit)
+
+    # 描画するテーブルの状態（変更回数・更新行数の累計など）とタイルの指定からETagを作成し、クライアントのキャッシュと一致すればタイルを作らずに304を返す
+    state = await changes.atable_state(schema_name, source_table)
+    etag = '"' + hashlib.md5(repr((state, source_table, z, x, y, attribute_columns, feature_limit)).encode("utf-8")).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={config.TILE_CACHE_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    query = _tile_query(schema_name, source_table, table_columns['geometry'], attribute_columns, z)
+    params = {
+        "z": z, "x": x, "y": y,
+        "margin": config.TILE_BUFFER / config.TILE_EXTENT,
+        "extent": config.TILE_EXTENT,
+        "buffer": config.TILE_BUFFER,
+        "limit": feature_limit,
+        "layer_name": table_name,
+    }
+    async with async_engine.connect() as connection:
+        tile = bytes((await connection.execute(text(query), params)).scalar() or b"")
+
+    return Response(
+        content=gzip.compress(tile, compresslevel=6),
+        media_type="application/vnd.mapbox-vector-tile",
+        headers={**headers, "Content-Encoding": "gzip"},
+    )
@@ -0,0 +1,98 @@
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Request
+from pydantic import BaseModel
+
+from .. import citygml, geoparquet, importers, jobs, merge, planar, resumable
+
+router = APIRouter()
+
+# finalize で指定するインポートの種類 -> (ジョブの種類, 受け付ける拡張子)
+IMPORT_KINDS = {
+    "csv": ("import_data", (".csv",)),
+    "geojson": ("import_geojson", (".geojson",)),
+    "shapefile": ("import_shapefile", (".zip",)),
+    "flatgeobuf": ("import_flatgeobuf", (".fgb",)),
+    "geoparquet": ("import_geoparquet", (".parquet",)),
+    "citygml": ("import_citygml", (".zip", ".gml")),
+}
+
+class UploadSession(BaseModel):
+    filename: str  # 元のファイル名（拡張子でインポートの種類を確認する）
+    size: int  # ファイル全体の大きさ（バイト）
+
+class FinalizeParameters(BaseModel):
+    kind: str  # csv / geojson / shapefile / flatgeobuf / geoparquet / citygml
+    schema_name: Optional[str] = None  # citygml 以外では必須
+    table_name: Optional[str] = None  # citygml 以外では必須
+    copy_format: str = "csv"
+    storage: str = "geography"
+    generalize: bool = False
+    mode: str = "create"
+    key: Optional[str] = None
+    sha256: Optional[str] = None  # ファイル全体のSHA-256（指定した場合はインポート前に確認する）
+
+# 再開可能なアップロード
+# 1. POST /uploads でセッションを作成する
+# 2. PUT /uploads/{upload_id} にバイト範囲を Content-Range ヘッダー付きで送る（並列に送ってよい、X-Checksum-SHA256 でチャンクを検証できる）
+#    接続が切れた場合は GET /uploads/{upload_id} の missing に残っている範囲だけを送り直す
+# 3. POST /uploads/{upload_id}/finalize でインポートをジョブとして投入する
+@router.post("/uploads")
+def create_upload(upload: UploadSession):
+    return resumable.create(upload.filename, upload.size)
+
+@router.get("/uploads/{upload_id}")
+def get_upload(upload_id: str):
+    return resumable.get(upload_id)
+
+@router.put("/uploads/{upload_id}")
+async def put_upload_range(upload_id: str, request: Request, content_range: Optional[str] = Header(None),
+                           x_checksum_sha256: Optional[str] = Header(None)):
+    # multipartを使わずにリクエストボディをそのまま受け取り、メモリに溜めずにファイルの該当位置へ書き込む
+    return await resumable.write_range(upload_id, content_range, x_checksum_sha256, request.stream())
+
+@router.post("/uploads/{upload_id}/finalize")
+def finalize_upload(upload_id: str, parameters: FinalizeParameters):
+    if parameters.kind not in IMPORT_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unsupported kind: {parameters.kind}")
+    job_kind, extensions = IMPORT_KINDS[parameters.kind]
+    if parameters.kind != "citygml":
+        if not parameters.schema_name or not parameters.table_name:
+            raise HTTPException(status_code=400, detail="schema_name and table_name are required")
+        merge.check_mode(parameters.mode, parameters.key)
+        planar.check_storage(parameters.storage)
+
+    session = resumable.begin_import(upload_id)
+    try:
+        if session["suffix"] not in extensions:
+            raise HTTPException(status_code=400, detail="Invalid file format")
+        options = dict(mode=parameters.mode, key=parameters.key)
+        if parameters.kind == "citygml":
+            args = (citygml.import_archive,)
+            options = {}
+        elif parameters.kind == "csv":
+            args = (importers.import_csv, parameters.schema_name, parameters.table_name, parameters.copy_format)
+        elif parameters.kind == "geoparquet":
+            args = (geoparquet.import_geoparquet, parameters.schema_name, parameters.table_name, parameters.copy_format, parameters.storage)
+            options["generalize"] = parameters.generalize
+        elif parameters.kind == "shapefile":
+            args = (importers.import_shapefile_zip, parameters.schema_name, parameters.table_name, parameters.copy_format, parameters.storage)
+            options["generalize"] = parameters.generalize
+        else:
+            args = (importers.import_vector, parameters.schema_name, parameters.table_name, parameters.copy_format, parameters.storage)
+            options["generalize"] = parameters.generalize
+
+        # 組み立てたファイルをパスのまま既存のインポート関数に渡す（成功するとセッションは削除される）
+        params = {"upload_id": upload_id, "filename": session["filename"], **parameters.model_dump(exclude={"sha256"})}
+        job = jobs.submit(job_kind, params, resumable.import_file, session, parameters.sha256, *args,
+                          cleanup=lambda: resumable.release(upload_id), **options)
+    except Exception:
+        resumable.release(upload_id)
+        raise
+    resumable.set_job(upload_id, job.id)
+    return jobs.accepted(job)
+
+@router.delete("/uploads/{upload_id}")
+def delete_upload(upload_id: str):
+    resumable.delete(upload_id)
+    return {"message": f"Upload {upload_id} deleted successfully"}
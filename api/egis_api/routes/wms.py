@@ -0,0 +1,31 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+
+from .. import pyramid, tilecache
+
+router = APIRouter()
+
+@router.get("/wms/{workspace_name}")
+async def wms_proxy(workspace_name: str, request: Request):
+    # GeoServerのWMSを中継し、GetMapのタイルはディスクキャッシュから返す
+    params = dict(request.query_params)
+    if {key.lower(): value for key, value in params.items()}.get("request", "").lower() != "getmap":
+        content, content_type, status_code = await run_in_threadpool(tilecache.forward, workspace_name, params)
+        return Response(content=content, media_type=content_type, status_code=status_code)
+
+    # 低ズームでは、このワークスペースに公開済みの簡略化したレイヤーから描画する（失敗した場合は元のレイヤーで描画し直す）
+    generalized = await pyramid.wms_params(workspace_name, params)
+    content, content_type, status_code, cache_status = await run_in_threadpool(tilecache.get_map, workspace_name, generalized)
+    if generalized != params and (status_code != 200 or not (content_type or "").startswith("image/")):
+        content, content_type, status_code, cache_status = await run_in_threadpool(tilecache.get_map, workspace_name, params)
+    return Response(content=content, media_type=content_type, status_code=status_code, headers={"X-Cache": cache_status})
+
+@router.get("/wms_cache/stats")
+def wms_cache_stats():
+    return tilecache.cache.stats()
+
+@router.delete("/wms_cache/{layer_name}")
+def invalidate_wms_cache(layer_name: str):
+    removed = tilecache.cache.invalidate_layer(layer_name)
+    return {"message": f"{removed} cached tiles of {layer_name} removed"}
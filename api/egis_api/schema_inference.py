@@ -0,0 +1,238 @@
+import datetime
+import re
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, SmallInteger, Integer, BigInteger, Boolean, String, Date, DateTime, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import CompileError
+from sqlalchemy.dialects.postgresql import JSONB, REAL, DOUBLE_PRECISION
+
+from . import config
+from .database import qualified_name
+
+# 推定する型（狭い順）と対応するPostgreSQLの型
+TYPES = {
+    "boolean": Boolean,
+    "smallint": SmallInteger,
+    "integer": Integer,
+    "bigint": BigInteger,
+    "real": REAL,
+    "double": DOUBLE_PRECISION,
+    "date": Date,
+    "timestamp": DateTime,
+    "timestamptz": lambda: DateTime(timezone=True),
+    "jsonb": JSONB,
+    "text": String,
+}
+
+_DIALECT = postgresql.dialect()
+
+INTEGERS = ("smallint", "integer", "bigint")
+FLOATS = ("real", "double")
+
+_INTEGER_RANGES = {
+    "smallint": (-2 ** 15, 2 ** 15 - 1),
+    "integer": (-2 ** 31, 2 ** 31 - 1),
+    "bigint": (-2 ** 63, 2 ** 63 - 1),
+}
+
+# ISO 8601形式の日付・日時のみを日付型として扱う（"001" のような数字だけの文字列は文字列のまま）
+_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?$")
+_TIMESTAMPTZ = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}(:?\d{2})?)$")
+
+
+def _integer_type(minimum, maximum) -> str:
+    for name in INTEGERS:
+        low, high = _INTEGER_RANGES[name]
+        if low <= minimum and maximum <= high:
+            return name
+    return "text"
+
+
+def _float_type(values: np.ndarray) -> str:
+    # float32 に変換しても値が変わらない場合のみ real にする
+    with np.errstate(over="ignore"):
+        narrowed = values.astype(np.float32).astype(np.float64)
+    return "real" if np.array_equal(narrowed, values) else "double"
+
+
+def _numeric_type(values: np.ndarray) -> str:
+    # 欠損値を含む整数列は float64 になるため、すべて整数値であれば整数型として扱う
+    if np.issubdtype(values.dtype, np.integer):
+        return _integer_type(int(values.min()), int(values.max()))
+    if np.all(np.isfinite(values)) and np.all(np.mod(values, 1) == 0) and np.abs(values).max() < 2 ** 53:
+        return _integer_type(int(values.min()), int(values.max()))
+    return _float_type(values.astype(np.float64))
+
+
+def _string_type(values: list) -> str:
+    if all(_DATE.match(value) for value in values):
+        kind = "date"
+    elif all(_TIMESTAMP.match(value) for value in values):
+        kind = "timestamp"
+    elif all(_TIMESTAMPTZ.match(value) for value in values):
+        kind = "timestamptz"
+    else:
+        return "text"
+    # 形式が合っていても存在しない日付（2023-02-30など）があれば文字列のままにする
+    parsed = pd.to_datetime(pd.Series(values), format="ISO8601", errors="coerce", utc=kind == "timestamptz")
+    return kind if parsed.notna().all() else "text"
+
+
+def _object_type(values: list) -> str:
+    if all(isinstance(value, (bool, np.bool_)) for value in values):
+        return "boolean"
+    if all(isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_)) for value in values):
+        # int64 に収まらない整数は文字列にする
+        try:
+            return _numeric_type(np.array(values, dtype=np.int64))
+        except OverflowError:
+            return "text"
+    if all(isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_)) for value in values):
+        return _numeric_type(np.array(values, dtype=np.float64))
+    if all(isinstance(value, (dict, list)) for value in values):
+        return "jsonb"
+    if all(isinstance(value, datetime.datetime) for value in values):
+        return "timestamptz" if all(value.tzinfo is not None for value in values) else "timestamp"
+    if all(isinstance(value, datetime.date) for value in values):
+        return "date"
+    if all(isinstance(value, str) for value in values):
+        return _string_type(values)
+    return "text"
+
+
+def infer_series(series: pd.Series):
+    # 1列の値に収まる最も狭い型を返す（すべて欠損値の場合は None）
+    values = series.dropna()
+    if values.empty:
+        return None
+    dtype = values.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "timestamptz" if getattr(dtype, "tz", None) is not None else "timestamp"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return _numeric_type(values.to_numpy())
+    return _object_type(values.tolist())
+
+
+def widen(a, b):
+    # 両方の値を表せる型を返す（表せる型がなければ text）
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if a in INTEGERS and b in INTEGERS:
+        return max(a, b, key=INTEGERS.index)
+    if a in INTEGERS + FLOATS and b in INTEGERS + FLOATS:
+        # real で正確に表せる整数は smallint まで。bigint と小数の組み合わせは double（2^53 を超える整数は丸められる）
+        if "smallint" in (a, b) and "real" in (a, b):
+            return "real"
+        return "double"
+    if {a, b} == {"date", "timestamp"}:
+        return "timestamp"
+    return "text"
+
+
+def infer_frame(df: pd.DataFrame, kinds: dict = None) -> dict:
+    # 列名 -> 型名。kinds を渡した場合は、その型と合わせて広げた結果を返す
+    kinds = dict(kinds or {})
+    for name in df.columns:
+        if name == "geometry":
+            continue
+        kinds[name] = widen(kinds.get(name), infer_series(df[name]))
+    return kinds
+
+
+def sample(batches, count: int = None) -> list:
+    # 型の推定に使う先頭のバッチを読み込む（読み込んだバッチもそのまま投入に使う）
+    count = count or config.SCHEMA_SAMPLE_BATCHES
+    sampled = []
+    for batch in batches:
+        sampled.append(batch)
+        if len(sampled) >= count:
+            break
+    return sampled
+
+
+def infer_kinds(sampled: list) -> dict:
+    kinds = {}
+    for batch in sampled:
+        kinds = infer_frame(batch, kinds)
+    # サンプル内ですべて欠損値だった列は text にする
+    return {name: kind or "text" for name, kind in kinds.items()}
+
+
+def column_type(kind: str):
+    return TYPES[kind]()
+
+
+def infer_columns(sampled: list) -> list:
+    return [Column(name, column_type(kind)) for name, kind in infer_kinds(sampled).items()]
+
+
+def describe(sampled: list) -> list:
+    # プレビュー用に推定結果を列の一覧として返す
+    kinds = infer_kinds(sampled)
+    nulls = {name: sum(int(batch[name].isna().sum()) for batch in sampled if name in batch) for name in kinds}
+    return [{"name": name, "type": kind, "nulls": nulls[name]} for name, kind in kinds.items()]
+
+
+def kind_of(column) -> str:
+    # PostgreSQLの型名で比較する（catalog.columns で読み込んだ INTEGER・TIMESTAMP などの型も対応する型名に戻す）
+    try:
+        type_name = column.type.compile(dialect=_DIALECT)
+    except CompileError:
+        # 認識できない型（NullType）の列
+        return "text"
+    for kind, factory in TYPES.items():
+        if factory().compile(dialect=_DIALECT) == type_name:
+            return kind
+    return "text"
+
+
+def _widenable(table) -> list:
+    return [column for column in table.columns if column.name != "geometry" and not column.primary_key and kind_of(column) != "text"]
+
+
+def widen_columns(connection, table, kinds: dict):
+    # 列ごとの型（列名 -> 型名）の値を表せるように、列の型を広げる
+    preparer = connection.dialect.identifier_preparer
+    for column in _widenable(table):
+        if column.name not in kinds:
+            continue
+        current = kind_of(column)
+        widened = widen(current, kinds[column.name])
+        if widened == current:
+            continue
+        column.type = column_type(widened)
+        type_name = column.type.compile(dialect=connection.dialect)
+        quoted = preparer.quote(column.name)
+        connection.execute(text(
+            f"ALTER TABLE {qualified_name(table.schema, table.name)} ALTER COLUMN {quoted} TYPE {type_name} USING {quoted}::{type_name}"
+        ))
+
+
+def incompatible_columns(table, batch: pd.DataFrame) -> dict:
+    # 列の型を変えずにはバッチの値を書き込めない列（列名 -> (列の型名, 値に必要な型名)）
+    # 日付・タイムゾーンなしの日時はCOPYでタイムゾーン付きの日時に変換できるため、そのまま書き込める
+    found = {}
+    for column in _widenable(table):
+        if column.name not in batch.columns:
+            continue
+        current = kind_of(column)
+        incoming = infer_series(batch[column.name])
+        if current == "timestamptz" and incoming in ("date", "timestamp"):
+            continue
+        widened = widen(current, incoming)
+        if widened != current:
+            found[column.name] = (current, widened)
+    return found
+
+
+def widen_table(connection, table, batch: pd.DataFrame):
+    # サンプルから推定した型に収まらない値がバッチに含まれる場合は、列の型を広げる
+    kinds = {column.name: infer_series(batch[column.name]) for column in _widenable(table) if column.name in batch.columns}
+    widen_columns(connection, table, kinds)
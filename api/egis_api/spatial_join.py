@@ -0,0 +1,139 @@
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import Float, Integer, Numeric, text
+
+from . import config, jobs, overlay, planar
+from .catalog import catalog
+from .database import engine, qualified_name
+
+# 結合条件（j: 集計されるレイヤー、a: 結果の各行になるレイヤー）
+PREDICATES = ("intersects", "within", "dwithin", "nearest")
+
+AGGREGATES = ("count", "sum", "avg", "min", "max")
+
+# 数値列にしか使えない集計関数
+_NUMERIC_AGGREGATES = ("sum", "avg")
+
+# 一致した件数（keep_unmatched=False の場合の絞り込みに使い、結果には含めない）
+_MATCHES = "_egis_matches"
+
+
+def _aggregate_columns(join_columns: dict, aggregates: list, target_columns: list) -> list:
+    # (集計式, 結果の列名) の一覧
+    preparer = engine.dialect.identifier_preparer
+    result = []
+    for aggregate in aggregates:
+        function, column = aggregate["function"], aggregate.get("column")
+        if function not in AGGREGATES:
+            raise HTTPException(status_code=400, detail=f"Unsupported aggregate: {function}")
+        if column is None and function != "count":
+            raise HTTPException(status_code=400, detail=f"{function} requires a column")
+        if column is not None and column not in join_columns:
+            raise HTTPException(status_code=400, detail=f"Unknown column: {column}")
+        if function in _NUMERIC_AGGREGATES and not isinstance(join_columns[column], (Integer, Float, Numeric)):
+            raise HTTPException(status_code=400, detail=f"{function} requires a numeric column: {column}")
+        alias = aggregate.get("alias") or (f"{function}_{column}" if column else function)
+        if alias in target_columns or alias in ("geometry", planar.PLANAR_COLUMN, _MATCHES) or alias in [name for _, name in result]:
+            raise HTTPException(status_code=400, detail=f"Duplicate output column: {alias}")
+        expression = f"{function}(j.{preparer.quote(column)})" if column else "count(*)"
+        result.append((expression, alias))
+    return result
+
+
+def _geometry_column(connection, schema_name: str, target_table: str, join_table: str):
+    # 両方のレイヤーが同じ投影座標系の列を持つ場合は、その列を使って平面上で計算する
+    target_srid = planar.planar_srid(connection, schema_name, target_table)
+    if target_srid is not None and target_srid == planar.planar_srid(connection, schema_name, join_table):
+        return planar.PLANAR_COLUMN, True
+    return "geometry", False
+
+
+def _matches(join: str, geometry: str, is_planar: bool, predicate: str, distance: Optional[float], aggregate_columns: list) -> str:
+    # 対象フィーチャー1件ごとに、結合するフィーチャーを空間インデックスで探して集計する（直積は作らない）
+    preparer = engine.dialect.identifier_preparer
+    geom = preparer.quote(geometry)
+    select_list = ", ".join([f"{expression} AS {preparer.quote(alias)}" for expression, alias in aggregate_columns] + [f"count(*) AS {_MATCHES}"])
+    if predicate == "nearest":
+        # <-> による近傍探索（distance を指定した場合はその距離以内に限る）
+        within = f"WHERE ST_DWithin(n.{geom}, a.{geom}, :distance)" if distance is not None else ""
+        return f"""
+            SELECT {select_list}
+            FROM (
+                SELECT n.* FROM {join} AS n
+                {within}
+                ORDER BY n.{geom} <-> a.{geom}
+                LIMIT :k
+            ) AS j
+        """
+    if predicate == "intersects":
+        condition = f"ST_Intersects(j.{geom}, a.{geom})"
+    elif predicate == "within":
+        # geographyには ST_Within がないため、対象側が覆う（ST_Covers）フィーチャーを結合する
+        condition = f"ST_Within(j.{geom}, a.{geom})" if is_planar else f"ST_Covers(a.{geom}, j.{geom})"
+    else:
+        condition = f"ST_DWithin(j.{geom}, a.{geom}, :distance)"
+    return f"SELECT {select_list} FROM {join} AS j WHERE {condition}"
+
+
+def spatial_join(schema_name: str, target_table: str, join_table: str, new_table_name: str, predicate: str = "intersects",
+                 aggregates: Optional[list] = None, distance: Optional[float] = None, k: int = 1, keep_unmatched: bool = True) -> int:
+    # 対象レイヤーの各フィーチャーに、条件に合う結合レイヤーのフィーチャーの集計値を付けた新しいテーブルを作成する
+    # 対象レイヤーを空間区画に分け、区画ごとに並列に処理する
+    if predicate not in PREDICATES:
+        raise HTTPException(status_code=400, detail=f"Unsupported predicate: {predicate}")
+    if predicate == "dwithin" and distance is None:
+        raise HTTPException(status_code=400, detail="distance is required for predicate=dwithin")
+    if predicate == "nearest" and k < 1:
+        raise HTTPException(status_code=400, detail="k must be at least 1")
+
+    columns = overlay.target_columns(schema_name, target_table)
+    join_columns = {column['name']: column['type'] for column in catalog.columns(schema_name, join_table)}
+    if 'geometry' not in join_columns:
+        raise HTTPException(status_code=400, detail=f"{join_table} has no geometry column")
+    aggregate_columns = _aggregate_columns(join_columns, aggregates or [{"function": "count"}], columns)
+
+    preparer = engine.dialect.identifier_preparer
+    target = qualified_name(schema_name, target_table)
+    column_list = ", ".join([preparer.quote(column) for column in columns] + ["geometry"] + [preparer.quote(alias) for _, alias in aggregate_columns])
+    select_list = ", ".join([f"a.{preparer.quote(column)}" for column in columns] + ["a.geometry"] + [f"m.{preparer.quote(alias)}" for _, alias in aggregate_columns])
+    unmatched = "" if keep_unmatched else f"WHERE m.{_MATCHES} > 0"
+    params = {"distance": distance, "k": k}
+    partitions = config.OVERLAY_PARTITIONS
+
+    with overlay.scratch_tables(schema_name, "partition") as (partition_table,):
+        with engine.connect() as connection, jobs.tracked_connection(connection):
+            geometry, is_planar = _geometry_column(connection, schema_name, target_table, join_table)
+            matches = _matches(qualified_name(schema_name, join_table), geometry, is_planar, predicate, distance, aggregate_columns)
+            jobs.report(phase="partition")
+            overlay.partition(connection, schema_name, target_table, partition_table, partitions)
+            # 集計結果の型に合わせて結果テーブルを作成する
+            connection.execute(text(f"""
+                CREATE TABLE {qualified_name(schema_name, new_table_name)} AS
+                SELECT {select_list}
+                FROM {target} AS a
+                CROSS JOIN LATERAL ({matches}) AS m
+                WITH NO DATA
+            """), params)
+            srid = planar.planar_srid(connection, schema_name, target_table)
+            if srid is not None:
+                planar.add_planar_column(connection, schema_name, new_table_name, srid)
+            connection.commit()
+
+        statement = f"""
+            INSERT INTO {qualified_name(schema_name, new_table_name)} ({column_list})
+            SELECT {select_list}
+            FROM {target} AS a
+            JOIN {qualified_name(schema_name, partition_table)} AS p ON p.id = a.id AND p.part = :part
+            CROSS JOIN LATERAL ({matches}) AS m
+            {unmatched}
+        """
+        try:
+            rows = overlay.run_partitioned(statement, params, partitions)
+        except Exception:
+            # 途中で失敗した場合は作りかけの結果テーブルを削除する
+            with engine.connect() as connection:
+                connection.execute(text(f"DROP TABLE IF EXISTS {qualified_name(schema_name, new_table_name)}"))
+                connection.commit()
+            raise
+    return rows
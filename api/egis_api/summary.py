@@ -0,0 +1,180 @@
+import json
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from . import config, maintenance, planar
+from .catalog import catalog
+from .database import engine, qualified_name
+
+# テーブルの概要を全件走査せずに求める
+# 件数・サイズはシステムカタログ、範囲は統計情報（ST_EstimatedExtent）かインポート時に記録した範囲、列の値の分布は pg_stats から取得し、
+# ジオメトリの種類は TABLESAMPLE で抽出した一部の行から集計する
+
+_TABLE_SQL = """
+SELECT c.reltuples, c.relpages,
+       pg_total_relation_size(c.oid) AS total_bytes,
+       pg_relation_size(c.oid) AS table_bytes,
+       pg_indexes_size(c.oid) AS index_bytes,
+       greatest(s.last_analyze, s.last_autoanalyze) AS analyzed_at,
+       s.n_mod_since_analyze
+FROM pg_class c
+LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+WHERE c.oid = to_regclass(:table)
+"""
+
+# anyarray の列は text[] に変換して取得する
+_STATS_SQL = """
+SELECT attname, null_frac, avg_width, n_distinct, correlation,
+       most_common_vals::text::text[] AS most_common_vals,
+       most_common_freqs,
+       histogram_bounds::text::text[] AS histogram_bounds
+FROM pg_stats
+WHERE schemaname = :schema_name AND tablename = :table_name
+"""
+
+
+def _sample_percent(rows: Optional[float]) -> float:
+    # 約 SUMMARY_SAMPLE_ROWS 行を抽出する割合（件数が不明な場合や小さいテーブルは全件）
+    if not rows or rows <= config.SUMMARY_SAMPLE_ROWS:
+        return 100.0
+    return max(0.0001, 100.0 * config.SUMMARY_SAMPLE_ROWS / rows)
+
+
+def _box(row) -> Optional[list]:
+    if row is None or row[0] is None:
+        return None
+    return [row[0], row[1], row[2], row[3]]
+
+
+def _statistics_extent(connection, schema_name: str, table_name: str, column: str, srid: int) -> Optional[list]:
+    # 統計情報から推定した範囲をEPSG:4326に変換する（統計情報がない ANALYZE 前のテーブルでは None）
+    try:
+        # 統計情報がない場合はエラーになるため、セーブポイント内で試す
+        with connection.begin_nested():
+            return _box(connection.execute(text("""
+                SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+                FROM (SELECT ST_Transform(ST_SetSRID(ST_EstimatedExtent(:schema_name, :table_name, :column)::geometry, :srid), 4326) AS e) AS extent
+            """), {"schema_name": schema_name, "table_name": table_name, "column": column, "srid": srid}).first())
+    except DBAPIError:
+        return None
+
+
+def _estimated_extent(connection, schema_name: str, table_name: str, planar_srid: Optional[int]):
+    # 全件を走査せずに範囲（EPSG:4326）を求め、(範囲, 求め方) を返す
+    # geometry列は統計情報から推定する。geography列の統計情報は地心座標のため使わず、
+    # インポート時に記録した範囲か、投影座標系の列の統計情報を使う（routes/geoserver と同じ順）
+    srid = connection.execute(text("""
+        SELECT srid FROM geometry_columns
+        WHERE f_table_schema = :schema_name AND f_table_name = :table_name AND f_geometry_column = 'geometry'
+    """), {"schema_name": schema_name, "table_name": table_name}).scalar()
+    if srid is not None:
+        return _statistics_extent(connection, schema_name, table_name, "geometry", srid or 4326), "statistics"
+    extent = maintenance.recorded_extent(connection, schema_name, table_name)
+    if extent is not None:
+        return extent, "recorded"
+    if planar_srid is not None:
+        return _statistics_extent(connection, schema_name, table_name, planar.PLANAR_COLUMN, planar_srid), "statistics"
+    return None, None
+
+
+def _sample(connection, schema_name: str, table_name: str, percent: float) -> dict:
+    # 抽出した行からジオメトリの種類の内訳・平均頂点数・範囲を集計する
+    table = qualified_name(schema_name, table_name)
+    rows = connection.execute(text(f"""
+        SELECT GeometryType(geometry::geometry) AS geometry_type, count(*) AS rows, avg(ST_NPoints(geometry::geometry)) AS vertices
+        FROM {table} TABLESAMPLE SYSTEM (:percent)
+        GROUP BY 1
+    """), {"percent": percent}).fetchall()
+    extent = connection.execute(text(f"""
+        SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+        FROM (SELECT ST_Extent(geometry::geometry) AS e FROM {table} TABLESAMPLE SYSTEM (:percent)) AS extent
+    """), {"percent": percent}).first()
+    sampled = sum(row.rows for row in rows)
+    types = {
+        row.geometry_type or "EMPTY": {"rows": row.rows, "fraction": round(row.rows / sampled, 4), "average_vertices": round(float(row.vertices or 0), 1)}
+        for row in rows
+    }
+    return {"sampled_rows": sampled, "types": types, "extent": _box(extent)}
+
+
+def _column_stats(connection, schema_name: str, table_name: str, rows: Optional[float]) -> dict:
+    stats = {}
+    for row in connection.execute(text(_STATS_SQL), {"schema_name": schema_name, "table_name": table_name}):
+        # n_distinct が負の値の場合は行数に対する割合
+        distinct = row.n_distinct
+        if distinct is not None and distinct < 0:
+            distinct = round(-distinct * rows) if rows else None
+        stats[row.attname] = {
+            "null_fraction": row.null_frac,
+            "average_width": row.avg_width,
+            "distinct": distinct,
+            "correlation": row.correlation,
+            "most_common": [
+                {"value": value, "frequency": frequency}
+                for value, frequency in zip(row.most_common_vals or [], row.most_common_freqs or [])
+            ],
+            "histogram": row.histogram_bounds,
+        }
+    return stats
+
+
+def _summarize(schema_name: str, table_name: str) -> dict:
+    columns = catalog.columns(schema_name, table_name)
+    has_geometry = any(column['name'] == 'geometry' for column in columns)
+    with engine.connect() as connection:
+        table = connection.execute(text(_TABLE_SQL), {"table": qualified_name(schema_name, table_name)}).first()
+        # 一度も ANALYZE されていないテーブルの reltuples は -1
+        rows = table.reltuples if table.reltuples >= 0 else None
+        stats = _column_stats(connection, schema_name, table_name, rows)
+        summary = {
+            "estimated_rows": round(rows) if rows is not None else None,
+            "analyzed_at": table.analyzed_at.isoformat() if table.analyzed_at else None,
+            "modified_since_analyze": table.n_mod_since_analyze,
+            "size": {"total_bytes": table.total_bytes, "table_bytes": table.table_bytes, "index_bytes": table.index_bytes, "pages": table.relpages},
+            "columns": [
+                {"name": column['name'], "type": str(column['type']), "nullable": column['nullable'], "stats": stats.get(column['name'])}
+                for column in columns
+            ],
+        }
+        if has_geometry:
+            srid = planar.planar_srid(connection, schema_name, table_name)
+            sample = _sample(connection, schema_name, table_name, _sample_percent(rows))
+            extent, extent_source = _estimated_extent(connection, schema_name, table_name, srid)
+            summary["geometry"] = {
+                "extent": extent or sample["extent"],
+                "extent_source": extent_source if extent else "sample",
+                "planar_srid": srid,
+                "sampled_rows": sample["sampled_rows"],
+                "types": sample["types"],
+            }
+    return summary
+
+
+def summarize(schema_name: str, table_name: str) -> dict:
+    # テーブルが変更されるまで（changes.table_changed で無効化されるまで）キャッシュする
+    if not catalog.has_table(schema_name, table_name):
+        raise HTTPException(status_code=404, detail="Table not found")
+    return catalog.cached(("summary", schema_name, table_name), lambda: _summarize(schema_name, table_name))
+
+
+def preview(schema_name: str, table_name: str, extent: Optional[list], limit: int) -> list:
+    # 先頭の行を、範囲に対して SUMMARY_PREVIEW_PIXELS ピクセル相当の精度に簡略化したGeoJSONで返す
+    preparer = engine.dialect.identifier_preparer
+    columns = [column['name'] for column in catalog.columns(schema_name, table_name) if column['name'] not in ('geometry', planar.PLANAR_COLUMN)]
+    has_geometry = any(column['name'] == 'geometry' for column in catalog.columns(schema_name, table_name))
+    tolerance = max(extent[2] - extent[0], extent[3] - extent[1]) / config.SUMMARY_PREVIEW_PIXELS if extent else 0
+    select_list = [preparer.quote(column) for column in columns]
+    if has_geometry:
+        select_list.append("ST_AsGeoJSON(ST_SimplifyPreserveTopology(geometry::geometry, :tolerance), 6) AS geometry")
+    with engine.connect() as connection:
+        result = connection.execute(text(f"""
+            SELECT {", ".join(select_list)} FROM {qualified_name(schema_name, table_name)} LIMIT :limit
+        """), {"tolerance": tolerance, "limit": limit})
+        rows = [dict(row._mapping) for row in result]
+    if has_geometry:
+        for row in rows:
+            row["geometry"] = json.loads(row["geometry"]) if row["geometry"] else None
+    return rows
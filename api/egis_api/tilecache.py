@@ -0,0 +1,284 @@
+import hashlib
+import io
+import math
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+
+import requests
+from PIL import Image
+
+from . import config, metrics
+
+# メタタイル化できるタイルグリッド（原点X, 原点Y, 全体の幅, 全体の高さ）
+GRIDS = {
+    "EPSG:3857": (-20037508.342789244, 20037508.342789244, 40075016.68557849, 40075016.68557849),
+    "EPSG:900913": (-20037508.342789244, 20037508.342789244, 40075016.68557849, 40075016.68557849),
+    "EPSG:4326": (-180.0, 90.0, 360.0, 180.0),
+}
+
+# 分割して保存できる画像フォーマット（WMSのFORMAT → Pillowのフォーマット名）
+IMAGE_FORMATS = {"image/png": "PNG", "image/jpeg": "JPEG"}
+
+# キャッシュキーに含めないパラメータ（グリッド上の位置で区別する）
+_POSITION_PARAMS = ("bbox", "width", "height")
+
+_session = requests.Session()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class TileCache:
+    # ディスク上のLRUタイルキャッシュ（インデックスはメモリ上に持ち、APIサーバーの起動時に start() で空にする）
+    # インデックスはプロセスごとに持つため、ファイルもプロセスごとのサブディレクトリ（<directory>/<PID>）に保存する
+    def __init__(self, directory: str, max_bytes: int):
+        self.root = directory
+        self.directory = os.path.join(directory, str(os.getpid()))
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()  # key -> (path, size, layers, content_type)
+        self._bytes = 0
+        self._generations = defaultdict(int)  # レイヤーごとの無効化回数（描画中に無効化されたタイルを保存しないため）
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "upstream_requests": 0, "evictions": 0, "invalidations": 0}
+
+    def start(self):
+        # APIサーバーの各ワーカープロセスの起動時に呼び出し、このプロセスのサブディレクトリを空にする
+        # 他のワーカーのサブディレクトリには触れず、終了したプロセスのものだけを削除する
+        # （インポートの子プロセスなど、このモジュールを読み込むだけのプロセスではディレクトリに触れない）
+        self.directory = os.path.join(self.root, str(os.getpid()))
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.root):
+            if not name.isdigit() or not _alive(int(name)):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            self._index.move_to_end(key)
+        path, size, layers, content_type = entry
+        try:
+            with open(path, "rb") as f:
+                return f.read(), content_type
+        except FileNotFoundError:
+            # 読み込み前に追い出された場合はミスとして扱う
+            return None
+
+    def generations(self, layers) -> tuple:
+        with self._lock:
+            return tuple(self._generations[layer] for layer in layers)
+
+    def put(self, key: str, data: bytes, content_type: str, layers, generations: tuple):
+        path = os.path.join(self.directory, key[:2], key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            # 描画中に対象レイヤーが無効化された場合は保存しない
+            if tuple(self._generations[layer] for layer in layers) != generations:
+                os.unlink(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            previous = self._index.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._index[key] = (path, len(data), tuple(layers), content_type)
+            self._bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        # 上限サイズを超えた分を最も使われていないタイルから削除する（ロック取得済みで呼ぶ）
+        while self._bytes > self.max_bytes and self._index:
+            key, (path, size, layers, content_type) = self._index.popitem(last=False)
+            self._bytes -= size
+            self.counters["evictions"] += 1
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def invalidate_layer(self, layer: str) -> int:
+        with self._lock:
+            self._generations[layer] += 1
+            keys = [key for key, entry in self._index.items() if layer in entry[2]]
+            for key in keys:
+                path, size, layers, content_type = self._index.pop(key)
+                self._bytes -= size
+                if os.path.exists(path):
+                    os.unlink(path)
+            self.counters["invalidations"] += len(keys)
+        return len(keys)
+
+    def coalesce(self, key: str, render):
+        # 同じキーの描画が実行中であれば、その結果を待って共有する
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.counters["coalesced"] += 1
+        if not owner:
+            return future.result()
+        try:
+            result = render()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "entries": len(self._index), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+cache = TileCache(config.WMS_CACHE_DIR, config.WMS_CACHE_MAX_BYTES)
+
+
+def _layers(params: dict) -> list:
+    # ワークスペース接頭辞を除いたレイヤー名（= テーブル名）
+    return [layer.split(":")[-1] for layer in params.get("layers", "").split(",") if layer]
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def _grid_position(params: dict):
+    # リクエストがタイルグリッドに揃った256pxタイルであれば、グリッド上の位置を返す
+    srs = (params.get("srs") or params.get("crs") or "").upper()
+    grid = GRIDS.get(srs)
+    if grid is None or (srs == "EPSG:4326" and params.get("version") == "1.3.0"):
+        return None
+    try:
+        width, height = int(params.get("width", 0)), int(params.get("height", 0))
+        minx, miny, maxx, maxy = (float(value) for value in params.get("bbox", "").split(","))
+    except ValueError:
+        return None
+    if width != config.WMS_TILE_SIZE or height != config.WMS_TILE_SIZE:
+        return None
+
+    origin_x, origin_y, grid_width, grid_height = grid
+    span = maxx - minx
+    if span <= 0 or not math.isclose(maxy - miny, span, rel_tol=1e-6):
+        return None
+    col, row, level = (minx - origin_x) / span, (origin_y - maxy) / span, math.log2(grid_width / span)
+    if not all(math.isclose(value, round(value), abs_tol=1e-4) for value in (col, row, level)):
+        return None
+    return {
+        "origin": (origin_x, origin_y), "span": span, "level": round(level), "col": round(col), "row": round(row),
+        "cols": round(grid_width / span), "rows": max(1, round(grid_height / span)),
+    }
+
+
+def _fetch(workspace_name: str, params: dict) -> requests.Response:
+    cache._count("upstream_requests")
+    started = time.perf_counter()
+    response = _session.get(
+        f"{config.GEOSERVER_URL}/{workspace_name}/wms",
+        params=params,
+        auth=(config.GEOSERVER_USER_NAME, config.GEOSERVER_USER_PASS),
+        timeout=config.WMS_REQUEST_TIMEOUT,
+    )
+    metrics.GEOSERVER_REQUEST_DURATION.labels("GET", str(response.status_code)).observe(time.perf_counter() - started)
+    return response
+
+
+def _is_image(response: requests.Response) -> bool:
+    return response.status_code == 200 and response.headers.get("Content-Type", "").startswith("image/")
+
+
+def _render_metatile(workspace_name: str, params: dict, position: dict, base_key: str, layers: list, generations: tuple) -> dict:
+    # メタタイル（WMS_METATILE × WMS_METATILE枚分）を1回で描画し、タイルに分割してキャッシュする
+    size = config.WMS_TILE_SIZE
+    metatile = config.WMS_METATILE
+    span = position["span"]
+    origin_x, origin_y = position["origin"]
+    first_col = position["col"] // metatile * metatile
+    first_row = position["row"] // metatile * metatile
+    cols = max(1, min(metatile, position["cols"] - first_col))
+    rows = max(1, min(metatile, position["rows"] - first_row))
+
+    bbox = (origin_x + first_col * span, origin_y - (first_row + rows) * span,
+            origin_x + (first_col + cols) * span, origin_y - first_row * span)
+    response = _fetch(workspace_name, {**params, "bbox": ",".join(repr(value) for value in bbox), "width": cols * size, "height": rows * size})
+    if not _is_image(response):
+        return {"error": response}
+
+    image_format = IMAGE_FORMATS[params["format"]]
+    content_type = response.headers["Content-Type"]
+    image = Image.open(io.BytesIO(response.content))
+    if image_format == "JPEG":
+        image = image.convert("RGB")
+    tiles = {}
+    for i in range(cols):
+        for j in range(rows):
+            buffer = io.BytesIO()
+            image.crop((i * size, j * size, (i + 1) * size, (j + 1) * size)).save(buffer, format=image_format)
+            key = _digest(base_key, position["level"], first_col + i, first_row + j)
+            tiles[key] = buffer.getvalue()
+            cache.put(key, tiles[key], content_type, layers, generations)
+    return {"tiles": tiles, "content_type": content_type}
+
+
+def get_map(workspace_name: str, params: dict):
+    # GetMapのレスポンスを (内容, Content-Type, ステータスコード, キャッシュ状態) で返す
+    params = {key.lower(): value for key, value in params.items()}
+    layers = _layers(params)
+    position = _grid_position(params)
+    base_key = _digest(workspace_name, *sorted((key, value) for key, value in params.items() if key not in _POSITION_PARAMS))
+    if position is not None:
+        key = _digest(base_key, position["level"], position["col"], position["row"])
+    else:
+        key = _digest(base_key, params.get("bbox"), params.get("width"), params.get("height"))
+
+    cached = cache.get(key)
+    if cached is not None:
+        cache._count("hits")
+        return cached[0], cached[1], 200, "HIT"
+    cache._count("misses")
+    generations = cache.generations(layers)
+
+    # グリッドに揃ったタイルはメタタイル単位でまとめて描画する（同じメタタイルへの同時リクエストは1回の描画を共有）
+    if position is not None and params.get("format") in IMAGE_FORMATS and config.WMS_METATILE > 1:
+        metatile_key = _digest(base_key, position["level"], position["col"] // config.WMS_METATILE, position["row"] // config.WMS_METATILE)
+        result = cache.coalesce(metatile_key, lambda: _render_metatile(workspace_name, params, position, base_key, layers, generations))
+        if "error" not in result and key in result["tiles"]:
+            return result["tiles"][key], result["content_type"], 200, "MISS"
+
+    def render():
+        response = _fetch(workspace_name, params)
+        if _is_image(response):
+            cache.put(key, response.content, response.headers["Content-Type"], layers, generations)
+        return response
+
+    response = cache.coalesce(key, render)
+    return response.content, response.headers.get("Content-Type"), response.status_code, "MISS"
+
+
+def forward(workspace_name: str, params: dict):
+    # GetMap以外のリクエスト（GetCapabilities等）はキャッシュせずに中継する
+    response = _fetch(workspace_name, params)
+    return response.content, response.headers.get("Content-Type"), response.status_code
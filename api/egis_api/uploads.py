@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from fastapi import UploadFile
+
+from . import config
+
+
+def spool_dir() -> str:
+    os.makedirs(config.UPLOAD_SPOOL_DIR, exist_ok=True)
+    return config.UPLOAD_SPOOL_DIR
+
+
+def spool_upload(file: UploadFile, suffix: str = "") -> str:
+    # アップロードファイルをメモリに載せずにチャンク単位でディスクへ書き出し、パスを返す
+    with tempfile.NamedTemporaryFile(delete=False, dir=spool_dir(), suffix=suffix) as spool:
+        shutil.copyfileobj(file.file, spool, config.UPLOAD_CHUNK_SIZE)
+    return spool.name
+
+
+def remove(path: str):
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+@contextmanager
+def spooled_upload(file: UploadFile, suffix: str = ""):
+    # withブロックを抜けると一時ファイルを削除する
+    path = spool_upload(file, suffix)
+    try:
+        yield path
+    finally:
+        remove(path)
@@ -0,0 +1,33 @@
+from egis_api.catalog import Catalog
+
+
+def _counting(value):
+    calls = []
+
+    def load():
+        calls.append(1)
+        return value
+
+    return load, calls
+
+
+def test_empty_values_are_not_cached_by_default():
+    catalog = Catalog(ttl=60)
+    load, calls = _counting({})
+    catalog.cached(("workspace_layers", "ws"), load)
+    catalog.cached(("workspace_layers", "ws"), load)
+    assert len(calls) == 2
+
+
+def test_keep_empty_caches_empty_values_but_not_none():
+    catalog = Catalog(ttl=60)
+    load, calls = _counting({})
+    assert catalog.cached(("workspace_layers", "ws"), load, keep_empty=True) == {}
+    assert catalog.cached(("workspace_layers", "ws"), load, keep_empty=True) == {}
+    assert len(calls) == 1
+
+    # 取得に失敗した（None を返した）場合はキャッシュしない
+    load, calls = _counting(None)
+    catalog.cached(("workspace_layers", "other"), load, keep_empty=True)
+    catalog.cached(("workspace_layers", "other"), load, keep_empty=True)
+    assert len(calls) == 2
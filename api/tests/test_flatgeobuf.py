@@ -0,0 +1,42 @@
+import datetime
+
+import fiona
+import shapely
+from shapely.geometry import shape
+from sqlalchemy import BigInteger, Date, Integer, String
+from sqlalchemy.dialects.postgresql import JSONB
+
+from egis_api import flatgeobuf
+
+
+def test_stream_is_readable_by_gdal(tmp_path):
+    # 生成したバイト列をGDALのFlatGeobufドライバーで読み込み、ジオメトリと属性が一致すること
+    geometries = [
+        shapely.Point(139.7, 35.6),
+        shapely.Polygon([(0, 0), (4, 0), (4, 4), (0, 4)], [[(1, 1), (2, 1), (2, 2), (1, 1)]]),
+        shapely.MultiLineString([[(0, 0), (1, 1)], [(2, 2), (3, 3), (4, 4)]]),
+        shapely.GeometryCollection([shapely.Point(0, 0), shapely.box(0, 0, 1, 1)]),
+        None,
+    ]
+    rows = [
+        {"geometry": shapely.to_wkb(geometry) if geometry is not None else None, "id": index, "big": 2 ** 40 + index,
+         "name": f"名前{index}" if index % 2 else None, "day": datetime.date(2024, 1, index + 1), "tags": {"n": [index]}}
+        for index, geometry in enumerate(geometries)
+    ]
+    columns = [("id", Integer()), ("big", BigInteger()), ("name", String()), ("day", Date()), ("tags", JSONB())]
+    path = tmp_path / "features.fgb"
+    path.write_bytes(b"".join(flatgeobuf.stream([rows[:2], rows[2:]], "features", columns)))
+
+    with fiona.open(path) as src:
+        assert list(src.schema["properties"]) == ["id", "big", "name", "day", "tags"]
+        features = list(src)
+    assert len(features) == len(rows)
+    for feature, row, geometry in zip(features, rows, geometries):
+        if geometry is None:
+            assert feature.geometry is None
+        else:
+            assert shape(feature.geometry).equals(geometry)
+        assert feature.properties["id"] == row["id"]
+        assert feature.properties["big"] == row["big"]
+        assert feature.properties["name"] == row["name"]
+        assert feature.properties["tags"] == f'{{"n": [{row["id"]}]}}'
@@ -0,0 +1,47 @@
+import json
+
+from sqlalchemy import Column
+
+from egis_api import importers, ingest, schema_inference
+
+
+def _write_geojson(path, properties: list):
+    features = [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [139.7, 35.6 + index * 0.01]}, "properties": values}
+        for index, values in enumerate(properties)
+    ]
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+def test_geojson_list_property_becomes_jsonb(tmp_path):
+    # 配列のプロパティが列ごと落ちずに、jsonb の列としてそのまま書き込まれること
+    path = str(tmp_path / "lists.geojson")
+    # 要素の型が揃った配列（OGRの IntegerList・StringList）は、既定の読み込みでは列ごと落ちる
+    _write_geojson(path, [
+        {"name": "a", "codes": [1, 2], "tags": ["x", "y"]},
+        {"name": "b", "codes": [3], "tags": ["z"]},
+        {"name": "c", "codes": None, "tags": None},
+    ])
+
+    batches = list(importers.read_vector_batches(path))
+    frame = batches[0]
+    assert list(frame["codes"][:2]) == [[1, 2], [3]]
+    assert list(frame["tags"][:2]) == [["x", "y"], ["z"]]
+    assert frame["codes"].isna()[2]
+
+    kinds = schema_inference.infer_kinds(batches)
+    assert kinds["codes"] == "jsonb"
+    assert kinds["tags"] == "jsonb"
+    assert kinds["name"] == "text"
+
+    column = Column("codes", schema_inference.column_type(kinds["codes"]))
+    prepared = ingest._prepare_frame(frame, [column], "binary")
+    encode = ingest._binary_encoder(column)
+    fields = encode(prepared["codes"].to_numpy(dtype=object), prepared["codes"].isna().to_numpy())
+    # 4バイトの長さの後に、JSONBのバージョン番号とJSONテキストが続く
+    assert fields[0][4:] == b"\x01[1, 2]"
+    assert fields[1][4:] == b"\x01[3]"
+
+    prepared = ingest._prepare_frame(frame, [column], "csv")
+    assert list(prepared["codes"][:2]) == ["[1, 2]", "[3]"]
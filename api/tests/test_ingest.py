@@ -0,0 +1,27 @@
+import csv
+import io
+
+import pandas as pd
+from sqlalchemy import Column, Integer, String
+
+from egis_api import ingest
+
+
+def _columns():
+    return [Column("name", String), Column("code", Integer)]
+
+
+def test_csv_keeps_empty_strings_apart_from_nulls():
+    # COPY (FORMAT csv) は引用符なしの空欄だけをNULLとして読むため、空文字列は引用符で囲む
+    frame = ingest._prepare_frame(pd.DataFrame({"name": ["", None, 'a "b", c'], "code": [1, 2, None]}), _columns(), "csv")
+    data = b"".join(ingest._csv_chunks(frame)).decode("utf-8")
+    assert data == '"",1\n,2\n"a ""b"", c",\n'
+    # 値そのものはCSVとして元に戻る
+    assert list(csv.reader(io.StringIO(data))) == [["", "1"], ["", "2"], ['a "b", c', ""]]
+
+
+def test_binary_keeps_empty_strings_apart_from_nulls():
+    frame = ingest._prepare_frame(pd.DataFrame({"name": ["", None]}), _columns()[:1], "binary")
+    fields = ingest._binary_encoder(_columns()[0])(frame["name"].to_numpy(dtype=object), frame["name"].isna().to_numpy())
+    # 長さ0の値と、長さ-1（NULL）
+    assert fields == [b"\x00\x00\x00\x00", b"\xff\xff\xff\xff"]
@@ -0,0 +1,66 @@
+import uuid
+
+import geopandas as gpd
+import pytest
+from fastapi import HTTPException
+from shapely.geometry import Point
+from sqlalchemy import Column, MetaData, SmallInteger, Table, text
+from sqlalchemy.exc import OperationalError
+
+from egis_api import importers, merge
+from egis_api.database import engine
+
+
+def _batch(codes: list, names: list) -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(
+        {"code": codes, "name": names},
+        geometry=[Point(139.7 + index * 0.01, 35.6) for index in range(len(codes))],
+        crs=4326,
+    )
+
+
+def test_incompatible_types_are_rejected_without_altering_the_target():
+    # 対象テーブルの型を広げる必要がある値は、列名を示して400にする
+    staging = Table("staging", MetaData(), Column("code", SmallInteger))
+    with pytest.raises(HTTPException) as error:
+        merge._check_types("parcels", staging, _batch([1, 100000], ["a", "b"]))
+    assert error.value.status_code == 400
+    assert "code (smallint in parcels, the imported data needs integer)" in error.value.detail
+
+    merge._check_types("parcels", staging, _batch([1, 2], ["a", "b"]))
+
+
+@pytest.fixture
+def schema_name():
+    # PostgreSQL（docker-compose の db）に接続できない環境ではスキップする
+    name = f"test_merge_{uuid.uuid4().hex[:8]}"
+    try:
+        with engine.connect() as connection:
+            connection.execute(text(f'CREATE SCHEMA "{name}"'))
+            connection.commit()
+    except OperationalError:
+        pytest.skip("PostgreSQL is not available")
+    yield name
+    with engine.connect() as connection:
+        connection.execute(text(f'DROP SCHEMA "{name}" CASCADE'))
+        connection.commit()
+
+
+def test_upsert_counts_inserted_updated_unchanged_and_skipped(schema_name):
+    importers.write_batches(schema_name, "parcels", iter([_batch([1, 2, 3], ["a", "b", "c"])]), importers.vector_columns)
+
+    # 2: 変更なし、3: 更新、4: 追加（同じキーの前の行は後の行で置き換えられる）
+    result = importers.write_batches(
+        schema_name, "parcels", iter([_batch([4, 2, 3, 4], ["old", "b", "x", "d"])]), importers.vector_columns, mode="upsert", key="code",
+    )
+    assert result == {"rows": 4, "inserted": 1, "updated": 1, "unchanged": 1, "skipped": 1}
+
+    with engine.connect() as connection:
+        rows = connection.execute(text(f'SELECT code, name FROM "{schema_name}".parcels ORDER BY code')).all()
+    assert [tuple(row) for row in rows] == [(1, "a"), (2, "b"), (3, "x"), (4, "d")]
+
+
+def test_append_counts_every_row_as_inserted(schema_name):
+    importers.write_batches(schema_name, "parcels", iter([_batch([1], ["a"])]), importers.vector_columns)
+    result = importers.write_batches(schema_name, "parcels", iter([_batch([2, 3], ["b", "c"])]), importers.vector_columns, mode="append")
+    assert result == {"rows": 2, "inserted": 2, "updated": 0, "unchanged": 0, "skipped": 0}
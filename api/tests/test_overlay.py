@@ -0,0 +1,23 @@
+from egis_api import overlay
+
+
+def _statement(operation, srid, monkeypatch):
+    # 実行せずに、区画ごとに実行するSQLだけを組み立てる
+    monkeypatch.setattr(overlay, "_overlay", lambda schema_name, table_name, operand_table, new_table_name, build_statement:
+                        build_statement(["id"], "parts", "partition", srid))
+    return operation("public", "target", "operand", "result")
+
+
+def test_clip_without_planar_column_intersects_as_geography(monkeypatch):
+    statement = _statement(overlay.clip, None, monkeypatch)
+    assert "ST_Intersection(a.geometry, c.geom::geography)" in statement
+
+
+def test_clip_with_planar_column_intersects_in_projected_crs(monkeypatch):
+    statement = _statement(overlay.clip, 32654, monkeypatch)
+    assert "ST_Transform(ST_Intersection(a.geometry_planar, c.geom), 4326)::geography" in statement
+
+
+def test_erase_without_planar_column_keeps_planar_difference_in_degrees(monkeypatch):
+    statement = _statement(overlay.erase, None, monkeypatch)
+    assert "ST_Difference(a.geometry::geometry, e.geom)::geography" in statement
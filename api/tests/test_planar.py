@@ -0,0 +1,26 @@
+import geopandas as gpd
+import pytest
+from fastapi import HTTPException
+from shapely.geometry import Point
+
+from egis_api import planar
+
+
+def _batch(*points):
+    return gpd.GeoDataFrame(geometry=[Point(x, y) if x is not None else None for x, y in points], crs=4326)
+
+
+def test_extent_grows_across_batches():
+    extent = planar.extend_extent(None, _batch((139.0, 35.0), (140.0, 36.0)))
+    # 空・欠損ジオメトリのみのバッチでは範囲は変わらない
+    extent = planar.extend_extent(extent, _batch((None, None)))
+    extent = planar.extend_extent(extent, _batch((141.0, 35.5)))
+    assert extent == (139.0, 35.0, 141.0, 36.0)
+
+
+def test_extent_too_large_fails_on_the_batch_that_exceeds_it():
+    # 1つ目のバッチでは収まり、2つ目のバッチを書き込む前に打ち切られること
+    extent = planar.extend_extent(None, _batch((139.0, 35.0)))
+    with pytest.raises(HTTPException) as error:
+        planar.extend_extent(extent, _batch((139.0 + planar.config.PLANAR_MAX_SPAN_DEGREES + 1, 35.0)))
+    assert error.value.status_code == 400
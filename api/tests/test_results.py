@@ -0,0 +1,16 @@
+from egis_api import results
+
+
+def test_budget_keeps_recent_entries_within_bytes():
+    # 最後に使われた日時が新しい順。合計サイズが上限を超えた記録から古いものはすべて削除する
+    entries = [("a", 40), ("b", 0), ("c", 50), ("d", 20), ("e", 0)]
+    assert results.over_budget(entries, max_bytes=100, max_entries=10) == ["d", "e"]
+
+
+def test_budget_limits_number_of_entries():
+    entries = [("a", 0), ("b", 0), ("c", 0)]
+    assert results.over_budget(entries, max_bytes=100, max_entries=2) == ["c"]
+
+
+def test_budget_keeps_everything_under_the_limits():
+    assert results.over_budget([("a", 10), ("b", 10)], max_bytes=20, max_entries=2) == []
@@ -0,0 +1,95 @@
+import pandas as pd
+import pytest
+from sqlalchemy import BigInteger, Boolean, Column, Date, DateTime, Integer, MetaData, SmallInteger, String, Table
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, JSONB, REAL
+
+from egis_api import schema_inference
+from egis_api.database import engine
+
+
+@pytest.mark.parametrize("values, kind", [
+    ([1, 2], "smallint"),
+    ([1, 40000], "integer"),
+    ([1, 2 ** 40], "bigint"),
+    # 欠損値を含む整数列（float64）も整数型にする
+    ([1, None], "smallint"),
+    ([1.5, 2.25], "real"),
+    ([0.1], "double"),
+    ([True, False], "boolean"),
+    ([[1], {"a": 1}], "jsonb"),
+    (["2020-01-01"], "date"),
+    (["2020-01-01T10:00"], "timestamp"),
+    (["2020-01-01T10:00Z"], "timestamptz"),
+    # 存在しない日付・数字だけの文字列・型の混在・int64 に収まらない整数は文字列
+    (["2023-02-30"], "text"),
+    (["001", "002"], "text"),
+    (["a", 1], "text"),
+    ([2 ** 70], "text"),
+    # すべて欠損値の列は型を決めない
+    ([None, None], None),
+])
+def test_infer_series(values, kind):
+    assert schema_inference.infer_series(pd.Series(values)) == kind
+
+
+@pytest.mark.parametrize("a, b, widened", [
+    ("smallint", "integer", "integer"),
+    ("integer", "bigint", "bigint"),
+    ("bigint", "smallint", "bigint"),
+    ("smallint", "real", "real"),
+    ("integer", "real", "double"),
+    ("bigint", "double", "double"),
+    ("date", "timestamp", "timestamp"),
+    ("integer", "date", "text"),
+    ("boolean", "smallint", "text"),
+    ("timestamp", "timestamptz", "text"),
+    (None, "integer", "integer"),
+    ("integer", None, "integer"),
+])
+def test_widen(a, b, widened):
+    assert schema_inference.widen(a, b) == widened
+    assert schema_inference.widen(b, a) == widened
+
+
+def test_infer_kinds_widens_across_batches():
+    # int → bigint → double の順に広がり、サンプル内ですべて欠損値の列は text になる
+    sampled = [
+        pd.DataFrame({"value": [1, 2], "empty": [None, None], "geometry": [None, None]}),
+        pd.DataFrame({"value": [2 ** 40, 1], "empty": [None, None], "geometry": [None, None]}),
+        pd.DataFrame({"value": [0.5, 1.0], "empty": [None, None], "geometry": [None, None]}),
+    ]
+    assert schema_inference.infer_kinds(sampled) == {"value": "double", "empty": "text"}
+
+
+def test_describe_counts_nulls():
+    sampled = [pd.DataFrame({"code": [1, None]}), pd.DataFrame({"code": [None, 3]})]
+    assert schema_inference.describe(sampled) == [{"name": "code", "type": "smallint", "nulls": 2}]
+
+
+@pytest.mark.parametrize("column_type, kind", [
+    (SmallInteger(), "smallint"), (Integer(), "integer"), (BigInteger(), "bigint"),
+    (REAL(), "real"), (DOUBLE_PRECISION(), "double"), (Boolean(), "boolean"),
+    (Date(), "date"), (DateTime(), "timestamp"), (DateTime(timezone=True), "timestamptz"),
+    (JSONB(), "jsonb"), (String(), "text"),
+])
+def test_kind_of_round_trips_column_types(column_type, kind):
+    assert schema_inference.kind_of(Column("value", column_type)) == kind
+    assert schema_inference.kind_of(Column("value", schema_inference.column_type(kind))) == kind
+
+
+class _Recorder:
+    # widen_table が発行するSQLを記録する接続の代わり
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+
+
+def test_widen_table_alters_only_columns_that_no_longer_fit():
+    table = Table("parcels", MetaData(), Column("code", SmallInteger), Column("area", REAL), Column("name", String), schema="public")
+    connection = _Recorder(engine.dialect)
+    schema_inference.widen_table(connection, table, pd.DataFrame({"code": [1, 100000], "area": [0.5, 0.25], "name": ["a", "b"]}))
+    assert connection.statements == ['ALTER TABLE public.parcels ALTER COLUMN code TYPE INTEGER USING code::INTEGER']
+    assert schema_inference.kind_of(table.c.code) == "integer"
@@ -143,7 +143,8 @@ const MapComponent: React.FC<MapComponentProps> = ({
     map.addSource(layerName, { // ソースIDとしてレイヤー名を使用
       'type': 'raster',
       'tiles': [
-        `${GEOSERVER_URL}/test_workspace/wms?service=WMS&request=GetMap&layers=${layerName}&styles=&format=image/png&transparent=true&version=1.1.1&width=256&height=256&srs=EPSG:3857&bbox={bbox-epsg-3857}`
+        // APIのWMSプロキシ経由で取得し、描画済みタイルはキャッシュから返す
+        `${API_URL}/wms/${GEOSERVER_WORKSPACE}?service=WMS&request=GetMap&layers=${layerName}&styles=&format=image/png&transparent=true&version=1.1.1&width=256&height=256&srs=EPSG:3857&bbox={bbox-epsg-3857}`
       ],
       'tileSize': 256,
     });